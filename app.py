@@ -1,14 +1,43 @@
+import os
+import re
+import csv
+import sys
+import gzip
+import json
 import time
+import heapq
+import bisect
+import queue
+import atexit
+import logging
+import argparse
 import random
 import sqlite3
+import functools
+import unicodedata
+import threading
+import multiprocessing
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import repeat
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 import streamlit as st
 
+logger = logging.getLogger(__name__)
+
 # ========= 基本配置 =========
 DB_PATH = Path("quiz.db")
 CSV_PATH = Path("questions.csv")
+# 多题库：questions.csv 是默认题库；BANKS_DIR 下每个 CSV 是一个题库（题库名取文件名），
+# 有人第一次选中时才导入。同名 .json 文件可以给该题库单独指定组卷配置，格式同 EXAM_CONFIG
+BANKS_DIR = Path("banks")
+DEFAULT_BANK_ID = 1
+DEFAULT_BANK_NAME = "默认题库"
 
 EXAM_CONFIG = {
     "单选题": {"count": 30, "score": 1},
@@ -16,19 +45,417 @@ EXAM_CONFIG = {
     "判断题": {"count": 20, "score": 1},
     "填空题": {"count": 10, "score": 2},
 }
+# 题型配置里可以加 "chapters": {"章节名": 题数, ...}，按章节配额抽题，剩余名额在该题型全体里随机补足
+# 组卷时尽量避开该用户最近这么多天做过的题，0 表示不避开
+EXAM_RECENT_DAYS = 3
+# 考核计时器单独刷新的间隔（秒），只重跑计时器这一小块
+EXAM_TIMER_REFRESH_SECONDS = 1
+# 考核时长；过了截止时间还没交的卷（比如学生关了页面）由后台线程代为交卷
+EXAM_DURATION_SECONDS = 60 * 60
+EXAM_SWEEP_GRACE_SECONDS = 30     # 截止后再等一会儿，让学生自己的页面先交卷
+EXAM_SWEEP_BATCH = 50             # 一个事务最多代交这么多张卷（每张卷几十条作答，别把写锁占太久）
+EXAM_SWEEP_RESYNC_SECONDS = 60    # 多久从库里增量捞一次别的副本开的卷
+# 按难度组卷：题目难度取 item_calibration 里标定的答对率（越大越容易），整卷按分值加权的期望得分率
+# 要落在目标 ± 容差内；None 表示以该题库按组卷配置算出的平均得分率为目标，只拉平不同考生之间的差异
+EXAM_TARGET_DIFFICULTY = None
+EXAM_DIFFICULTY_TOLERANCE = 0.01
+EXAM_SWAP_PROBE = 8               # 换题时在同一 (章节, 题型) 里，答对率最接近的位置两侧各最多看几道
+
+# 题目难度标定：答对率向同题库同题型的平均值收缩，相当于先给每题加这么多次平均水平的作答
+CALIBRATION_PRIOR_ATTEMPTS = 20
+CALIBRATION_REFRESH_SECONDS = 6 * 3600   # 标定结果多久重算一次（多个副本只有一个会去算）
+CALIBRATION_CHECK_SECONDS = 300          # 后台线程多久看一次是否该重算
+CALIBRATION_RECHECK_SECONDS = 60         # 组卷时最多隔这么久核对一次标定有没有更新
 
 QTYPE_ORDER = ["单选题", "多选题", "判断题", "填空题"]
+PRACTICE_MODES = ["章节刷题", "错题重刷", "到期复习", "随机刷题", "模拟考核"]
+
+# 连接池：每个进程一份，所有 Streamlit 会话共用
+POOL_SIZE = 16
+SQLITE_PRAGMAS = {
+    "auto_vacuum": "INCREMENTAL",  # 只对新建库生效，必须在切换 WAL 之前；老库由 maintain 做一次全量 VACUUM 切换
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",   # WAL 下 NORMAL 已能保证不损坏，只是断电可能丢最后一个事务
+    "cache_size": -32000,      # 负数单位为 KiB，约 32MB 页缓存
+    "mmap_size": 268435456,    # 256MB 内存映射读
+    "temp_store": "MEMORY",
+}
+STATEMENT_CACHE_SIZE = 256
+
+# 并发写：拿不到写锁时 SQLite 自己等 BUSY_TIMEOUT_SECONDS，仍然失败再整体重试几次（指数退避 + 随机抖动）
+BUSY_TIMEOUT_SECONDS = 5.0
+WRITE_RETRIES = 4
+WRITE_RETRY_BASE_SECONDS = 0.05
+WRITE_RETRY_MAX_SECONDS = 2.0
+
+# 题库导入
+IMPORT_COLUMNS = ["chapter", "q_type", "text", "options", "answer"]
+IMPORT_BATCH_SIZE = 5000
+IMPORT_REJECT_SAMPLES = 200
+
+# 作答记录归档：超过这么多天的原始作答合并成按天汇总，可选导出到压缩文件
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_BATCH_SIZE = 50000
+ARCHIVE_COLUMNS = ["id", "user_id", "question_id", "is_correct", "answer_text", "ts"]
+
+# 题目搜索：trigram 分词最短匹配 3 个字，更短的词退化为逐行查找
+SEARCH_LIMIT = 50
+SEARCH_MIN_TERM = 3
+
+# 题目去重：题干+选项按字符 3-gram 做 MinHash，LSH 分桶找候选，签名相似度达到阈值算重复
+# 合并会删题、改作答记录，默认不在自动导入时做；先用 python app.py dedup 看报告，再 dedup --merge
+DEDUP_ON_IMPORT = False         # 打开后首次自动导入题库时顺带合并重复题
+DEDUP_SHINGLE = 3
+DEDUP_NUM_PERM = 64
+DEDUP_BANDS = 16                # 16 段 × 4 行：相似度 0.85 的两题几乎必定进同一个桶
+DEDUP_THRESHOLD = 0.85
+DEDUP_SEED = 20240901           # 固定随机排列，同一份题库每次跑出的结果一致
+
+# 内存题库：其他进程导入新题库后，最多这么久就能被本进程发现
+BANK_RECHECK_SECONDS = 5.0
+# 内存里同时保留的题库总大小（估算）上限，超出时淘汰最久没用的题库，正在用的那个总会留下
+BANK_MEMORY_BUDGET_MB = 512
+
+# 练习时每次装入的题目窗口大小（当前题 + 后面几题）
+PRACTICE_PREFETCH = 5
+PERMUTE_ROUNDS = 6
+
+# 错题间隔复习（SM-2）：答错后 REVIEW_RELEARN_MINUTES 分钟再出现；连续答对的间隔依次为 1 天、6 天，之后乘以难度系数
+REVIEW_RELEARN_MINUTES = 10
+REVIEW_FIRST_INTERVALS = (1.0, 6.0)
+REVIEW_EASE_INIT = 2.5
+REVIEW_EASE_MIN = 1.3
+REVIEW_QUALITY_CORRECT = 4      # SM-2 的 0-5 评分：答对记 4（难度系数不变），答错记 2
+REVIEW_QUALITY_WRONG = 2
+REVIEW_QUEUE_LIMIT = 200        # 一轮到期复习最多取这么多题
+
+# 练习作答写后台队列（可选）：点提交不再等 fsync，由单个后台线程合并成批量事务写入
+WRITE_BEHIND = os.environ.get("QUIZ_WRITE_BEHIND", "") == "1"
+WRITE_BEHIND_FLUSH_SECONDS = 0.5
+WRITE_BEHIND_BATCH_SIZE = 500
+WRITE_BEHIND_MAX_RETRIES = 5
+WRITE_BEHIND_SPILL_FILE = Path("answer_spill.jsonl")   # 重试用尽的批次追加到这里，写线程下次启动时重新入队
+
+# 性能监控：分位数窗口、Prometheus 文本导出文件和导出间隔；调试面板只对这些用户名显示
+METRICS_WINDOW = 1024
+METRICS_FILE = Path(os.environ.get("QUIZ_METRICS_FILE", "metrics.prom"))
+METRICS_EXPORT_SECONDS = 15.0
+ADMIN_USERS = {u.strip() for u in os.environ.get("QUIZ_ADMIN_USERS", "").split(",") if u.strip()}
+
+# 班级题目分析（只对 ADMIN_USERS 显示）：按 answer_log.id 高水位增量累加，每批读这么多行
+COHORT_CHUNK_ROWS = 1_000_000
+COHORT_REFRESH_SECONDS = 30.0        # 两次增量刷新的最短间隔
+COHORT_MIN_EXAM_ATTEMPTS = 10        # 考核作答少于这么多次的题不算区分度
+COHORT_MASTERY_ACCURACY = 0.8        # 某章正确率达到这个值、且作答不少于下面的次数，算该学生掌握了这一章
+COHORT_MASTERY_MIN_ATTEMPTS = 5
+COHORT_TOP_WRONG = 3                 # 每道题列出的常见错答个数
+
+# 纸质考试批量判分（python app.py grade-sheets）：每个工作进程一次判这么多份答卷；
+# 答卷文件小于 GRADE_SHEETS_POOL_MIN_BYTES 时直接在本进程判（spawn 一个工作进程要几秒，判一万份答卷不到一秒）；
+# 作答记录攒够这么多条提交一个事务，统计表按批整体更新，一批大约写 1 秒，别让在线作答等写锁等到超时
+GRADE_SHEETS_CHUNK = 500
+GRADE_SHEETS_POOL_MIN_BYTES = 32 << 20
+GRADE_SHEETS_WRITE_ROWS = 40_000
+
+
+# ========= 性能监控 =========
+class Metrics:
+    """进程内耗时统计：每个 (类别, 名称) 保留最近 METRICS_WINDOW 个样本算分位数，另计累计次数和总耗时。
+
+    当前 rerun 的明细（各段耗时、SQL 条数）记在线程局部变量里，供调试面板展示。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._samples = {}
+        self._totals = {}
+        self._last_export = 0.0
+        self.local = threading.local()
+
+    def observe(self, kind: str, name: str, ms: float):
+        key = (kind, name)
+        with self._lock:
+            window = self._samples.get(key)
+            if window is None:
+                window = self._samples[key] = deque(maxlen=METRICS_WINDOW)
+                self._totals[key] = [0, 0.0]
+            window.append(ms)
+            totals = self._totals[key]
+            totals[0] += 1
+            totals[1] += ms
+        rerun = getattr(self.local, "rerun", None)
+        if rerun is not None:
+            entry = rerun["calls"].setdefault(key, [0, 0.0])
+            entry[0] += 1
+            entry[1] += ms
+
+    def count_query(self):
+        # 连接池的连接每次 execute / executemany 调一次（见 CountingConnection），只记在正在记录的 rerun 上
+        rerun = getattr(self.local, "rerun", None)
+        if rerun is not None:
+            rerun["queries"] += 1
+
+    def begin_rerun(self):
+        self.local.rerun = {"start": time.perf_counter(), "queries": 0, "calls": {}}
+
+    def end_rerun(self) -> dict:
+        rerun = getattr(self.local, "rerun", None)
+        if rerun is None:
+            return None
+        self.local.rerun = None
+        rerun["total_ms"] = (time.perf_counter() - rerun["start"]) * 1000
+        self.observe("rerun", "main", rerun["total_ms"])
+        self.observe("rerun", "queries", rerun["queries"])
+        return rerun
+
+    def current_rerun(self) -> dict:
+        return getattr(self.local, "rerun", None)
+
+    def snapshot(self) -> list:
+        with self._lock:
+            items = [(key, sorted(window), tuple(self._totals[key])) for key, window in self._samples.items()]
+        rows = []
+        for (kind, name), samples, (count, total) in sorted(items):
+            rows.append({
+                "kind": kind,
+                "name": name,
+                "count": count,
+                "sum": total,
+                "p50": _quantile(samples, 0.5),
+                "p95": _quantile(samples, 0.95),
+                "p99": _quantile(samples, 0.99),
+            })
+        return rows
+
+    def maybe_export(self, path: Path):
+        """距上次导出超过 METRICS_EXPORT_SECONDS 才写一次 Prometheus 文本格式文件"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_export < METRICS_EXPORT_SECONDS:
+                return
+            self._last_export = now
+        lines = [
+            "# HELP quiz_duration_seconds 数据访问和页面各段耗时（分位数为最近样本滚动计算）",
+            "# TYPE quiz_duration_seconds summary",
+        ]
+        query_lines = [
+            "# HELP quiz_rerun_queries 每次页面 rerun 执行的 SQL 语句数",
+            "# TYPE quiz_rerun_queries summary",
+        ]
+        for row in self.snapshot():
+            if row["kind"] == "rerun" and row["name"] == "queries":
+                metric, labels, scale, out = "quiz_rerun_queries", "", 1, query_lines
+            else:
+                metric, scale, out = "quiz_duration_seconds", 1000.0, lines
+                labels = f'kind="{row["kind"]}",name="{row["name"]}"'
+            sep = "," if labels else ""
+            for q, key in (("0.5", "p50"), ("0.95", "p95"), ("0.99", "p99")):
+                out.append(f'{metric}{{{labels}{sep}quantile="{q}"}} {row[key] / scale:.6f}')
+            out.append(f"{metric}_sum{{{labels}}} {row['sum'] / scale:.6f}")
+            out.append(f"{metric}_count{{{labels}}} {row['count']}")
+        # 同一目录下可能有多个进程在导出，临时文件按进程区分
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            tmp.write_text("\n".join(lines + query_lines) + "\n", encoding="utf-8")
+            os.replace(tmp, path)  # 原子替换，抓取方不会读到写了一半的文件
+        except OSError as e:
+            # 导出只是旁路，写不了也不能影响页面
+            logger.warning("性能指标导出到 %s 失败：%s", path, e)
+            try:
+                tmp.unlink(missing_ok=True)
+            except OSError:
+                pass
+
+
+def _quantile(sorted_samples: list, q: float) -> float:
+    if not sorted_samples:
+        return 0.0
+    return sorted_samples[min(len(sorted_samples) - 1, int(q * len(sorted_samples)))]
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics() -> Metrics:
+    return Metrics()
+
+
+_resources = {}
+
+
+def resource(factory, *args):
+    """在本次脚本执行内记住 cache_resource 的查找结果。
+
+    一次 cache_resource 查找要几十微秒，比一条主键查询还贵；Streamlit 每次 rerun 都会重新执行脚本，
+    这个字典也随之重建，所以不会比 cache_resource 本身活得更久。
+    """
+    key = (factory.__name__,) + args
+    obj = _resources.get(key)
+    if obj is None:
+        obj = _resources[key] = factory(*args)
+    return obj
+
+
+def timed(kind: str, name: str = None):
+    """装饰器：记录函数耗时到 Metrics"""
+    def decorator(fn):
+        label = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                resource(get_metrics).observe(kind, label, (time.perf_counter() - start) * 1000)
+        return wrapper
+    return decorator
+
+
+@contextmanager
+def timed_section(name: str):
+    """记录一段页面渲染代码的耗时"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        resource(get_metrics).observe("render", name, (time.perf_counter() - start) * 1000)
 
 
 # ========= 数据库 =========
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+class CountingCursor(sqlite3.Cursor):
+    def execute(self, *args):
+        resource(get_metrics).count_query()
+        return super().execute(*args)
 
+    def executemany(self, *args):
+        resource(get_metrics).count_query()
+        return super().executemany(*args)
 
-def init_db():
-    conn = get_conn()
+
+class CountingConnection(sqlite3.Connection):
+    """按调用次数计 SQL 条数：一次 executemany 算一条，触发器里的语句不算。
+
+    不用 trace callback：那个每执行一行、每条触发器语句都回调一次，批量写入时开销明显，数出来的也不是往返次数。
+    """
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        resource(get_metrics).count_query()
+        return super().execute(*args)
+
+    def executemany(self, *args):
+        resource(get_metrics).count_query()
+        return super().executemany(*args)
+
+
+class ConnectionPool:
+    """SQLite 长连接池。连接按需创建、用完归还，跨线程复用（同一时刻只被一个线程持有）。"""
+
+    def __init__(self, db_path: str, size: int = POOL_SIZE):
+        self.db_path = db_path
+        self._idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT_SECONDS,       # busy_timeout：遇到锁先等待，而不是立刻报 database is locked
+            isolation_level=None,               # 事务由 transaction() 显式管理
+            check_same_thread=False,            # 池内连接会被不同脚本线程轮流使用
+            cached_statements=STATEMENT_CACHE_SIZE,
+            factory=CountingConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        for name, value in SQLITE_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value}")
+        return conn
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn: sqlite3.Connection):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close_all(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+@st.cache_resource(show_spinner=False)
+def get_pool(db_path: str) -> ConnectionPool:
+    # Streamlit 每次 rerun 都会重新执行本脚本，池必须放在 cache_resource 里才能跨 rerun、跨会话存活
+    return ConnectionPool(db_path)
+
+
+@contextmanager
+def get_conn():
+    """从连接池借出一个连接，退出 with 时归还（未提交的事务会被回滚）。"""
+    pool = resource(get_pool, str(DB_PATH))
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
+
+
+@contextmanager
+def transaction(immediate: bool = True):
+    """借出连接并开启事务，正常退出提交，异常回滚。
+
+    默认 BEGIN IMMEDIATE：一开始就拿写锁，拿不到时走 busy_timeout 等待。
+    DEFERRED 事务在读过之后再升级写锁，如果期间别的连接提交过，SQLite 会直接报 locked，不会等待。
+    """
+    with get_conn() as conn:
+        conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+        try:
+            yield conn
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+
+def is_lock_error(exc: BaseException) -> bool:
+    if not isinstance(exc, sqlite3.OperationalError):
+        return False
+    msg = str(exc).lower()
+    return "locked" in msg or "busy" in msg
+
+
+def retry_on_lock(fn):
+    """装饰器：函数因锁冲突失败时整体重试。
+
+    被装饰的函数要在自己的 transaction() 里完成全部写入，失败时事务已回滚，重跑一遍是安全的。
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        for attempt in range(WRITE_RETRIES + 1):
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError as exc:
+                if attempt == WRITE_RETRIES or not is_lock_error(exc):
+                    raise
+                delay = min(WRITE_RETRY_BASE_SECONDS * 2 ** attempt, WRITE_RETRY_MAX_SECONDS)
+                logger.warning("%s 遇到锁冲突（第 %d 次），%.0f ms 内重试", fn.__name__, attempt + 1, delay * 1000)
+                time.sleep(random.uniform(0, delay))  # 全抖动，避免多个会话同时醒来再撞一次
+    return wrapper
+
+
+# ========= 数据库迁移 =========
+# 每个迁移步骤只能追加、不能修改；步骤序号即 PRAGMA user_version 的版本号
+def _migration_1_base_tables(conn):
+    """初始三张表；对升级前的老库是幂等的"""
     cur = conn.cursor()
 
     cur.execute("""
@@ -64,48 +491,1005 @@ def init_db():
         )
     """)
 
-    conn.commit()
-    conn.close()
 
+def _migration_2_query_indexes(conn):
+    """按 app.py 里真实的查询形状建索引"""
+    # get_question_stats / get_chapter_summary / 清空记录：按用户、按题查作答记录，覆盖 is_correct 免回表
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_answer_log_user_question
+        ON answer_log(user_id, question_id, is_correct)
+    """)
+    # 随机刷题、组卷按题型取题；章节刷题按章节（+题型）取题，章节列表按章节去重排序
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_questions_type_chapter ON questions(q_type, chapter)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_questions_chapter_type ON questions(chapter, q_type)")
 
-def import_csv_if_empty():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(1) FROM questions")
-    count = cur.fetchone()[0]
-    if count > 0:
-        conn.close()
+
+def _migration_3_meta(conn):
+    """键值元数据表，目前只存题库版本号（每次导入 +1，用来让内存题库缓存失效）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('bank_version', '0')")
+
+
+def _migration_4_user_stats(conn):
+    """按用户物化的统计表，由触发器在写 answer_log / wrong_log 的同一事务里维护（迁移 15 起改由 write_answers 维护）"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_question_stats (
+            user_id TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            correct_cnt INTEGER NOT NULL DEFAULT 0,
+            wrong_cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, question_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_chapter_stats (
+            user_id TEXT NOT NULL,
+            chapter TEXT NOT NULL,
+            done_cnt INTEGER NOT NULL DEFAULT 0,
+            wrong_cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, chapter)
+        ) WITHOUT ROWID
+    """)
+
+    # 每条作答累加到 (用户, 题) 计数
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_answer_log_stats AFTER INSERT ON answer_log BEGIN
+            INSERT INTO user_question_stats (user_id, question_id, correct_cnt, wrong_cnt)
+            VALUES (NEW.user_id, NEW.question_id, NEW.is_correct != 0, NEW.is_correct = 0)
+            ON CONFLICT(user_id, question_id) DO UPDATE SET
+                correct_cnt = correct_cnt + excluded.correct_cnt,
+                wrong_cnt = wrong_cnt + excluded.wrong_cnt;
+        END
+    """)
+    # (用户, 题) 第一次出现即「已刷」一道新题；upsert 走 UPDATE 分支时不会触发这里
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_user_question_stats_done AFTER INSERT ON user_question_stats BEGIN
+            INSERT INTO user_chapter_stats (user_id, chapter, done_cnt, wrong_cnt)
+            SELECT NEW.user_id, chapter, 1, 0 FROM questions WHERE id = NEW.question_id
+            ON CONFLICT(user_id, chapter) DO UPDATE SET done_cnt = done_cnt + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_wrong_log_insert AFTER INSERT ON wrong_log BEGIN
+            INSERT INTO user_chapter_stats (user_id, chapter, done_cnt, wrong_cnt)
+            SELECT NEW.user_id, chapter, 0, 1 FROM questions WHERE id = NEW.question_id
+            ON CONFLICT(user_id, chapter) DO UPDATE SET wrong_cnt = wrong_cnt + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER IF NOT EXISTS trg_wrong_log_delete AFTER DELETE ON wrong_log BEGIN
+            UPDATE user_chapter_stats SET wrong_cnt = wrong_cnt - 1
+            WHERE user_id = OLD.user_id
+              AND chapter = (SELECT chapter FROM questions WHERE id = OLD.question_id);
+        END
+    """)
+
+    rebuild_user_stats(conn)
+
+
+def _migration_5_answer_log_recent(conn):
+    """组卷时按用户查最近做过的题"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_answer_log_user_ts ON answer_log(user_id, ts)")
+
+
+def _migration_6_answer_log_daily(conn):
+    """归档后的作答按 (用户, 题, 天) 汇总，重算统计时和 answer_log 合在一起算"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS answer_log_daily (
+            user_id TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            day INTEGER NOT NULL,              -- UTC 天序号：CAST(ts / 86400 AS INTEGER)
+            correct_cnt INTEGER NOT NULL DEFAULT 0,
+            wrong_cnt INTEGER NOT NULL DEFAULT 0,
+            last_ts REAL NOT NULL,
+            PRIMARY KEY (user_id, question_id, day)
+        ) WITHOUT ROWID
+    """)
+
+
+FTS_SYNC_TRIGGERS = {
+    "trg_questions_fts_insert": """
+        CREATE TRIGGER IF NOT EXISTS trg_questions_fts_insert AFTER INSERT ON questions BEGIN
+            INSERT INTO questions_fts (rowid, text, options) VALUES (NEW.id, NEW.text, NEW.options);
+        END
+    """,
+    "trg_questions_fts_delete": """
+        CREATE TRIGGER IF NOT EXISTS trg_questions_fts_delete AFTER DELETE ON questions BEGIN
+            INSERT INTO questions_fts (questions_fts, rowid, text, options) VALUES ('delete', OLD.id, OLD.text, OLD.options);
+        END
+    """,
+    "trg_questions_fts_update": """
+        CREATE TRIGGER IF NOT EXISTS trg_questions_fts_update AFTER UPDATE OF text, options ON questions BEGIN
+            INSERT INTO questions_fts (questions_fts, rowid, text, options) VALUES ('delete', OLD.id, OLD.text, OLD.options);
+            INSERT INTO questions_fts (rowid, text, options) VALUES (NEW.id, NEW.text, NEW.options);
+        END
+    """,
+}
+
+
+def _migration_7_questions_fts(conn):
+    """题干和选项的全文索引（外部内容表，由触发器和 questions 保持同步）。
+
+    trigram 分词不依赖空格切词，中文也能按任意子串检索。SQLite 没编译 FTS5 时跳过，搜索退化为逐行查找。
+    """
+    try:
+        conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS questions_fts USING fts5(
+                text, options, content = 'questions', content_rowid = 'id', tokenize = 'trigram'
+            )
+        """)
+    except sqlite3.OperationalError as e:
+        logger.warning("当前 SQLite 不支持 FTS5 trigram（%s），题目搜索将逐行查找", e)
         return
+    for sql in FTS_SYNC_TRIGGERS.values():
+        conn.execute(sql)
+    conn.execute("INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')")
+
+
+def _migration_8_review_schedule(conn):
+    """错题的间隔复习排期；(user_id, due_ts) 索引让「现在到期的题」成为一次范围查询"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS review_schedule (
+            user_id TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            reps INTEGER NOT NULL DEFAULT 0,           -- 连续答对次数
+            interval_days REAL NOT NULL DEFAULT 0,
+            ease REAL NOT NULL DEFAULT 2.5,
+            due_ts REAL NOT NULL,
+            lapses INTEGER NOT NULL DEFAULT 0,         -- 累计答错次数
+            PRIMARY KEY (user_id, question_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_review_schedule_due ON review_schedule(user_id, due_ts)")
+    # 错题本里已有的题立即到期
+    conn.execute("""
+        INSERT OR IGNORE INTO review_schedule (user_id, question_id, due_ts, lapses)
+        SELECT user_id, question_id, last_wrong_ts, wrong_count FROM wrong_log
+    """)
+
+
+def _migration_9_answer_key(conn):
+    """预先算好的规范答案，判分时不再逐题规范化标准答案"""
+    if "answer_key" not in {r[1] for r in conn.execute("PRAGMA table_info(questions)")}:
+        conn.execute("ALTER TABLE questions ADD COLUMN answer_key")  # 不声明类型：选择题存整数，其余存文本
+    rows = conn.execute("SELECT id, q_type, answer FROM questions").fetchall()
+    conn.executemany("UPDATE questions SET answer_key = ? WHERE id = ?",
+                     [(canonical_answer(q_type, answer), qid) for qid, q_type, answer in rows])
+
+
+def _migration_10_exam_session(conn):
+    """进行中的模拟考核：试卷只存题目 id（array("q") 的字节），作答和标记按题号逐条 upsert。
+
+    每个用户最多一张 active 的卷，任何副本按 user_id 都能接着考。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS exam_session (
+            id INTEGER PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            question_ids BLOB NOT NULL,
+            start_ts REAL NOT NULL,
+            status TEXT NOT NULL DEFAULT 'active',   -- active / finished / abandoned
+            finished_ts REAL,
+            total_score INTEGER
+        )
+    """)
+    conn.execute("""
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_exam_session_active
+        ON exam_session(user_id) WHERE status = 'active'
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS exam_session_answer (
+            session_id INTEGER NOT NULL,
+            pos INTEGER NOT NULL,                    -- 题号（从 0 开始）
+            answer TEXT,
+            marked INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (session_id, pos)
+        ) WITHOUT ROWID
+    """)
+
+
+def _migration_11_banks(conn):
+    """多题库：题目按 bank_id 分区。题号仍是全库唯一的，作答、错题、复习这些按题号记的表不用动。
+
+    不同题库的章节可能重名，user_chapter_stats 改为按 (用户, 题库, 章节) 统计；
+    进行中的考卷也按 (用户, 题库) 各保留一张。
+    """
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS banks (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE,
+            source TEXT,                           -- 导入来源 CSV
+            exam_config TEXT,                      -- JSON，格式同 EXAM_CONFIG；为空时用 EXAM_CONFIG
+            version INTEGER NOT NULL DEFAULT 0,    -- 每次导入、合并、改配置 +1，让各进程的内存题库失效
+            created_ts REAL NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO banks (id, name, source, created_ts) VALUES (?, ?, ?, ?)",
+                 (DEFAULT_BANK_ID, DEFAULT_BANK_NAME, str(CSV_PATH), time.time()))
+    if "bank_id" not in {r[1] for r in conn.execute("PRAGMA table_info(questions)")}:
+        conn.execute(f"ALTER TABLE questions ADD COLUMN bank_id INTEGER NOT NULL DEFAULT {DEFAULT_BANK_ID}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_questions_bank ON questions(bank_id)")
+
+    if "bank_id" not in {r[1] for r in conn.execute("PRAGMA table_info(exam_session)")}:
+        conn.execute(f"ALTER TABLE exam_session ADD COLUMN bank_id INTEGER NOT NULL DEFAULT {DEFAULT_BANK_ID}")
+    conn.execute("DROP INDEX IF EXISTS idx_exam_session_active")
+    conn.execute("""
+        CREATE UNIQUE INDEX idx_exam_session_active
+        ON exam_session(user_id, bank_id) WHERE status = 'active'
+    """)
+
+    for name in ("trg_user_question_stats_done", "trg_wrong_log_insert", "trg_wrong_log_delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+    conn.execute("DROP TABLE IF EXISTS user_chapter_stats")
+    conn.execute("""
+        CREATE TABLE user_chapter_stats (
+            user_id TEXT NOT NULL,
+            bank_id INTEGER NOT NULL,
+            chapter TEXT NOT NULL,
+            done_cnt INTEGER NOT NULL DEFAULT 0,
+            wrong_cnt INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, bank_id, chapter)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TRIGGER trg_user_question_stats_done AFTER INSERT ON user_question_stats BEGIN
+            INSERT INTO user_chapter_stats (user_id, bank_id, chapter, done_cnt, wrong_cnt)
+            SELECT NEW.user_id, bank_id, chapter, 1, 0 FROM questions WHERE id = NEW.question_id
+            ON CONFLICT(user_id, bank_id, chapter) DO UPDATE SET done_cnt = done_cnt + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER trg_wrong_log_insert AFTER INSERT ON wrong_log BEGIN
+            INSERT INTO user_chapter_stats (user_id, bank_id, chapter, done_cnt, wrong_cnt)
+            SELECT NEW.user_id, bank_id, chapter, 0, 1 FROM questions WHERE id = NEW.question_id
+            ON CONFLICT(user_id, bank_id, chapter) DO UPDATE SET wrong_cnt = wrong_cnt + 1;
+        END
+    """)
+    conn.execute("""
+        CREATE TRIGGER trg_wrong_log_delete AFTER DELETE ON wrong_log BEGIN
+            UPDATE user_chapter_stats SET wrong_cnt = wrong_cnt - 1
+            WHERE (user_id, bank_id, chapter) =
+                  (SELECT OLD.user_id, bank_id, chapter FROM questions WHERE id = OLD.question_id);
+        END
+    """)
+    rebuild_user_stats(conn)
+
+
+def _migration_12_answer_exam_link(conn):
+    """考核作答记下所属的考试会话，班级分析据此拿整卷总分算区分度；练习作答为 NULL"""
+    if "exam_session_id" not in {r[1] for r in conn.execute("PRAGMA table_info(answer_log)")}:
+        conn.execute("ALTER TABLE answer_log ADD COLUMN exam_session_id INTEGER")
+
+
+def _has_fts(conn) -> bool:
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'questions_fts'").fetchone() is not None
+
+
+def _migration_13_item_calibration(conn):
+    """题目难度标定表，由 calibrate_items 整表重算；meta 里记最近一次标定和认领的时间"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS item_calibration (
+            question_id INTEGER PRIMARY KEY,
+            bank_id INTEGER NOT NULL,
+            attempts INTEGER NOT NULL,           -- 作答次数（含已归档的）
+            correct INTEGER NOT NULL,
+            difficulty REAL NOT NULL,            -- 收缩后的答对率，越大越容易
+            updated_ts REAL NOT NULL
+        )
+    """)
+    # 组卷按题库整批读难度，覆盖索引不用回表
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_item_calibration_bank ON item_calibration(bank_id, question_id, difficulty)
+    """)
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('calibrated_ts', '0')")
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('calibration_claim_ts', '0')")
+
+
+def _migration_14_compaction_count(conn):
+    """meta 里记合并旧作答的批次数，班级分析看到它变了就从头重算"""
+    conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('compactions', '0')")
+
+
+def _migration_15_batch_stats(conn):
+    """统计表改由 write_answers 按批整体更新：逐行触发器在批量判分时每条作答要多跑几条语句"""
+    for name in ("trg_answer_log_stats", "trg_user_question_stats_done", "trg_wrong_log_insert", "trg_wrong_log_delete"):
+        conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+
+
+MIGRATIONS = [
+    _migration_1_base_tables,
+    _migration_2_query_indexes,
+    _migration_3_meta,
+    _migration_4_user_stats,
+    _migration_5_answer_log_recent,
+    _migration_6_answer_log_daily,
+    _migration_7_questions_fts,
+    _migration_8_review_schedule,
+    _migration_9_answer_key,
+    _migration_10_exam_session,
+    _migration_11_banks,
+    _migration_12_answer_exam_link,
+    _migration_13_item_calibration,
+    _migration_14_compaction_count,
+    _migration_15_batch_stats,
+]
+
+
+def migrate(conn) -> int:
+    """把数据库升级到最新版本，返回升级后的版本号。多个进程同时启动时只有一个会真正执行。"""
+    latest = len(MIGRATIONS)
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= latest:
+        return latest
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # 拿到写锁后重读一次，别的进程可能刚升级完
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for step_no in range(version + 1, latest + 1):
+            MIGRATIONS[step_no - 1](conn)
+            conn.execute(f"PRAGMA user_version = {step_no}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.execute("PRAGMA optimize")
+    return latest
+
+
+@timed("data")
+def init_db():
+    with get_conn() as conn:
+        migrate(conn)
+
+
+# ========= 题库导入 =========
+def validate_question(chapter: str, q_type: str, text: str, options: str, answer: str):
+    """校验一道题，合法返回 None，否则返回拒绝原因"""
+    if not chapter:
+        return "章节为空"
+    if q_type not in QTYPE_ORDER:
+        return f"未知题型：{q_type}"
+    if not text:
+        return "题干为空"
+    if not answer:
+        return "答案为空"
+
+    if q_type in ("单选题", "多选题"):
+        opts = [o.strip() for o in options.split("||")] if options else []
+        if len(opts) < 2:
+            return "选项少于两个"
+        letters = {o[0].upper() for o in opts if o and o[0].isalpha()}
+        ans = answer.upper()
+        if q_type == "单选题" and (len(ans) != 1 or ans not in letters):
+            return f"单选答案不在选项中：{answer}"
+        if q_type == "多选题" and (len(set(ans)) != len(ans) or not set(ans) <= letters):
+            return f"多选答案不在选项中：{answer}"
+
+    if q_type == "判断题" and normalize_tf(answer) not in ("对", "错"):
+        return f"判断题答案应为对/错：{answer}"
+    return None
+
+
+def import_questions(csv_path: Path, replace: bool = False, batch_size: int = IMPORT_BATCH_SIZE,
+                     progress=None, bank_id: int = DEFAULT_BANK_ID) -> dict:
+    """流式导入题库 CSV 到 bank_id 题库：逐行校验，按批 executemany，整个文件在一个事务里。
+
+    progress(已处理行数) 每批回调一次。返回 {"inserted", "rejected_count", "rejected"}，
+    rejected 只保留前 IMPORT_REJECT_SAMPLES 条 (行号, 原因)，内存不随文件大小增长。
+    """
+    report = {"inserted": 0, "rejected_count": 0, "rejected": []}
+    sql = ("INSERT INTO questions (chapter, q_type, text, options, answer, answer_key, bank_id) "
+           "VALUES (?, ?, ?, ?, ?, ?, ?)")
+
+    # utf-8-sig 兼容 Excel 导出时带的 BOM
+    with open(csv_path, encoding="utf-8-sig", newline="") as f, transaction() as conn:
+        reader = csv.DictReader(f)
+        missing = [c for c in IMPORT_COLUMNS if c not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"题库文件缺少列：{', '.join(missing)}")
+        fts = _has_fts(conn)
+        if fts:
+            # 逐行触发同步全文索引比导入完一次性补齐慢两三倍；DDL 也在本事务里，失败会一起回滚
+            conn.execute("DROP TRIGGER IF EXISTS trg_questions_fts_insert")
+            conn.execute("DROP TRIGGER IF EXISTS trg_questions_fts_delete")
+        last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM questions").fetchone()[0]
+        if replace:
+            conn.execute("DELETE FROM questions WHERE bank_id = ?", (bank_id,))
+
+        batch = []
+        processed = 0
+        for row in reader:
+            processed += 1
+            values = tuple((row.get(c) or "").strip() for c in IMPORT_COLUMNS)
+            reason = validate_question(*values)
+            if reason:
+                report["rejected_count"] += 1
+                if len(report["rejected"]) < IMPORT_REJECT_SAMPLES:
+                    report["rejected"].append((reader.line_num, reason))
+                continue
+            batch.append(values + (canonical_answer(values[1], values[4]), bank_id))
+            if len(batch) >= batch_size:
+                conn.executemany(sql, batch)
+                report["inserted"] += len(batch)
+                batch.clear()
+                if progress:
+                    progress(processed)
+        if batch:
+            conn.executemany(sql, batch)
+            report["inserted"] += len(batch)
+        if progress:
+            progress(processed)
+        if fts:
+            if replace:
+                conn.execute("INSERT INTO questions_fts (questions_fts) VALUES ('rebuild')")
+            else:
+                # AUTOINCREMENT 保证新题号都大于导入前的最大题号
+                conn.execute("""
+                    INSERT INTO questions_fts (rowid, text, options)
+                    SELECT id, text, options FROM questions WHERE id > ?
+                """, (last_id,))
+            conn.execute(FTS_SYNC_TRIGGERS["trg_questions_fts_insert"])
+            conn.execute(FTS_SYNC_TRIGGERS["trg_questions_fts_delete"])
+        bump_bank_version(conn, bank_id)
+
+    resource(get_bank_registry, str(DB_PATH)).invalidate(bank_id)
+    return report
+
+
+# ========= 题目去重 =========
+_STEM_NUMBER = re.compile(r"^\s*\d+\s*[.、．]?\s*")
+_OPTION_LABEL = re.compile(r"^\s*[A-Za-z]\s*[、.．:：)）]?\s*")
+_NON_WORD = re.compile(r"[\W_]+")
+_MERSENNE_31 = (1 << 31) - 1
+
+
+def _norm_text(s: str) -> str:
+    return _NON_WORD.sub("", s or "").lower()
+
+
+def question_fingerprint(q_type: str, text: str, options: str, answer: str):
+    """返回 (参与相似度计算的文本, 规范化答案)。
+
+    去掉题号、空白和标点；选项去掉字母编号后排序，答案换成对应的选项内容，所以选项换了顺序也算同一题。
+    """
+    stem = _norm_text(_STEM_NUMBER.sub("", text or "", count=1))
+    contents = {}
+    for opt in (options or "").split("||"):
+        if opt.strip():
+            contents[opt.strip()[0].upper()] = _norm_text(_OPTION_LABEL.sub("", opt, count=1))
+    if q_type in ("单选题", "多选题"):
+        key = tuple(sorted(contents.get(c, c) for c in str(answer).upper() if c.isalpha()))
+    elif q_type == "判断题":
+        key = normalize_tf(answer)
+    else:
+        key = _norm_text(answer)
+    return stem + "|" + "|".join(sorted(contents.values())), key
+
+
+def minhash_signatures(docs: list) -> np.ndarray:
+    """每篇文本一行 DEDUP_NUM_PERM 个最小哈希，按块向量化计算。
+
+    字符 n-gram 直接由码位拼成整数（码位不超过 21 位，3-gram 恰好无冲突），
+    再用 multiply-shift 哈希族模拟随机排列，uint64 乘法溢出回绕正是它要的取模。
+    """
+    rng = np.random.default_rng(DEDUP_SEED)
+    a = (rng.integers(0, 1 << 63, DEDUP_NUM_PERM, dtype=np.uint64) | np.uint64(1))[:, None]
+    b = rng.integers(0, 1 << 63, DEDUP_NUM_PERM, dtype=np.uint64)[:, None]
+    k = DEDUP_SHINGLE
+    sigs = np.empty((len(docs), DEDUP_NUM_PERM), dtype=np.uint64)
+    chunk = 1024
+    for start in range(0, len(docs), chunk):
+        part = [d.ljust(k, "\0") for d in docs[start:start + chunk]]  # 太短的文本补齐，保证至少一个 gram
+        lengths = np.fromiter((len(d) for d in part), dtype=np.int64, count=len(part))
+        codes = np.frombuffer("".join(part).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        grams = np.zeros(len(codes) - k + 1, dtype=np.uint64)
+        for j in range(k):
+            grams = (grams << np.uint64(21)) ^ codes[j:len(codes) - k + 1 + j]
+        # 去掉跨两篇文本的 gram：每篇最后 k-1 个起点
+        valid = np.ones(len(codes), dtype=bool)
+        ends = np.cumsum(lengths)
+        for j in range(1, k):
+            valid[ends - j] = False
+        grams = grams[valid[:len(grams)]]
+        offsets = ends - lengths - (k - 1) * np.arange(len(part))
+        with np.errstate(over="ignore"):
+            hashed = (a * grams[None, :] + b) >> np.uint64(32)
+        sigs[start:start + len(part)] = np.minimum.reduceat(hashed, offsets, axis=1).T
+    return sigs
+
+
+def find_duplicate_groups(rows, threshold: float = DEDUP_THRESHOLD) -> list:
+    """rows: [(id, q_type, text, options, answer), ...]，按题号升序。
+
+    返回重复组列表 [{"keep", "merge", "conflict", "similarity"}]：keep 是组内最小题号，
+    merge 是答案与它一致、可以合并的题，conflict 是题干选项相似但答案不同、只报告不合并的题。
+    完全相同的文本先直接归组；其余每个 LSH 桶只和桶里第一道题比较签名，整体接近线性。
+    """
+    n = len(rows)
+    if n < 2:
+        return []
+    fps = [question_fingerprint(r[1], r[2], r[3], r[4]) for r in rows]
+    first_seen = {}
+    parent = [first_seen.setdefault((rows[i][1], fps[i][0]), i) for i in range(n)]
+    uniq = np.array(sorted(first_seen.values()), dtype=np.int64)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    sim_of = {}
+    if len(uniq) > 1:
+        sigs = minhash_signatures([fps[i][0] for i in uniq])
+        _, type_code = np.unique([rows[i][1] for i in uniq], return_inverse=True)
+        width = DEDUP_NUM_PERM // DEDUP_BANDS
+        for band in range(DEDUP_BANDS):
+            # 题型不同的题不会是重复题，题型编码并进桶键
+            part = np.ascontiguousarray(
+                np.column_stack([type_code.astype(np.uint64), sigs[:, band * width:(band + 1) * width]]))
+            keys = part.view(np.dtype((np.void, part.dtype.itemsize * part.shape[1]))).ravel()
+            _, first_idx, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            first = first_idx[inverse.ravel()]
+            cand = np.nonzero(first != np.arange(len(uniq)))[0]
+            sims = (sigs[cand] == sigs[first[cand]]).mean(axis=1)
+            keep = sims >= threshold
+            for i, j, sim in zip(uniq[cand[keep]].tolist(), uniq[first[cand[keep]]].tolist(), sims[keep].tolist()):
+                ri, rj = find(i), find(j)
+                if ri != rj:
+                    parent[max(ri, rj)] = min(ri, rj)
+                sim_of[i] = min(sim_of.get(i, 1.0), sim)
+
+    members = {}
+    for i in range(n):
+        members.setdefault(find(i), []).append(i)
+    groups = []
+    for root, idx in members.items():
+        if len(idx) < 2:
+            continue
+        keep_key = fps[root][1]
+        groups.append({
+            "keep": rows[root][0],
+            "merge": [rows[i][0] for i in idx[1:] if fps[i][1] == keep_key],
+            "conflict": [rows[i][0] for i in idx[1:] if fps[i][1] != keep_key],
+            "similarity": min(sim_of.get(i, 1.0) for i in idx[1:]),
+        })
+    return groups
+
+
+def dedup_questions(merge: bool = False, threshold: float = DEDUP_THRESHOLD, bank_id: int = DEFAULT_BANK_ID) -> dict:
+    """在一个题库里找重复题，merge=True 时把答案一致的重复题合并到保留题；不跨题库合并"""
+    with get_conn() as conn:
+        rows = conn.execute(
+            "SELECT id, q_type, text, options, answer FROM questions WHERE bank_id = ? ORDER BY id", (bank_id,)
+        ).fetchall()
+    groups = find_duplicate_groups(rows, threshold)
+    mapping = {dup: g["keep"] for g in groups for dup in g["merge"]}
+    report = {
+        "questions": len(rows),
+        "groups": groups,
+        "duplicates": len(mapping),
+        "conflicts": sum(len(g["conflict"]) for g in groups),
+        "merged": 0,
+    }
+    if merge and mapping:
+        report["merged"] = merge_duplicates(mapping, bank_id)
+    return report
+
+
+def merge_duplicates(mapping: dict, bank_id: int = DEFAULT_BANK_ID) -> int:
+    """把重复题合并到保留题：作答记录、归档汇总和错题本改指保留题，删除重复题并重算统计表。
+
+    mapping: {重复题号: 保留题号}，都属于 bank_id 题库。返回实际删除的题数。
+    """
+    with transaction() as conn:
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS dedup_map (dup INTEGER PRIMARY KEY, keep INTEGER NOT NULL)")
+        conn.execute("DELETE FROM temp.dedup_map")
+        conn.executemany("INSERT INTO temp.dedup_map (dup, keep) VALUES (?, ?)", mapping.items())
+
+        conn.execute("""
+            UPDATE answer_log SET question_id = m.keep
+            FROM temp.dedup_map m WHERE answer_log.question_id = m.dup
+        """)
+        # 下面两张表以 (用户, 题) 为键，改指后可能和保留题已有的行撞键，先合并再删旧行
+        conn.execute("""
+            INSERT INTO answer_log_daily (user_id, question_id, day, correct_cnt, wrong_cnt, last_ts)
+            SELECT d.user_id, m.keep, d.day, SUM(d.correct_cnt), SUM(d.wrong_cnt), MAX(d.last_ts)
+            FROM answer_log_daily d JOIN temp.dedup_map m ON d.question_id = m.dup
+            GROUP BY d.user_id, m.keep, d.day
+            ON CONFLICT(user_id, question_id, day) DO UPDATE SET
+                correct_cnt = correct_cnt + excluded.correct_cnt,
+                wrong_cnt = wrong_cnt + excluded.wrong_cnt,
+                last_ts = MAX(last_ts, excluded.last_ts)
+        """)
+        conn.execute("DELETE FROM answer_log_daily WHERE question_id IN (SELECT dup FROM temp.dedup_map)")
+        conn.execute("""
+            INSERT INTO wrong_log (user_id, question_id, wrong_count, last_wrong_ts)
+            SELECT w.user_id, m.keep, SUM(w.wrong_count), MAX(w.last_wrong_ts)
+            FROM wrong_log w JOIN temp.dedup_map m ON w.question_id = m.dup
+            GROUP BY w.user_id, m.keep
+            ON CONFLICT(user_id, question_id) DO UPDATE SET
+                wrong_count = wrong_count + excluded.wrong_count,
+                last_wrong_ts = MAX(last_wrong_ts, excluded.last_wrong_ts)
+        """)
+        conn.execute("DELETE FROM wrong_log WHERE question_id IN (SELECT dup FROM temp.dedup_map)")
+        # 复习排期：保留题已有排期的以它为准，否则沿用重复题的
+        conn.execute("""
+            INSERT OR IGNORE INTO review_schedule (user_id, question_id, reps, interval_days, ease, due_ts, lapses)
+            SELECT r.user_id, m.keep, r.reps, r.interval_days, r.ease, r.due_ts, r.lapses
+            FROM review_schedule r JOIN temp.dedup_map m ON r.question_id = m.dup
+        """)
+        conn.execute("DELETE FROM review_schedule WHERE question_id IN (SELECT dup FROM temp.dedup_map)")
+
+        deleted = conn.execute("DELETE FROM questions WHERE id IN (SELECT dup FROM temp.dedup_map)").rowcount
+        conn.execute("DROP TABLE temp.dedup_map")
+        rebuild_user_stats(conn)
+        bump_bank_version(conn, bank_id)
+
+    resource(get_bank_registry, str(DB_PATH)).invalidate(bank_id)
+    return deleted
+
+
+@timed("data")
+def import_csv_if_empty(bank_id: int = DEFAULT_BANK_ID) -> bool:
+    """题库为空时从它的 CSV 导入（默认题库用 CSV_PATH）；返回导入后题库是否可用"""
+    with get_conn() as conn:
+        count = conn.execute("SELECT COUNT(1) FROM questions WHERE bank_id = ?", (bank_id,)).fetchone()[0]
+        row = conn.execute("SELECT name, source FROM banks WHERE id = ?", (bank_id,)).fetchone()
+    if count > 0:
+        return True
+    if row is None:
+        st.error(f"题库 {bank_id} 不存在。")
+        return False
+
+    name, source = row
+    csv_path = CSV_PATH if bank_id == DEFAULT_BANK_ID else Path(source or "")
+    if not csv_path.is_file():
+        st.error(f"题库文件 {csv_path} 不存在，请先上传。")
+        return False
+
+    with st.spinner(f"正在导入题库「{name}」..."):
+        try:
+            report = import_questions(csv_path, bank_id=bank_id)
+        except ValueError as e:
+            st.error(str(e))
+            return False
+    if report["rejected_count"]:
+        st.warning(f"题库导入完成：{report['inserted']} 题，跳过 {report['rejected_count']} 行不合法数据。")
+    if DEDUP_ON_IMPORT:
+        dedup = dedup_questions(merge=True, bank_id=bank_id)
+        if dedup["merged"]:
+            st.info(f"导入时合并了 {dedup['merged']} 道重复题。")
+    return report["inserted"] > 0
+
+
+def _is_count(x) -> bool:
+    return isinstance(x, int) and not isinstance(x, bool) and x >= 0
+
+
+def check_exam_config(cfg) -> dict:
+    """检查组卷配置的结构，不合格时抛 ValueError：
+    {题型: {"count": 题数, "score": 每题分值, "chapters": {章节: 题数}（可选）}}，数都是非负整数
+    """
+    if not isinstance(cfg, dict) or not cfg:
+        raise ValueError("组卷配置应为 {题型: {...}} 形式的非空对象")
+    for q_type, item in cfg.items():
+        if not isinstance(item, dict):
+            raise ValueError(f"{q_type}：应为对象")
+        for key in ("count", "score"):
+            if not _is_count(item.get(key)):
+                raise ValueError(f"{q_type}：{key} 应为非负整数")
+        chapters = item.get("chapters", {})
+        if not isinstance(chapters, dict) or not all(_is_count(v) for v in chapters.values()):
+            raise ValueError(f"{q_type}：chapters 应为 {{章节: 题数}}，题数为非负整数")
+    return cfg
+
+
+def _read_exam_config(path: Path):
+    """题库 CSV 旁边同名的 .json 组卷配置，没有时返回 None。
+
+    配置写错时记一条警告并改用默认的 EXAM_CONFIG，免得到组卷时才报错。
+    """
+    cfg_path = path.with_suffix(".json")
+    if not cfg_path.is_file():
+        return None
+    try:
+        cfg = check_exam_config(json.loads(cfg_path.read_text(encoding="utf-8")))
+    except ValueError as e:
+        logger.warning("题库 %s 的组卷配置 %s 不可用，改用默认配置：%s", path.stem, cfg_path.name, e)
+        cfg = EXAM_CONFIG
+    return json.dumps(cfg, ensure_ascii=False, sort_keys=True)
+
+
+@retry_on_lock
+def upsert_bank(name: str, source: Path = None, exam_config: str = None) -> int:
+    """登记一个题库（只登记，不导入），返回题库 id。不给 exam_config 时保留原有配置；
+    配置变了时版本号 +1，让各进程重新加载。"""
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO banks (name, source, exam_config, created_ts) VALUES (?, ?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET
+                source = COALESCE(excluded.source, source),
+                version = version + (exam_config IS NOT COALESCE(excluded.exam_config, exam_config)),
+                exam_config = COALESCE(excluded.exam_config, exam_config)
+        """, (name, str(source) if source else None, exam_config, time.time()))
+        return conn.execute("SELECT id FROM banks WHERE name = ?", (name,)).fetchone()[0]
+
+
+def register_bank_files() -> int:
+    """把 BANKS_DIR 下的每个 CSV 登记为一个题库，返回登记数"""
+    if not BANKS_DIR.is_dir():
+        return 0
+    n = 0
+    for path in sorted(BANKS_DIR.glob("*.csv")):
+        # 存绝对路径：导入时的工作目录不一定是登记时的
+        upsert_bank(path.stem, path.resolve(), _read_exam_config(path))
+        n += 1
+    return n
+
+
+@timed("data")
+def list_banks() -> list:
+    """[(题库 id, 题库名), ...]，默认题库在前"""
+    with get_conn() as conn:
+        return [tuple(r) for r in conn.execute("SELECT id, name FROM banks ORDER BY id")]
+
+
+@st.cache_resource(show_spinner=False)
+def get_setup_state() -> dict:
+    return {"lock": threading.Lock(), "ready": set()}
 
-    if not CSV_PATH.exists():
-        conn.close()
-        st.error("题库文件 questions.csv 不存在，请先上传。")
+
+def ensure_db_ready():
+    """每个进程每个库只做一次迁移检查和题库登记"""
+    state = resource(get_setup_state)
+    key = str(DB_PATH)
+    if key in state["ready"]:
         return
+    with state["lock"]:
+        if key in state["ready"]:
+            return
+        init_db()
+        register_bank_files()
+        state["ready"].add(key)
+
+
+def ensure_bank_ready(bank_id: int) -> bool:
+    """题库第一次被选中时才导入；还没导进来时下次 rerun 再试"""
+    state = resource(get_setup_state)
+    key = (str(DB_PATH), bank_id)
+    if key in state["ready"]:
+        return True
+    with state["lock"]:
+        if key in state["ready"]:
+            return True
+        if not import_csv_if_empty(bank_id):
+            return False
+        state["ready"].add(key)
+        return True
+
+
+# ========= 内存题库 =========
+def bump_bank_version(conn, bank_id: int):
+    conn.execute("UPDATE banks SET version = version + 1 WHERE id = ?", (bank_id,))
+
+
+class QuestionBank:
+    """一个题库的只读内存快照：按列存放题目，并预先建好按章节、题型、(章节, 题型) 的 id 索引。
+
+    进程内所有会话共享同一个实例，任何调用方都不能修改它。
+    """
+
+    FIELDS = ("id", "chapter", "q_type", "text", "options", "answer", "answer_key", "bank_id")
+    # 估算内存时每道题除字符串以外的开销：索引数组、列表槽位、_pos 字典项
+    ROW_OVERHEAD_BYTES = 160
+
+    def __init__(self, rows, bank_id: int = DEFAULT_BANK_ID, exam_config: dict = None, version: int = 0):
+        self.bank_id = bank_id
+        self.version = version
+        self.exam_config = exam_config or EXAM_CONFIG
+        self.nbytes = 0
+        self.ids = array("q")
+        self._pos = {}
+        self._chapter, self._q_type, self._text, self._options, self._answer = [], [], [], [], []
+        self._key = []
+        self._views = {}
+        self.by_chapter = {}
+        self.by_type = {}
+        self.by_chapter_type = {}
+
+        interned = {}
+        for qid, chapter, q_type, text, options, answer, key in rows:
+            chapter = interned.setdefault(chapter, chapter)
+            q_type = interned.setdefault(q_type, q_type)
+            self._pos[qid] = len(self.ids)
+            self.ids.append(qid)
+            self._chapter.append(chapter)
+            self._q_type.append(q_type)
+            self._text.append(text)
+            self._options.append(options)
+            self._answer.append(answer)
+            self._key.append(key if key is not None else canonical_answer(q_type, answer))
+            self.nbytes += sys.getsizeof(text) + sys.getsizeof(options) + sys.getsizeof(answer) + self.ROW_OVERHEAD_BYTES
+            self.by_chapter.setdefault(chapter, array("q")).append(qid)
+            self.by_type.setdefault(q_type, array("q")).append(qid)
+            self.by_chapter_type.setdefault((chapter, q_type), array("q")).append(qid)
+
+        self.chapters = sorted(self.by_chapter)
+        # 已知题型按 QTYPE_ORDER，未知题型排在最后
+        self.type_order = [t for t in QTYPE_ORDER if t in self.by_type] + \
+            sorted(t for t in self.by_type if t not in QTYPE_ORDER)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, qid):
+        return qid in self._pos
+
+    def get(self, qid: int) -> dict:
+        """按 id 取题，返回新建的 dict，调用方可以随意修改"""
+        i = self._pos[qid]
+        return {
+            "id": qid,
+            "chapter": self._chapter[i],
+            "q_type": self._q_type[i],
+            "text": self._text[i],
+            "options": self._options[i],
+            "answer": self._answer[i],
+            "answer_key": self._key[i],
+            "bank_id": self.bank_id,
+        }
 
-    df = pd.read_csv(CSV_PATH).fillna("")
-    for _, row in df.iterrows():
-        cur.execute("""
-            INSERT INTO questions (chapter, q_type, text, options, answer)
-            VALUES (?, ?, ?, ?, ?)
-        """, (
-            str(row["chapter"]).strip(),
-            str(row["q_type"]).strip(),
-            str(row["text"]).strip(),
-            str(row["options"]).strip(),
-            str(row["answer"]).strip(),
-        ))
-    conn.commit()
-    conn.close()
+    def chapter_of(self, qid: int) -> str:
+        return self._chapter[self._pos[qid]]
+
+    def type_of(self, qid: int) -> str:
+        return self._q_type[self._pos[qid]]
+
+    def key_of(self, qid: int):
+        return self._key[self._pos[qid]]
+
+    def view(self, qid: int) -> dict:
+        """渲染用的预处理结果，每道题第一次用到时算一次，之后所有会话共用；调用方不能修改"""
+        v = self._views.get(qid)
+        if v is None:
+            i = self._pos[qid]
+            v = self._views[qid] = build_question_view(self._chapter[i], self._q_type[i], self._text[i], self._options[i])
+        return v
+
+    def select(self, chapter: str = "全部", q_type: str = "全部") -> dict:
+        """按筛选条件返回 {题型: id 数组}，按 type_order 排列，不复制数组"""
+        result = {}
+        for t in self.type_order:
+            if q_type != "全部" and t != q_type:
+                continue
+            if chapter == "全部":
+                ids = self.by_type.get(t)
+            else:
+                ids = self.by_chapter_type.get((chapter, t))
+            if ids:
+                result[t] = ids
+        return result
+
+    @classmethod
+    def load(cls, conn, bank_id: int = DEFAULT_BANK_ID, exam_config: dict = None, version: int = 0):
+        cur = conn.execute("""
+            SELECT id, chapter, q_type, text, options, answer, answer_key FROM questions
+            WHERE bank_id = ? ORDER BY id
+        """, (bank_id,))
+        return cls(((r[0], r[1], r[2], r[3], r[4] or "", r[5], r[6]) for r in cur), bank_id, exam_config, version)
+
+
+def build_question_view(chapter: str, q_type: str, text: str, options: str) -> dict:
+    """选项列表、选项字母、转义后的题干和标签 HTML，省得每次 rerun 重新切分和转义"""
+    opts = tuple(options.split("||")) if options else ()
+    letters = tuple(o[0] if o and o[0].isalpha() else str(i) for i, o in enumerate(opts))
+    return {
+        "options": opts,
+        "letters": letters,
+        "letter_of": dict(zip(opts, letters)),
+        "index_of": {letter: i for i, letter in enumerate(letters)},
+        "stem_html": escape_html(text),
+        "tags_html": f'<span class="tag">{escape_html(chapter)}</span><span class="tag">{escape_html(q_type)}</span>',
+        "type_tag_html": f'<span class="tag">{escape_html(q_type)}</span>',
+    }
+
+
+def question_view(row: dict) -> dict:
+    """优先取内存题库里缓存的视图；题目已不在当前题库里（例如考试中途重新导入）时现算"""
+    bank = get_bank(row.get("bank_id", DEFAULT_BANK_ID))
+    if row["id"] in bank:
+        return bank.view(row["id"])
+    return build_question_view(row["chapter"], row["q_type"], row["text"], row["options"])
+
+
+class BankRegistry:
+    """当前进程加载过的题库。题库第一次被要到时才加载，版本号变化时重新加载；
+    估算的总大小超过 BANK_MEMORY_BUDGET_MB 时，按最近一次使用的时间淘汰其他题库。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}   # bank_id -> [QuestionBank, 版本号, 上次核对版本的时间, 上次使用的时间]
+        self._listeners = []
+
+    def get(self, bank_id: int) -> QuestionBank:
+        now = time.time()
+        entry = self._entries.get(bank_id)
+        if entry is not None and now - entry[2] < BANK_RECHECK_SECONDS:
+            entry[3] = now
+            return entry[0]
+        with self._lock:
+            entry = self._entries.get(bank_id)
+            if entry is not None and time.time() - entry[2] < BANK_RECHECK_SECONDS:
+                entry[3] = now
+                return entry[0]
+            with get_conn() as conn:
+                conn.execute("BEGIN")  # 版本号和题目在同一个快照里读
+                row = conn.execute("SELECT version, exam_config FROM banks WHERE id = ?", (bank_id,)).fetchone()
+                if row is None:
+                    conn.rollback()
+                    raise KeyError(f"题库 {bank_id} 不存在")
+                version, exam_config = row
+                if entry is None or version != entry[1]:
+                    bank = QuestionBank.load(conn, bank_id, json.loads(exam_config) if exam_config else None, version)
+                    entry = self._entries[bank_id] = [bank, version, 0.0, now]
+                conn.rollback()
+            entry[2] = entry[3] = time.time()
+            self._evict(keep=bank_id)
+            return entry[0]
+
+    def _evict(self, keep: int):
+        """调用方持有 _lock"""
+        budget = BANK_MEMORY_BUDGET_MB * 1048576
+        total = sum(e[0].nbytes for e in self._entries.values())
+        while total > budget and len(self._entries) > 1:
+            victim = min((bid for bid in self._entries if bid != keep), key=lambda bid: self._entries[bid][3])
+            total -= self._entries.pop(victim)[0].nbytes
+            logger.info("内存题库超出预算，淘汰题库 %s", victim)
+            for fn in self._listeners:
+                fn(victim)
+
+    def on_evict(self, fn):
+        """题库被淘汰时调用 fn(bank_id)，让按题库缓存的派生数据一起释放"""
+        self._listeners.append(fn)
+
+    def loaded(self) -> dict:
+        """{题库 id: 估算字节数}，给性能面板看"""
+        return {bid: e[0].nbytes for bid, e in list(self._entries.items())}
+
+    def invalidate(self, bank_id: int = None):
+        """下次 get() 时强制核对版本号；不给 bank_id 时对所有题库生效"""
+        for bid, entry in list(self._entries.items()):
+            if bank_id is None or bid == bank_id:
+                entry[2] = 0.0
+
+
+@st.cache_resource(show_spinner=False)
+def get_bank_registry(db_path: str) -> BankRegistry:
+    return BankRegistry()
+
+
+@timed("data")
+def get_bank(bank_id: int = DEFAULT_BANK_ID) -> QuestionBank:
+    return resource(get_bank_registry, str(DB_PATH)).get(bank_id)
 
 
 # ========= 工具函数 =========
+_TF_TOKENS = {
+    **dict.fromkeys(["对", "√", "是", "正确", "T", "True", "true"], "对"),
+    **dict.fromkeys(["错", "×", "否", "错误", "F", "False", "false"], "错"),
+}
+
+
 def normalize_tf(x: str) -> str:
     x = str(x).strip()
-    if x in ["对", "√", "是", "正确", "T", "True", "true"]:
-        return "对"
-    if x in ["错", "×", "否", "错误", "F", "False", "false"]:
-        return "错"
-    return x
+    return _TF_TOKENS.get(x, x)
 
 
 def escape_html(s: str) -> str:
@@ -114,24 +1498,32 @@ def escape_html(s: str) -> str:
     return str(s).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
 
 
-def check_answer(q_type: str, user_answer, std_answer: str) -> bool:
-    std_answer = str(std_answer).strip()
-    if q_type == "判断题":
-        return normalize_tf(user_answer) == normalize_tf(std_answer)
+_WHITESPACE = re.compile(r"\s+")
 
-    if q_type == "多选题":
-        if not user_answer:
-            return False
-        ua = "".join(sorted([str(x).strip().upper() for x in user_answer]))
-        sa = "".join(sorted(list(std_answer.strip().upper())))
-        return ua == sa
 
-    if q_type == "单选题":
-        if user_answer is None:
-            return False
-        return str(user_answer).strip().upper() == std_answer.strip().upper()
+def canonical_answer(q_type: str, answer):
+    """标准答案或作答的规范形式，两者相等即答对；空作答返回 None。
+
+    选择题为选项字母的位掩码（A=1, B=2, C=4 …，与顺序、大小写、重复无关），判断题为「对」/「错」，
+    填空题做全角转半角、去空白、忽略大小写。题目的规范答案导入时算好存在 questions.answer_key。
+    """
+    if answer is None or (isinstance(answer, (str, list, tuple)) and not answer):
+        return None
+    if q_type in ("单选题", "多选题"):
+        letters = answer if isinstance(answer, str) else "".join(str(x) for x in answer)
+        mask = 0
+        for c in letters.upper():
+            if "A" <= c <= "Z":
+                mask |= 1 << (ord(c) - 65)
+        return mask or None
+    if q_type == "判断题":
+        return normalize_tf(answer)
+    return _WHITESPACE.sub("", unicodedata.normalize("NFKC", str(answer))).casefold() or None
+
 
-    return str(user_answer).strip() == std_answer.strip()
+def answer_matches(q_type: str, user_answer, answer_key) -> bool:
+    key = canonical_answer(q_type, user_answer)
+    return key is not None and key == answer_key
 
 
 def format_hms(seconds: int) -> str:
@@ -145,149 +1537,309 @@ def format_hms(seconds: int) -> str:
     return f"{m:02d}:{s:02d}"
 
 
-def get_all_chapters() -> list:
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT DISTINCT chapter FROM questions ORDER BY chapter")
-    rows = [r[0] for r in cur.fetchall()]
-    conn.close()
-    return rows
+@timed("data")
+def get_all_chapters(bank_id: int = DEFAULT_BANK_ID) -> list:
+    return get_bank(bank_id).chapters
 
 
 # ========= 题目获取&统计 =========
-def fetch_questions_for_mode(user_id: str, mode: str, chapter: str = "全部", q_type_filter: str = "全部"):
-    """获取符合条件的所有题目列表（按题型排序）"""
-    conn = get_conn()
-    cur = conn.cursor()
+def read_with_pending(read):
+    """调用 read()。开启 WRITE_BEHIND 时 read 会先读库、再叠加未落库的作答，期间有批次落库就重读，
+    免得同一条作答在库里和队列里各算一次或都没算上。"""
+    if not WRITE_BEHIND:
+        return read()
+    return resource(get_answer_writer, str(DB_PATH)).consistent(read)
+
+
+@timed("data")
+def get_wrong_ids(user_id: str) -> list:
+    def read():
+        with get_conn() as conn:
+            ids = [r[0] for r in conn.execute("SELECT question_id FROM wrong_log WHERE user_id = ?", (user_id,))]
+        if WRITE_BEHIND:
+            ids = resource(get_answer_writer, str(DB_PATH)).overlay_wrong_ids(user_id, ids)
+        return ids
+    return read_with_pending(read)
+
+
+def _select_for_mode(user_id: str, mode: str, chapter: str, q_type_filter: str,
+                     bank_id: int = DEFAULT_BANK_ID) -> dict:
+    """按模式和筛选条件返回 bank_id 题库里的 {题型: id 序列}"""
+    bank = get_bank(bank_id)
 
     if mode == "章节刷题":
-        sql = "SELECT * FROM questions WHERE 1=1"
-        params = []
-        if chapter != "全部":
-            sql += " AND chapter = ?"
-            params.append(chapter)
-        if q_type_filter != "全部":
-            sql += " AND q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-
-    elif mode == "错题重刷":
-        sql = """
-        SELECT q.* FROM questions q
-        JOIN wrong_log w ON q.id = w.question_id
-        WHERE w.user_id = ?
-        """
-        params = [user_id]
-        if chapter != "全部":
-            sql += " AND q.chapter = ?"
-            params.append(chapter)
-        if q_type_filter != "全部":
-            sql += " AND q.q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-
-    elif mode == "随机刷题":
-        sql = "SELECT * FROM questions WHERE 1=1"
-        params = []
-        if q_type_filter != "全部":
-            sql += " AND q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
-        rows = cur.fetchall()
-
-    else:
-        rows = []
-
-    conn.close()
-
-    # 转为字典列表并按题型排序
-    result = [dict(r) for r in rows]
-    result.sort(key=lambda x: QTYPE_ORDER.index(x["q_type"]) if x["q_type"] in QTYPE_ORDER else 99)
-    random.shuffle(result)  # 先打乱
-    result.sort(key=lambda x: QTYPE_ORDER.index(x["q_type"]) if x["q_type"] in QTYPE_ORDER else 99)  # 再按题型排序
+        return bank.select(chapter, q_type_filter)
+
+    if mode == "随机刷题":
+        return bank.select("全部", q_type_filter)
+
+    if mode == "到期复习":
+        result = {}
+        for qid in get_due_ids(user_id, chapter, q_type_filter, bank_id=bank_id):
+            result.setdefault(bank.type_of(qid), []).append(qid)
+        return {t: result[t] for t in bank.type_order if t in result}
+
+    if mode == "错题重刷":
+        result = {}
+        for qid in get_wrong_ids(user_id):
+            if qid not in bank:
+                continue
+            if chapter != "全部" and bank.chapter_of(qid) != chapter:
+                continue
+            qtype = bank.type_of(qid)
+            if q_type_filter != "全部" and qtype != q_type_filter:
+                continue
+            result.setdefault(qtype, []).append(qid)
+        return {t: result[t] for t in bank.type_order if t in result}
+
+    return {}
+
+
+@timed("data")
+def fetch_questions_for_mode(user_id: str, mode: str, chapter: str = "全部", q_type_filter: str = "全部",
+                             bank_id: int = DEFAULT_BANK_ID):
+    """获取符合条件的所有题目列表（按题型排序，同题型内打乱）"""
+    bank = get_bank(bank_id)
+    result = []
+    for ids in _select_for_mode(user_id, mode, chapter, q_type_filter, bank_id).values():
+        ids = list(ids)
+        random.shuffle(ids)
+        result.extend(bank.get(qid) for qid in ids)
     return result
 
 
-def record_wrong(user_id: str, question_id: int):
-    ts = time.time()
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
+def write_answers(conn, answers, clear_on_correct: bool = False, exam_session_id=None):
+    """批量写入作答记录，答错的题同时记入错题本，并维护按用户的统计表和复习排期。调用方负责事务。
+
+    answers: [(user_id, question_id, is_correct, answer_text, ts), ...]，按作答先后排列。
+    clear_on_correct=True 时按练习的规则，答对即移出错题本；exam_session_id 为这批作答所属的考卷，
+    一批里有多张卷时给和 answers 等长的列表。
+
+    先按 (用户, 题) 合并成一张临时表，统计表、错题本和排期都按这张表整批更新，语句数和批大小无关。
+    """
+    sessions = exam_session_id if isinstance(exam_session_id, (list, tuple)) else repeat(exam_session_id)
+    conn.executemany("""
+        INSERT INTO answer_log (user_id, question_id, is_correct, answer_text, ts, exam_session_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    """, [(u, qid, int(ok), str(text), ts, sid) for (u, qid, ok, text, ts), sid in zip(answers, sessions)])
+
+    # 同一批里同一道题可能先错后对、先对后错，按顺序合并成「答对/答错次数 + 是否先移出 + 之后又错了几次」
+    batch = {}
+    for u, qid, ok, _, ts in answers:
+        b = batch.get((u, qid))
+        if b is None:
+            b = batch[(u, qid)] = [0, 0, False, 0, 0.0]
+        if ok:
+            b[0] += 1
+            if clear_on_correct:
+                b[2:] = [True, 0, 0.0]
+        else:
+            b[1] += 1
+            b[3] += 1
+            b[4] = ts
+    conn.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS answer_batch (
+            user_id TEXT NOT NULL,
+            question_id INTEGER NOT NULL,
+            correct_cnt INTEGER NOT NULL,
+            wrong_cnt INTEGER NOT NULL,
+            cleared INTEGER NOT NULL,        -- 先移出错题本
+            new_wrong INTEGER NOT NULL,      -- 移出之后（或本来）又错了几次
+            last_wrong_ts REAL NOT NULL,
+            PRIMARY KEY (user_id, question_id)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("DELETE FROM temp.answer_batch")
+    # 按主键顺序插，临时表的 B 树只往右边追加
+    conn.executemany("INSERT INTO temp.answer_batch VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     sorted((u, int(qid), *b) for (u, qid), b in batch.items()))
+
+    # 章节统计要和改动前的状态比：第一次做的题记为已刷，错题本里进出的题增减错题数
+    conn.execute("""
+        INSERT INTO user_chapter_stats (user_id, bank_id, chapter, done_cnt, wrong_cnt)
+        SELECT b.user_id, q.bank_id, q.chapter,
+               SUM(s.user_id IS NULL),
+               SUM(((w.user_id IS NOT NULL AND NOT b.cleared) OR b.new_wrong > 0) - (w.user_id IS NOT NULL))
+        FROM temp.answer_batch b
+        JOIN questions q ON q.id = b.question_id
+        LEFT JOIN user_question_stats s ON s.user_id = b.user_id AND s.question_id = b.question_id
+        LEFT JOIN wrong_log w ON w.user_id = b.user_id AND w.question_id = b.question_id
+        GROUP BY b.user_id, q.bank_id, q.chapter
+        ON CONFLICT(user_id, bank_id, chapter) DO UPDATE SET
+            done_cnt = done_cnt + excluded.done_cnt,
+            wrong_cnt = wrong_cnt + excluded.wrong_cnt
+    """)
+    conn.execute("""
+        INSERT INTO user_question_stats (user_id, question_id, correct_cnt, wrong_cnt)
+        SELECT user_id, question_id, correct_cnt, wrong_cnt FROM temp.answer_batch WHERE true
+        ON CONFLICT(user_id, question_id) DO UPDATE SET
+            correct_cnt = correct_cnt + excluded.correct_cnt,
+            wrong_cnt = wrong_cnt + excluded.wrong_cnt
+    """)
+    if clear_on_correct:
+        conn.executemany(
+            "DELETE FROM wrong_log WHERE user_id = ? AND question_id = ?",
+            [key for key, b in batch.items() if b[2]],
+        )
+    conn.execute("""
         INSERT INTO wrong_log (user_id, question_id, wrong_count, last_wrong_ts)
-        VALUES (?, ?, 1, ?)
+        SELECT user_id, question_id, new_wrong, last_wrong_ts FROM temp.answer_batch WHERE new_wrong > 0
         ON CONFLICT(user_id, question_id) DO UPDATE SET
-            wrong_count = wrong_count + 1,
+            wrong_count = wrong_count + excluded.wrong_count,
             last_wrong_ts = excluded.last_wrong_ts
-    """, (user_id, question_id, ts))
-    conn.commit()
-    conn.close()
-
-
-def remove_from_wrong(user_id: str, question_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM wrong_log WHERE user_id = ? AND question_id = ?", (user_id, question_id))
-    conn.commit()
-    conn.close()
-
-
-def log_answer(user_id: str, question_id: int, is_correct: bool, answer_text: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO answer_log (user_id, question_id, is_correct, answer_text, ts)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, question_id, int(is_correct), str(answer_text), time.time()))
-    conn.commit()
-    conn.close()
+    """)
+    _update_review_schedule(conn, answers)
+
+
+def fold_wrong(entry, answers):
+    """按练习的规则把一串作答叠加到错题本的一条记录上。
+
+    entry 为 (错误次数, 最后答错时间)，不在错题本里为 None；answers 为 [(是否答对, 作答时间), ...]。
+    """
+    for ok, ts in answers:
+        entry = None if ok else ((entry[0] if entry else 0) + 1, ts)
+    return entry
+
+
+def review_next(state, is_correct: bool, ts: float):
+    """SM-2 的一步。state 为 (reps, interval_days, ease, lapses)，还没排期的题为 None。
+
+    返回 (新状态, 下次到期时间)；还没排期的题答对了不进复习队列，返回 None。
+    """
+    if state is None:
+        if is_correct:
+            return None
+        state = (0, 0.0, REVIEW_EASE_INIT, 0)
+    reps, interval, ease, lapses = state
+    q = REVIEW_QUALITY_CORRECT if is_correct else REVIEW_QUALITY_WRONG
+    ease = max(REVIEW_EASE_MIN, ease + 0.1 - (5 - q) * (0.08 + (5 - q) * 0.02))
+    if not is_correct:
+        return (0, 0.0, ease, lapses + 1), ts + REVIEW_RELEARN_MINUTES * 60
+    reps += 1
+    interval = REVIEW_FIRST_INTERVALS[reps - 1] if reps <= len(REVIEW_FIRST_INTERVALS) else interval * ease
+    return (reps, interval, ease, lapses), ts + interval * 86400
+
+
+def _update_review_schedule(conn, answers):
+    """按作答顺序推进每道题的复习排期，同一批里同一道题可能出现多次。调用方负责事务。"""
+    steps = dict.fromkeys(((u, qid) for u, qid, _, _, _ in answers), (None, None))
+    # 整批的现有排期一次查出来：write_answers 已经把这批的 (用户, 题) 装进 temp.answer_batch
+    for r in conn.execute("""
+        SELECT r.user_id, r.question_id, r.reps, r.interval_days, r.ease, r.lapses
+        FROM temp.answer_batch b JOIN review_schedule r ON r.user_id = b.user_id AND r.question_id = b.question_id
+    """):
+        steps[(r[0], r[1])] = (tuple(r[2:]), None)
+    for u, qid, ok, _, ts in answers:
+        key = (u, qid)
+        step = review_next(steps[key][0], ok, ts)
+        if step:
+            steps[key] = step
+    conn.executemany("""
+        INSERT INTO review_schedule (user_id, question_id, reps, interval_days, ease, lapses, due_ts)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id, question_id) DO UPDATE SET
+            reps = excluded.reps,
+            interval_days = excluded.interval_days,
+            ease = excluded.ease,
+            lapses = excluded.lapses,
+            due_ts = excluded.due_ts
+    """, [(u, qid, *state, due) for (u, qid), (state, due) in steps.items() if due is not None])
+
+
+@timed("data")
+def get_due_ids(user_id: str, chapter: str = "全部", q_type_filter: str = "全部",
+                limit: int = REVIEW_QUEUE_LIMIT, bank_id: int = DEFAULT_BANK_ID) -> list:
+    """bank_id 题库里现在到期的复习题，最早到期的在前；走 (user_id, due_ts) 索引的范围扫描"""
+    bank = get_bank(bank_id)
+    with get_conn() as conn:
+        rows = conn.execute("""
+            SELECT question_id FROM review_schedule WHERE user_id = ? AND due_ts <= ? ORDER BY due_ts
+        """, (user_id, time.time()))
+        ids = []
+        for (qid,) in rows:
+            if qid not in bank:
+                continue
+            if chapter != "全部" and bank.chapter_of(qid) != chapter:
+                continue
+            if q_type_filter != "全部" and bank.type_of(qid) != q_type_filter:
+                continue
+            ids.append(qid)
+            if len(ids) >= limit:
+                break
+    if WRITE_BEHIND:
+        # 刚答过、还在队列里的题排期还没更新，先不出
+        writer = resource(get_answer_writer, str(DB_PATH))
+        ids = [qid for qid in ids if writer.pending_stats(user_id, qid) == (0, 0)]
+    return ids
+
+
+@timed("data")
+@retry_on_lock
+def submit_practice_answer(user_id: str, question_id: int, is_correct: bool, answer_text: str):
+    """记录一次练习作答：写作答记录，答错记入、答对移出错题本。开启 WRITE_BEHIND 时交给后台写线程。"""
+    answer = (user_id, question_id, is_correct, answer_text, time.time())
+    if WRITE_BEHIND:
+        resource(get_answer_writer, str(DB_PATH)).submit(answer)
+        return
+    with transaction() as conn:
+        write_answers(conn, [answer], clear_on_correct=True)
 
 
+@timed("data")
 def get_question_stats(user_id: str, question_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT
-            SUM(CASE WHEN is_correct = 1 THEN 1 ELSE 0 END) AS correct_cnt,
-            SUM(CASE WHEN is_correct = 0 THEN 1 ELSE 0 END) AS wrong_cnt
-        FROM answer_log
-        WHERE user_id = ? AND question_id = ?
-    """, (user_id, question_id))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return 0, 0
-    return row[0] or 0, row[1] or 0
-
-
-def get_chapter_summary(user_id: str):
-    conn = get_conn()
-    cur = conn.cursor()
-
-    cur.execute("SELECT chapter, COUNT(*) AS total FROM questions GROUP BY chapter ORDER BY chapter")
-    q_total = {r["chapter"]: r["total"] for r in cur.fetchall()}
-
-    cur.execute("""
-        SELECT q.chapter, COUNT(DISTINCT a.question_id) AS done_cnt
-        FROM answer_log a JOIN questions q ON a.question_id = q.id
-        WHERE a.user_id = ? GROUP BY q.chapter
-    """, (user_id,))
-    q_done = {r["chapter"]: r["done_cnt"] for r in cur.fetchall()}
-
-    cur.execute("""
-        SELECT q.chapter, COUNT(*) AS wrong_cnt
-        FROM wrong_log w JOIN questions q ON w.question_id = q.id
-        WHERE w.user_id = ? GROUP BY q.chapter
-    """, (user_id,))
-    q_wrong = {r["chapter"]: r["wrong_cnt"] for r in cur.fetchall()}
-
-    conn.close()
-
+    def read():
+        with get_conn() as conn:
+            row = conn.execute("""
+                SELECT correct_cnt, wrong_cnt FROM user_question_stats
+                WHERE user_id = ? AND question_id = ?
+            """, (user_id, question_id)).fetchone()
+        correct_cnt, wrong_cnt = (row[0], row[1]) if row else (0, 0)
+        if WRITE_BEHIND:
+            pending_correct, pending_wrong = resource(get_answer_writer, str(DB_PATH)).pending_stats(user_id, question_id)
+            correct_cnt += pending_correct
+            wrong_cnt += pending_wrong
+        return correct_cnt, wrong_cnt
+    return read_with_pending(read)
+
+
+@timed("data")
+def get_chapter_summary(user_id: str, bank_id: int = DEFAULT_BANK_ID):
+    bank = get_bank(bank_id)
+
+    def read():
+        with get_conn() as conn:
+            stats = {
+                r["chapter"]: [r["done_cnt"], r["wrong_cnt"]]
+                for r in conn.execute(
+                    "SELECT chapter, done_cnt, wrong_cnt FROM user_chapter_stats WHERE user_id = ? AND bank_id = ?",
+                    (user_id, bank_id),
+                )
+            }
+            pending = {}
+            if WRITE_BEHIND:
+                pending = resource(get_answer_writer, str(DB_PATH)).pending_answers(user_id)
+                pending = {qid: p for qid, p in pending.items() if qid in bank}
+            if pending:
+                # 还没落库的作答：第一次做的题记为已刷，错题本的进出按练习规则叠加
+                known = {r[0]: r[1] for r in conn.execute("""
+                    SELECT s.question_id, EXISTS (
+                        SELECT 1 FROM wrong_log w WHERE w.user_id = s.user_id AND w.question_id = s.question_id
+                    ) FROM user_question_stats s
+                    WHERE s.user_id = ? AND s.question_id IN (SELECT value FROM json_each(?))
+                """, (user_id, json.dumps(list(pending))))}
+                for qid, answers in pending.items():
+                    was_wrong = bool(known.get(qid))
+                    is_wrong = fold_wrong((1, 0.0) if was_wrong else None, answers) is not None
+                    s = stats.setdefault(bank.chapter_of(qid), [0, 0])
+                    s[0] += qid not in known
+                    s[1] += is_wrong - was_wrong
+        return stats
+
+    stats = read_with_pending(read)
     data = []
-    for chap, total in q_total.items():
-        done = q_done.get(chap, 0)
-        wrong = q_wrong.get(chap, 0)
+    for chap in bank.chapters:
+        total = len(bank.by_chapter[chap])
+        done, wrong = stats.get(chap, (0, 0))
         data.append({
             "章节": chap,
             "总题数": total,
@@ -298,113 +1850,1087 @@ def get_chapter_summary(user_id: str):
     return pd.DataFrame(data)
 
 
-def get_wrong_count(user_id: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COUNT(*) FROM wrong_log WHERE user_id = ?", (user_id,))
-    cnt = cur.fetchone()[0]
-    conn.close()
-    return cnt
+def rebuild_user_stats(conn, user_id: str = None):
+    """从 answer_log / wrong_log 重算物化统计表（全部用户或单个用户）。调用方负责事务。"""
+    where, params = ("WHERE user_id = ?", (user_id,)) if user_id else ("", ())
+    conn.execute(f"DELETE FROM user_chapter_stats {where}", params)
+    conn.execute(f"DELETE FROM user_question_stats {where}", params)
+    # 已归档的作答在 answer_log_daily 里；迁移 4 调用本函数时这张表还没建
+    daily = ""
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'answer_log_daily'").fetchone():
+        daily = f"UNION ALL SELECT user_id, question_id, correct_cnt, wrong_cnt FROM answer_log_daily {where}"
+    conn.execute(f"""
+        INSERT INTO user_question_stats (user_id, question_id, correct_cnt, wrong_cnt)
+        SELECT user_id, question_id, SUM(c), SUM(w) FROM (
+            SELECT user_id, question_id, is_correct != 0 AS c, is_correct = 0 AS w FROM answer_log {where}
+            {daily}
+        )
+        GROUP BY user_id, question_id
+    """, params + params if daily else params)
+    # 迁移 11 之前章节统计还不分题库；迁移 15 之前的触发器可能已经累加过，这里直接覆盖
+    bank = "bank_id, " if "bank_id" in {r[1] for r in conn.execute("PRAGMA table_info(user_chapter_stats)")} else ""
+    conn.execute(f"""
+        INSERT INTO user_chapter_stats (user_id, {bank}chapter, done_cnt, wrong_cnt)
+        SELECT user_id, {bank}chapter, SUM(done), SUM(wrong) FROM (
+            SELECT s.user_id, {bank and "q."}{bank}q.chapter, 1 AS done, 0 AS wrong
+            FROM user_question_stats s JOIN questions q ON s.question_id = q.id
+            {where.replace("user_id", "s.user_id")}
+            UNION ALL
+            SELECT w.user_id, {bank and "q."}{bank}q.chapter, 0, 1
+            FROM wrong_log w JOIN questions q ON w.question_id = q.id
+            {where.replace("user_id", "w.user_id")}
+        )
+        GROUP BY user_id, {bank}chapter
+        ON CONFLICT(user_id, {bank}chapter) DO UPDATE SET
+            done_cnt = excluded.done_cnt,
+            wrong_cnt = excluded.wrong_cnt
+    """, params + params)
+
+
+@timed("data")
+@retry_on_lock
+def clear_user_history(user_id: str):
+    """清空一个用户的错题本、答题记录和统计"""
+    if WRITE_BEHIND:
+        resource(get_answer_writer, str(DB_PATH)).flush()  # 免得排队中的作答在清空之后才落库
+    with transaction() as conn:
+        conn.execute("DELETE FROM wrong_log WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM answer_log WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM answer_log_daily WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM review_schedule WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM user_question_stats WHERE user_id = ?", (user_id,))
+        conn.execute("DELETE FROM user_chapter_stats WHERE user_id = ?", (user_id,))
+
+
+@timed("data")
+def get_wrong_count(user_id: str, bank_id: int = DEFAULT_BANK_ID):
+    if WRITE_BEHIND:
+        bank = get_bank(bank_id)
+        return sum(1 for qid in get_wrong_ids(user_id) if qid in bank)
+    # 章节统计里的错题数由 write_answers 随错题本维护，按题库求和只读几行
+    with get_conn() as conn:
+        return conn.execute(
+            "SELECT COALESCE(SUM(wrong_cnt), 0) FROM user_chapter_stats WHERE user_id = ? AND bank_id = ?",
+            (user_id, bank_id),
+        ).fetchone()[0]
+
+
+@timed("data")
+def get_available_count(user_id: str, mode: str, chapter: str, q_type_filter: str, bank_id: int = DEFAULT_BANK_ID):
+    return sum(len(ids) for ids in _select_for_mode(user_id, mode, chapter, q_type_filter, bank_id).values())
+
+
+# ========= 作答记录归档 =========
+def compact_answer_log(days: float = ARCHIVE_AFTER_DAYS, archive_dir: Path = None,
+                       batch_size: int = ARCHIVE_BATCH_SIZE, progress=None) -> dict:
+    """把 days 天以前的原始作答并入 answer_log_daily 后删除；给了 archive_dir 时先追加到 gzip CSV。
+
+    按 id 区间分批，每批一个短事务，不会长时间占住写锁。删除原始作答不动
+    按用户物化的统计表，累计数不变。
+    """
+    days = max(days, EXAM_RECENT_DAYS)  # 组卷避开最近做过的题要查原始记录
+    cutoff = time.time() - days * 86400
+    archive_path = None
+    if archive_dir:
+        archive_dir.mkdir(parents=True, exist_ok=True)
+        archive_path = archive_dir / f"answer_log-{time.strftime('%Y%m%d-%H%M%S')}.csv.gz"
+
+    with get_conn() as conn:
+        lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM answer_log").fetchone()
+    moved = 0
+    if lo is not None:
+        for start in range(lo, hi + 1, batch_size):
+            moved += _compact_batch(start, start + batch_size, cutoff, archive_path)
+            if progress:
+                progress(moved)
+    return {"rows": moved, "cutoff": cutoff, "archive": archive_path if moved else None}
+
+
+@retry_on_lock
+def _compact_batch(lo: int, hi: int, cutoff: float, archive_path: Path) -> int:
+    params = (lo, hi, cutoff)
+    with transaction() as conn:
+        rows = conn.execute("""
+            SELECT id, user_id, question_id, is_correct, answer_text, ts FROM answer_log
+            WHERE id >= ? AND id < ? AND ts < ?
+        """, params).fetchall()
+        if not rows:
+            return 0
+        conn.execute("""
+            INSERT INTO answer_log_daily (user_id, question_id, day, correct_cnt, wrong_cnt, last_ts)
+            SELECT user_id, question_id, CAST(ts / 86400 AS INTEGER), SUM(is_correct != 0), SUM(is_correct = 0), MAX(ts)
+            FROM answer_log
+            WHERE id >= ? AND id < ? AND ts < ?
+            GROUP BY user_id, question_id, CAST(ts / 86400 AS INTEGER)
+            ON CONFLICT(user_id, question_id, day) DO UPDATE SET
+                correct_cnt = correct_cnt + excluded.correct_cnt,
+                wrong_cnt = wrong_cnt + excluded.wrong_cnt,
+                last_ts = MAX(last_ts, excluded.last_ts)
+        """, params)
+        conn.execute("DELETE FROM answer_log WHERE id >= ? AND id < ? AND ts < ?", params)
+        # 合并走的行可能还没被班级分析读到，让它从按天汇总重算
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'compactions'")
+        if archive_path:
+            # 先落盘再提交：提交失败重试时归档里可能多出一批重复行（按 id 去重即可），但不会丢
+            _append_archive(archive_path, rows)
+    return len(rows)
+
+
+def _append_archive(path: Path, rows):
+    # 每批写成一个独立的 gzip 成员，进程中途退出也不会损坏之前已写入的部分
+    new_file = not path.exists()
+    with open(path, "ab") as raw:
+        with gzip.open(raw, "wt", encoding="utf-8", newline="") as f:
+            w = csv.writer(f)
+            if new_file:
+                w.writerow(ARCHIVE_COLUMNS)
+            w.writerows(tuple(r) for r in rows)
+        raw.flush()
+        os.fsync(raw.fileno())
+
+
+def vacuum_free_pages() -> dict:
+    """把空闲页还给文件系统。auto_vacuum 还没打开的老库会先做一次全量 VACUUM 切换过去。"""
+    with get_conn() as conn:
+        def db_bytes():
+            return conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+
+        before = db_bytes()
+        full = conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2
+        if full:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        else:
+            conn.executescript("PRAGMA incremental_vacuum")  # execute() 每步只回收一页，executescript 会跑完
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return {"full": full, "freed_bytes": before - db_bytes()}
+
+
+# ========= 后台写入 =========
+class AnswerWriter:
+    """单个后台写线程：把练习作答攒成批，按时间或条数阈值合并成一个事务写入。
+
+    还没落库的作答按 (用户, 题) 记在 _pending 里，读路径据此叠加，保证用户能马上看到自己的作答。
+    提交事务和移出 _pending 在同一把锁里完成，每落库一批 _commits 加一，读路径用 consistent() 避免重复或漏算。
+    重试用尽的批次写进 WRITE_BEHIND_SPILL_FILE，不丢作答。
+    """
+
+    _STOP = object()
+
+    def __init__(self, spill_file: Path = WRITE_BEHIND_SPILL_FILE):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        # (user_id, question_id) -> [(是否答对, 作答时间), ...]，按作答先后排列
+        self._pending = {}
+        self._commits = 0
+        self.spill_file = spill_file
+        self.spilled = 0   # 本进程写进溢出文件的作答条数
+        self._thread = threading.Thread(target=self._run, name="answer-writer", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+        self._replay_spill()
+
+    def _replay_spill(self):
+        """把上次溢出的作答重新入队；先改名再读，多个进程同时启动时只有一个拿到"""
+        claimed = self.spill_file.with_name(f"{self.spill_file.name}.{os.getpid()}")
+        try:
+            os.replace(self.spill_file, claimed)
+        except FileNotFoundError:
+            return
+        with open(claimed, encoding="utf-8") as f:
+            answers = [tuple(json.loads(line)) for line in f if line.strip()]
+        for answer in answers:
+            self.submit(answer)
+        claimed.unlink()
+        logger.warning("重新提交 %d 条上次写入失败的作答", len(answers))
+
+    def submit(self, answer):
+        user_id, qid, is_correct, _, ts = answer
+        with self._lock:
+            self._pending.setdefault((user_id, qid), []).append((bool(is_correct), ts))
+        self._queue.put(answer)
+
+    def pending_stats(self, user_id: str, question_id: int):
+        with self._lock:
+            p = self._pending.get((user_id, question_id), ())
+            correct = sum(ok for ok, _ in p)
+            return correct, len(p) - correct
+
+    def pending_answers(self, user_id: str) -> dict:
+        """{题号: [(是否答对, 作答时间), ...]}，该用户还没落库的作答"""
+        with self._lock:
+            return {qid: list(p) for (u, qid), p in self._pending.items() if u == user_id}
+
+    def consistent(self, read):
+        """反复调用 read() 直到期间没有批次落库，read 里读库和读 _pending 的结果才能直接叠加"""
+        while True:
+            commits = self._commits
+            result = read()
+            with self._lock:
+                if self._commits == commits:
+                    return result
+
+    def overlay_wrong_ids(self, user_id: str, ids: list) -> list:
+        """在库里的错题 id 上叠加未落库的作答：最后答对的移出，最后答错的加入"""
+        with self._lock:
+            last_ok = {qid: p[-1][0] for (u, qid), p in self._pending.items() if u == user_id}
+        if not last_ok:
+            return ids
+        result = [qid for qid in ids if last_ok.get(qid) is not True]
+        present = set(result)
+        result += [qid for qid, ok in last_ok.items() if not ok and qid not in present]
+        return result
+
+    def flush(self, timeout: float = None) -> bool:
+        """等到此刻之前提交的作答全部落库"""
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout: float = 10.0):
+        if self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch, waiters = [], []
+            item = self._queue.get()
+            deadline = time.time() + WRITE_BEHIND_FLUSH_SECONDS
+            while True:
+                if item is self._STOP:
+                    stopping = True
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                remaining = deadline - time.time()
+                if stopping or len(batch) >= WRITE_BEHIND_BATCH_SIZE or remaining <= 0:
+                    break
+                try:
+                    # flush() 的调用方在等，不再继续攒批
+                    item = self._queue.get(timeout=remaining) if not waiters else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                self._write(batch)
+            for w in waiters:
+                w.set()
+
+    def _write(self, batch):
+        for attempt in range(WRITE_BEHIND_MAX_RETRIES):
+            try:
+                self._commit(batch)
+                return
+            except sqlite3.Error:
+                logger.exception("后台写入失败（第 %d 次），%d 条作答待重试", attempt + 1, len(batch))
+                time.sleep(min(0.2 * 2 ** attempt, 5.0))
+        with open(self.spill_file, "a", encoding="utf-8") as f:
+            f.writelines(json.dumps(answer, ensure_ascii=False) + "\n" for answer in batch)
+        with self._lock:
+            self._forget(batch)
+            self.spilled += len(batch)
+        logger.error("后台写入重试 %d 次仍失败，%d 条作答已存入 %s，写线程下次启动时重新提交",
+                     WRITE_BEHIND_MAX_RETRIES, len(batch), self.spill_file)
+
+    def _commit(self, batch):
+        with get_conn() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                write_answers(conn, batch, clear_on_correct=True)
+                # 提交和移出 _pending 之间不能让读路径插进来，否则这批作答会在库里和队列里各算一次
+                with self._lock:
+                    conn.commit()
+                    self._forget(batch)
+                    self._commits += 1
+            except BaseException:
+                conn.rollback()
+                raise
 
+    def _forget(self, batch):
+        """调用方持有 _lock"""
+        for user_id, qid, _, _, _ in batch:
+            p = self._pending[(user_id, qid)]
+            del p[0]
+            if not p:
+                del self._pending[(user_id, qid)]
 
-def get_available_count(user_id: str, mode: str, chapter: str, q_type_filter: str):
-    conn = get_conn()
-    cur = conn.cursor()
 
-    if mode == "章节刷题":
-        sql = "SELECT COUNT(*) FROM questions WHERE 1=1"
-        params = []
-        if chapter != "全部":
-            sql += " AND chapter = ?"
-            params.append(chapter)
-        if q_type_filter != "全部":
-            sql += " AND q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
+@st.cache_resource(show_spinner=False)
+def get_answer_writer(db_path: str) -> AnswerWriter:
+    return AnswerWriter()
 
-    elif mode == "错题重刷":
-        sql = "SELECT COUNT(*) FROM questions q JOIN wrong_log w ON q.id = w.question_id WHERE w.user_id = ?"
-        params = [user_id]
-        if chapter != "全部":
-            sql += " AND q.chapter = ?"
-            params.append(chapter)
-        if q_type_filter != "全部":
-            sql += " AND q.q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
-
-    elif mode == "随机刷题":
-        sql = "SELECT COUNT(*) FROM questions WHERE 1=1"
-        params = []
-        if q_type_filter != "全部":
-            sql += " AND q_type = ?"
-            params.append(q_type_filter)
-        cur.execute(sql, params)
 
-    else:
-        conn.close()
+# ========= 练习会话 =========
+def _mix64(x: int) -> int:
+    x = (x ^ (x >> 33)) * 0xFF51AFD7ED558CCD & 0xFFFFFFFFFFFFFFFF
+    x = (x ^ (x >> 33)) * 0xC4CEB9FE1A85EC53 & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 33)
+
+
+def permute_index(i: int, n: int, seed: int) -> int:
+    """[0, n) 上由 seed 决定的伪随机排列的第 i 项，O(1) 计算，不需要把整个排列存下来。
+
+    用 PERMUTE_ROUNDS 轮 Feistel 网络在 2^k ≥ n 的区间上做双射，落到 n 之外时继续迭代（cycle walking）。
+    """
+    if n <= 1:
         return 0
+    half = max(((n - 1).bit_length() + 1) // 2, 1)
+    mask = (1 << half) - 1
+    keys = [_mix64((seed << 4) | rnd) for rnd in range(PERMUTE_ROUNDS)]
+    x = i
+    while True:
+        left, right = x >> half, x & mask
+        for key in keys:
+            left, right = right, left ^ (_mix64(right + key) & mask)
+        x = (left << half) | right
+        if x < n:
+            return x
+
+
+@timed("data")
+def new_practice_session(user_id: str, mode: str, chapter: str, q_type_filter: str,
+                         bank_id: int = DEFAULT_BANK_ID) -> dict:
+    """新建一次练习：只记筛选条件、随机种子和游标窗口，题目顺序由种子唯一确定。
+
+    题库模式下会话大小与题库规模无关；错题重刷额外保存一份错题 id 快照，
+    这样答对移出错题本时不会打乱本轮的题号。到期复习同样保存快照，并按到期先后出题、不打乱。
+    """
+    session = {
+        "bank_id": bank_id,
+        "mode": mode,
+        "chapter": chapter,
+        "q_type": q_type_filter,
+        "seed": random.getrandbits(32),
+        "wrong_ids": None,
+        "wrong_sizes": None,
+        "ordered": False,
+        "window": {},
+    }
+    if mode == "到期复习":
+        ids = get_due_ids(user_id, chapter, q_type_filter, bank_id=bank_id)
+        session["wrong_ids"] = array("q", ids)
+        session["wrong_sizes"] = [len(ids)]
+        session["ordered"] = True
+    elif mode == "错题重刷":
+        groups = _select_for_mode(user_id, mode, chapter, q_type_filter, bank_id)
+        session["wrong_ids"] = array("q", (qid for ids in groups.values() for qid in ids))
+        session["wrong_sizes"] = [len(ids) for ids in groups.values()]
+    return session
+
+
+def _practice_groups(session: dict) -> list:
+    """按题型分好组的 id 序列，组间按题型顺序，组内再按种子打乱"""
+    if session["wrong_ids"] is None:
+        return list(get_bank(session["bank_id"]).select(session["chapter"], session["q_type"]).values())
+    groups, start = [], 0
+    for size in session["wrong_sizes"]:
+        groups.append(session["wrong_ids"][start:start + size])
+        start += size
+    return groups
+
+
+def practice_total(session: dict) -> int:
+    return sum(len(ids) for ids in _practice_groups(session))
+
+
+def practice_question_id(session: dict, pos: int) -> int:
+    if session["ordered"]:
+        return session["wrong_ids"][pos]
+    for g, ids in enumerate(_practice_groups(session)):
+        if pos < len(ids):
+            return ids[permute_index(pos, len(ids), session["seed"] + g)]
+        pos -= len(ids)
+    raise IndexError(pos)
+
+
+@timed("data")
+def practice_question(session: dict, pos: int) -> dict:
+    """取第 pos 题；不在预取窗口里时一次装入从 pos 开始的 PRACTICE_PREFETCH 道题"""
+    window = session["window"]
+    if pos not in window:
+        bank = get_bank(session["bank_id"])
+        end = min(pos + PRACTICE_PREFETCH, practice_total(session))
+        window.clear()
+        for p in range(pos, end):
+            qid = practice_question_id(session, p)
+            if qid in bank:
+                window[p] = bank.get(qid)
+    return window.get(pos)
+
+
+# ========= 题目难度标定 =========
+@timed("data")
+def calibrate_items() -> int:
+    """从按用户物化的作答统计重算所有题库的题目难度，整表写进 item_calibration，返回写入的题数。
+
+    每题的答对率向同题库同题型的平均答对率收缩（先加 CALIBRATION_PRIOR_ATTEMPTS 次平均水平的作答），
+    作答少的题不至于被几次作答带偏，没人做过的题就取该题型的平均值。统计在读连接上做，写入只占一个短事务。
+    """
+    with get_conn() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None
+        questions = pd.DataFrame(cur.execute("SELECT id, bank_id, q_type FROM questions").fetchall(),
+                                 columns=["question_id", "bank_id", "q_type"])
+        # user_question_stats 的主键以 user_id 打头，按题号整表聚合一次，比逐题查快得多
+        counts = pd.DataFrame(cur.execute("""
+            SELECT question_id, SUM(correct_cnt + wrong_cnt), SUM(correct_cnt)
+            FROM user_question_stats GROUP BY question_id
+        """).fetchall(), columns=["question_id", "attempts", "correct"])
+    df = questions.merge(counts, on="question_id", how="left").fillna({"attempts": 0, "correct": 0})
+
+    by_type = df.groupby(["bank_id", "q_type"])[["attempts", "correct"]].transform("sum")
+    by_bank = df.groupby("bank_id")[["attempts", "correct"]].transform("sum")
+    prior = (by_type["correct"] / by_type["attempts"]).fillna(by_bank["correct"] / by_bank["attempts"])
+    # 整个题库都没人做过时没法标定，留给组卷按原来的方式随机抽
+    df = df.assign(prior=prior).dropna(subset=["prior"])
+    difficulty = (df["correct"] + CALIBRATION_PRIOR_ATTEMPTS * df["prior"]) / (df["attempts"] + CALIBRATION_PRIOR_ATTEMPTS)
 
-    cnt = cur.fetchone()[0]
-    conn.close()
-    return cnt
+    ts = time.time()
+    rows = list(zip(df["question_id"].tolist(), df["bank_id"].tolist(), df["attempts"].astype(int).tolist(),
+                    df["correct"].astype(int).tolist(), difficulty.round(4).tolist(), [ts] * len(df)))
+    _write_calibration(rows, ts)
+    resource(get_difficulty_cache, str(DB_PATH)).clear()  # 本进程不用等 CALIBRATION_RECHECK_SECONDS
+    return len(rows)
+
+
+@retry_on_lock
+def _write_calibration(rows: list, ts: float):
+    with transaction() as conn:
+        conn.execute("DELETE FROM item_calibration")
+        conn.executemany("""
+            INSERT INTO item_calibration (question_id, bank_id, attempts, correct, difficulty, updated_ts)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+        conn.execute("UPDATE meta SET value = ? WHERE key IN ('calibrated_ts', 'calibration_claim_ts')", (repr(ts),))
+
+
+@retry_on_lock
+def claim_calibration() -> bool:
+    """距上次标定（或别的副本认领）超过 CALIBRATION_REFRESH_SECONDS 时认领这一轮重算，多个副本只有一个拿得到"""
+    now = time.time()
+    with transaction() as conn:
+        cur = conn.execute(
+            "UPDATE meta SET value = ? WHERE key = 'calibration_claim_ts' AND CAST(value AS REAL) <= ?",
+            (repr(now), now - CALIBRATION_REFRESH_SECONDS),
+        )
+        return cur.rowcount == 1
+
+
+class ItemCalibrator:
+    """后台线程：每 CALIBRATION_CHECK_SECONDS 看一眼，标定过期了就认领并重算。
+
+    重算要整表扫一遍作答统计，放在后台做，组卷只读算好的结果。
+    """
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="item-calibrator", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if claim_calibration():
+                    start = time.time()
+                    n = calibrate_items()
+                    logger.info("已标定 %d 道题的难度，用时 %.1fs", n, time.time() - start)
+            except sqlite3.Error:
+                logger.exception("题目难度标定失败")
+            self._stop.wait(CALIBRATION_CHECK_SECONDS)
+
+
+@st.cache_resource(show_spinner=False)
+def get_item_calibrator(db_path: str) -> ItemCalibrator:
+    return ItemCalibrator()
+
+
+class DifficultyIndex:
+    """一个题库的标定难度：按 (章节, 题型) 分组，组内按答对率排好序，换题时二分查找答对率最接近的题"""
+
+    def __init__(self, bank: QuestionBank, difficulty: pd.Series):
+        self.strata = {}       # (章节, 题型) -> (升序的答对率列表, 对应的题号列表)
+        self.type_mean = {}
+        self._p = {}
+        raw = {key: difficulty.reindex(np.asarray(ids)).to_numpy() for key, ids in bank.by_chapter_type.items()}
+        for q_type in bank.by_type:
+            p = np.concatenate([v for key, v in raw.items() if key[1] == q_type])
+            self.type_mean[q_type] = float(np.nanmean(p)) if not np.isnan(p).all() else 0.5
+        for key, ids in bank.by_chapter_type.items():
+            # 标定之后新导入的题还没有数据，先按该题型的平均值算
+            p = np.nan_to_num(raw[key], nan=self.type_mean[key[1]])
+            order = np.argsort(p, kind="stable")
+            ps, ids_sorted = p[order].tolist(), np.asarray(ids)[order].tolist()
+            self.strata[key] = (ps, ids_sorted)
+            self._p.update(zip(ids_sorted, ps))
+
+    def p_of(self, qid: int) -> float:
+        return self._p[qid]
+
+    def tune(self, bank: QuestionBank, paper: list, scores: list, target: float,
+             avoid=frozenset(), rng=random) -> float:
+        """原地换题，让 paper 按分值加权的平均答对率落到 target ± EXAM_DIFFICULTY_TOLERANCE，返回换完后的值。
+
+        每道题只在自己的 (章节, 题型) 里换，题型题数和章节分布都不变。按随机顺序逐道看卷里的题，
+        算出用这一道把缺口补齐需要的答对率，在该组里二分找最接近的、不在卷里的题，能缩小缺口就换；
+        一遍通常就够，最多看 3 遍。每道题的代价是一次二分查找，和题库大小基本无关。
+        """
+        total = float(sum(scores))
+        if not total:
+            return 0.0
+        p = [self._p[qid] for qid in paper]
+        keys = [(bank.chapter_of(qid), bank.type_of(qid)) for qid in paper]
+        expected = sum(s * x for s, x in zip(scores, p))
+        taken = set(paper)
+        tol = EXAM_DIFFICULTY_TOLERANCE * total
+        order = list(range(len(paper)))
+
+        for _ in range(3):
+            swapped = False
+            rng.shuffle(order)
+            for i in order:
+                gap = target * total - expected
+                if abs(gap) <= tol:
+                    return expected / total
+                s = scores[i]
+                if not s:
+                    continue
+                ps, ids = self.strata[keys[i]]
+                j = bisect.bisect_left(ps, p[i] + gap / s)
+                best = None   # (换完后的缺口, 新题号, 新答对率)
+                for side in (range(j - 1, max(j - 1 - EXAM_SWAP_PROBE, -1), -1),
+                             range(j, min(j + EXAM_SWAP_PROBE, len(ids)))):
+                    for k in side:
+                        qid = ids[k]
+                        if qid in taken or qid in avoid:
+                            continue
+                        left = abs(gap - s * (ps[k] - p[i]))
+                        if best is None or left < best[0]:
+                            best = (left, qid, ps[k])
+                        break
+                if best is None or best[0] >= abs(gap):
+                    continue
+                _, qid, new_p = best
+                taken.discard(paper[i])
+                taken.add(qid)
+                expected += s * (new_p - p[i])
+                paper[i], p[i] = qid, new_p
+                swapped = True
+            if not swapped:
+                break
+        return expected / total
+
+
+@st.cache_resource(show_spinner=False)
+def get_difficulty_cache(db_path: str) -> dict:
+    cache = {}   # bank_id -> [DifficultyIndex 或 None, 题库版本号, 上次核对的时间, 标定时间]
+    # 只记版本号、不引用题库本身，题库被淘汰时这里的索引也一起丢掉，不占 BANK_MEMORY_BUDGET_MB 之外的内存
+    get_bank_registry(db_path).on_evict(lambda bank_id: cache.pop(bank_id, None))
+    return cache
+
+
+def get_difficulty_index(bank: QuestionBank):
+    """该题库的 DifficultyIndex；还没标定过时返回 None。题库重新加载或标定更新后重建"""
+    cache = resource(get_difficulty_cache, str(DB_PATH))
+    entry = cache.get(bank.bank_id)
+    now = time.time()
+    if entry is not None and entry[1] == bank.version and now - entry[2] < CALIBRATION_RECHECK_SECONDS:
+        return entry[0]
+    with get_conn() as conn:
+        calibrated_ts = conn.execute("SELECT value FROM meta WHERE key = 'calibrated_ts'").fetchone()[0]
+        if entry is not None and entry[1] == bank.version and entry[3] == calibrated_ts:
+            entry[2] = now
+            return entry[0]
+        cur = conn.cursor()
+        cur.row_factory = None
+        rows = cur.execute("SELECT question_id, difficulty FROM item_calibration WHERE bank_id = ?",
+                           (bank.bank_id,)).fetchall()
+    index = None
+    if rows:
+        arr = np.array(rows, dtype=float)
+        index = DifficultyIndex(bank, pd.Series(arr[:, 1], index=arr[:, 0].astype(np.int64)))
+    cache[bank.bank_id] = [index, bank.version, now, calibrated_ts]
+    return index
 
 
 # ========= 模拟考核 =========
-def build_exam_paper():
-    """按 EXAM_CONFIG 组卷，严格按题型顺序排列"""
-    conn = get_conn()
-    cur = conn.cursor()
-    exam_questions = []
+@timed("data")
+def get_recent_question_ids(user_id: str, days: float) -> set:
+    since = time.time() - days * 86400
+    with get_conn() as conn:
+        return {r[0] for r in conn.execute(
+            "SELECT question_id FROM answer_log WHERE user_id = ? AND ts >= ?", (user_id, since)
+        )}
+
+
+def sample_ids(ids, k: int, avoid=frozenset(), taken=frozenset(), rng=random) -> list:
+    """从 ids 中不放回地随机抽 k 个，跳过 taken，尽量避开 avoid。
+
+    常规情况下按随机下标拒绝采样，代价只和 k 有关；候选被排除得太多时才退化为一次线性过滤。
+    avoid 里的题只在其余题不够时才用来补足。
+    """
+    n = len(ids)
+    chosen, seen = [], set()
+    for _ in range(4 * k + 16):
+        if len(chosen) >= k or len(seen) >= n:
+            break
+        p = rng.randrange(n)
+        if p in seen:
+            continue
+        seen.add(p)
+        qid = ids[p]
+        if qid not in taken and qid not in avoid:
+            chosen.append(qid)
+
+    if len(chosen) < k:
+        picked = set(chosen)
+        fresh = [q for q in ids if q not in picked and q not in taken and q not in avoid]
+        chosen += rng.sample(fresh, min(k - len(chosen), len(fresh)))
+    if len(chosen) < k:
+        picked = set(chosen)
+        stale = [q for q in ids if q not in picked and q not in taken]
+        chosen += rng.sample(stale, min(k - len(chosen), len(stale)))
+    return chosen
+
+
+def allocate_quota(sizes: dict, k: int, rng=random) -> dict:
+    """把 k 个名额按各组大小成比例分下去（最大余数法，余数相同的随机排先后），每组不会超过它的大小"""
+    total = sum(sizes.values())
+    k = min(k, total)
+    if k <= 0:
+        return {}
+    exact = {g: k * n / total for g, n in sizes.items()}
+    quota = {g: int(x) for g, x in exact.items()}
+    by_remainder = sorted(sizes, key=lambda g: (quota[g] - exact[g], rng.random()))
+    for g in by_remainder[:k - sum(quota.values())]:
+        quota[g] += 1
+    return {g: q for g, q in quota.items() if q}
+
+
+@timed("data")
+def build_exam_paper(user_id: str = None, rng=random, bank_id: int = DEFAULT_BANK_ID):
+    """按题库的组卷配置（默认 EXAM_CONFIG）组卷，严格按题型顺序排列。
+
+    每个题型先满足配置里的章节配额，剩余名额按各章题量成比例分配，在每个 (章节, 题型) 里随机抽题，
+    尽量避开该用户最近做过的题；题库标定过难度时，再在同一 (章节, 题型) 里换题，
+    把整卷的期望得分率调到 EXAM_TARGET_DIFFICULTY 附近。只碰需要的题，不物化整个题池。
+    """
+    bank = get_bank(bank_id)
+    recent = get_recent_question_ids(user_id, EXAM_RECENT_DAYS) if user_id and EXAM_RECENT_DAYS else frozenset()
+    paper, scores, spans = [], [], []
 
     for qtype in QTYPE_ORDER:
-        cfg = EXAM_CONFIG.get(qtype)
+        cfg = bank.exam_config.get(qtype)
         if not cfg:
             continue
-        cur.execute("SELECT id, chapter, q_type, text, options, answer FROM questions WHERE q_type = ?", (qtype,))
-        rows = list(cur.fetchall())
-        random.shuffle(rows)
-        need = min(cfg["count"], len(rows))
-        exam_questions.extend([dict(r) for r in rows[:need]])
+        pool = bank.by_type.get(qtype, ())
+        need = min(cfg["count"], len(pool))
+
+        picked = []
+        for chapter, quota in cfg.get("chapters", {}).items():
+            sub = bank.by_chapter_type.get((chapter, qtype), ())
+            picked += sample_ids(sub, min(quota, len(sub), need - len(picked)), avoid=recent, rng=rng)
+        taken = set(picked)
+        used = {}
+        for qid in picked:
+            used[bank.chapter_of(qid)] = used.get(bank.chapter_of(qid), 0) + 1
+        sizes = {ch: len(ids) - used.get(ch, 0) for (ch, t), ids in bank.by_chapter_type.items() if t == qtype}
+        for chapter, k in allocate_quota(sizes, need - len(picked), rng).items():
+            picked += sample_ids(bank.by_chapter_type[(chapter, qtype)], k, avoid=recent, taken=taken, rng=rng)
+
+        spans.append(len(paper))
+        paper += picked
+        scores += [cfg.get("score", 0)] * len(picked)
+
+    index = get_difficulty_index(bank) if paper else None
+    if index is not None:
+        target = EXAM_TARGET_DIFFICULTY
+        if target is None:
+            target = sum(s * index.type_mean[bank.type_of(qid)] for s, qid in zip(scores, paper)) / max(sum(scores), 1)
+        index.tune(bank, paper, scores, target, avoid=recent, rng=rng)
 
-    conn.close()
+    exam_questions = []
+    for lo, hi in zip(spans, spans[1:] + [len(paper)]):
+        part = paper[lo:hi]
+        rng.shuffle(part)  # 按章节抽出的题不要扎堆
+        exam_questions.extend(bank.get(qid) for qid in part)
     return exam_questions  # 已经按题型顺序添加
 
 
-def grade_exam(user_id: str, exam_questions, exam_answers):
-    total_score = 0
-    detail = []
+@timed("data")
+def grade_responses(q_types: list, keys: list, answers: list) -> np.ndarray:
+    """批量判分的核心：第 i 个作答对照第 i 道题的题型和规范答案，返回布尔数组。
 
-    for idx, row in enumerate(exam_questions):
-        qid = row["id"]
-        qtype = row["q_type"]
-        std = row["answer"]
-        user_ans = exam_answers.get(idx)
+    作答逐个规范化后编成整数：选择题就是位掩码，其余答案按本批出现的标准答案编号，
+    对不上任何标准答案的为 -2，没作答为 -1，最后一次数组比较得出对错。可以一次判多份试卷。
+    """
+    vocab = {}
 
-        if qtype == "多选题":
-            is_correct = check_answer(qtype, user_ans or [], std)
-            ans_str = "".join(user_ans or [])
-        else:
-            is_correct = check_answer(qtype, user_ans, std)
-            ans_str = str(user_ans or "")
-
-        log_answer(user_id, qid, is_correct, ans_str)
-        if not is_correct:
-            record_wrong(user_id, qid)
-
-        per_score = EXAM_CONFIG.get(qtype, {}).get("score", 0)
-        gain = per_score if is_correct else 0
-        total_score += gain
-
-        detail.append({
-            "题号": idx + 1,
-            "题型": qtype,
-            "得分": gain,
-            "应得分": per_score,
-            "是否正确": "√" if is_correct else "×",
-        })
+    def code(key):
+        if isinstance(key, int):
+            return key
+        return vocab.setdefault(key, -3 - len(vocab))
+
+    key_codes = np.fromiter((code(k) for k in keys), dtype=np.int64, count=len(keys))
+    # 答卷里的作答高度重复（A/B/对/错…），同一 (题型, 作答) 只规范化一次
+    seen = {}
+    answer_codes = []
+    for q_type, ans in zip(q_types, answers):
+        memo = (q_type, tuple(ans) if isinstance(ans, list) else ans)
+        c = seen.get(memo)
+        if c is None:
+            k = canonical_answer(q_type, ans)
+            c = seen[memo] = -1 if k is None else k if isinstance(k, int) else vocab.get(k, -2)
+        answer_codes.append(c)
+    return np.array(answer_codes, dtype=np.int64) == key_codes
+
+
+def grade_answer_sheets(question_ids: list, sheets: list, bank_id: int = DEFAULT_BANK_ID) -> np.ndarray:
+    """同一张试卷的多份答卷：sheets 每份按题号顺序给出原始作答，返回 (答卷数 × 题数) 的布尔矩阵"""
+    bank = get_bank(bank_id)
+    q_types = [bank.type_of(qid) for qid in question_ids]
+    keys = [bank.key_of(qid) for qid in question_ids]
+    n = len(question_ids)
+    flat = [sheet[j] if j < len(sheet) else None for sheet in sheets for j in range(n)]
+    return grade_responses(q_types * len(sheets), keys * len(sheets), flat).reshape(len(sheets), n)
+
+
+def exam_score_vector(q_types: list, exam_config: dict = None) -> np.ndarray:
+    cfg = exam_config or EXAM_CONFIG
+    return np.array([cfg.get(t, {}).get("score", 0) for t in q_types], dtype=np.int64)
+
+
+@timed("data")
+def grade_exam(user_id: str, exam_questions, exam_answers, session_id: int = None):
+    """判分并在一个事务里写入整张试卷，要么全部落库要么全部不落库。
 
-    return total_score, pd.DataFrame(detail)
+    给了 session_id 时在同一个事务里把考试会话标记为已交卷，同一张卷只会落库一次。
+    """
+    ts = time.time()
+    q_types = [row["q_type"] for row in exam_questions]
+    # 会话里可能还留着升级前组的卷，没有 answer_key 就现算
+    keys = [row["answer_key"] if "answer_key" in row else canonical_answer(row["q_type"], row["answer"])
+            for row in exam_questions]
+    raw = [exam_answers.get(idx) for idx in range(len(exam_questions))]
+    correct = grade_responses(q_types, keys, raw)
+
+    answers = [
+        (user_id, row["id"], ok, exam_answer_text(row["q_type"], ans), ts)
+        for row, ans, ok in zip(exam_questions, raw, correct.tolist())
+    ]
+    bank_id = exam_questions[0].get("bank_id", DEFAULT_BANK_ID) if exam_questions else DEFAULT_BANK_ID
+    per_score = exam_score_vector(q_types, get_bank(bank_id).exam_config)
+    gains = np.where(correct, per_score, 0)
+    if not _write_exam_answers(answers, session_id, int(gains.sum())):
+        logger.warning("考试会话 %s 已在别处交卷，本次作答不再重复落库", session_id)
+    return int(gains.sum()), _exam_detail(q_types, correct, per_score)
+
+
+def _exam_detail(q_types: list, correct: np.ndarray, per_score: np.ndarray) -> pd.DataFrame:
+    return pd.DataFrame({
+        "题号": np.arange(1, len(q_types) + 1),
+        "题型": q_types,
+        "得分": np.where(correct, per_score, 0),
+        "应得分": per_score,
+        "是否正确": np.where(correct, "√", "×"),
+    })
+
+
+@timed("data")
+def load_exam_result(session_id: int, exam_questions):
+    """库里记下的这张卷的 (总分, 明细)，明细同 grade_exam；卷没交上（被作废）时返回 None"""
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT user_id, status, total_score FROM exam_session WHERE id = ?", (session_id,)
+        ).fetchone()
+        if row is None or row["status"] != "finished":
+            return None
+        # answer_log 上没有 exam_session_id 的索引，按 (用户, 题) 走 idx_answer_log_user_question 再过滤
+        ok = dict(conn.execute("""
+            SELECT question_id, is_correct != 0 FROM answer_log
+            WHERE user_id = ? AND question_id IN (SELECT value FROM json_each(?)) AND exam_session_id = ?
+        """, (row["user_id"], json.dumps([q["id"] for q in exam_questions]), session_id)).fetchall())
+    q_types = [q["q_type"] for q in exam_questions]
+    correct = np.array([bool(ok.get(q["id"])) for q in exam_questions], dtype=bool)
+    bank_id = exam_questions[0].get("bank_id", DEFAULT_BANK_ID) if exam_questions else DEFAULT_BANK_ID
+    per_score = exam_score_vector(q_types, get_bank(bank_id).exam_config)
+    return row["total_score"], _exam_detail(q_types, correct, per_score)
+
+
+@retry_on_lock
+def _write_exam_answers(answers, session_id: int = None, total_score: int = None) -> bool:
+    with transaction() as conn:
+        if session_id is not None and not _claim_exam_session(conn, session_id, total_score, time.time()):
+            return False
+        write_answers(conn, answers, exam_session_id=session_id)
+    return True
+
+
+def _claim_exam_session(conn, session_id: int, total_score: int, ts: float) -> bool:
+    """把进行中的卷标为已交；已经交过或作废时返回 False。学生交卷和后台代交靠这一步互斥。"""
+    claimed = conn.execute(
+        "UPDATE exam_session SET status = 'finished', finished_ts = ?, total_score = ? "
+        "WHERE id = ? AND status = 'active'",
+        (ts, total_score, session_id),
+    ).rowcount
+    if claimed:
+        # 交卷后逐题作答已经进了 answer_log，会话里的草稿没用了
+        conn.execute("DELETE FROM exam_session_answer WHERE session_id = ?", (session_id,))
+    return bool(claimed)
+
+
+# ========= 考试会话 =========
+def exam_answer_text(q_type: str, ans) -> str:
+    """作答的存储形式：多选题是字母拼接，其余原样"""
+    return "".join(ans or []) if q_type == "多选题" else str(ans or "")
+
+
+@retry_on_lock
+def create_exam_session(user_id: str, exam_questions, start_ts: float, bank_id: int = DEFAULT_BANK_ID) -> int:
+    """落库一张新卷；该用户在这个题库之前没交的卷作废"""
+    ids = array("q", (row["id"] for row in exam_questions))
+    with transaction() as conn:
+        conn.execute(
+            "UPDATE exam_session SET status = 'abandoned' WHERE user_id = ? AND bank_id = ? AND status = 'active'",
+            (user_id, bank_id),
+        )
+        return conn.execute(
+            "INSERT INTO exam_session (user_id, bank_id, question_ids, start_ts) VALUES (?, ?, ?, ?)",
+            (user_id, bank_id, ids.tobytes(), start_ts),
+        ).lastrowid
+
+
+def _paper_ids(blob: bytes) -> array:
+    ids = array("q")
+    ids.frombytes(blob)
+    return ids
+
+
+@timed("data")
+def load_exam_session(user_id: str, bank_id: int = DEFAULT_BANK_ID):
+    """取该用户在这个题库进行中的卷，没有时返回 None。卷里的题已不在题库（被删或被去重合并）时作废这张卷。"""
+    with get_conn() as conn:
+        row = conn.execute(
+            "SELECT id, question_ids, start_ts FROM exam_session WHERE user_id = ? AND bank_id = ? AND status = 'active'",
+            (user_id, bank_id),
+        ).fetchone()
+        if row is None:
+            return None
+        session_id, blob, start_ts = row
+        drafts = conn.execute(
+            "SELECT pos, answer, marked FROM exam_session_answer WHERE session_id = ?", (session_id,)
+        ).fetchall()
+
+    ids = _paper_ids(blob)
+    bank = get_bank(bank_id)
+    if not all(qid in bank for qid in ids):
+        abandon_exam_session(session_id)
+        return None
+
+    questions = [bank.get(qid) for qid in ids]
+    answers, marked = {}, set()
+    for pos, text, is_marked in drafts:
+        if pos >= len(questions):
+            continue
+        if text:
+            answers[pos] = list(text) if questions[pos]["q_type"] == "多选题" else text
+        if is_marked:
+            marked.add(pos)
+    return {"id": session_id, "questions": questions, "answers": answers, "marked": marked, "start_ts": start_ts}
+
+
+@retry_on_lock
+def abandon_exam_session(session_id: int):
+    with transaction() as conn:
+        _abandon_exam_session(conn, session_id)
+
+
+def _abandon_exam_session(conn, session_id: int):
+    conn.execute("UPDATE exam_session SET status = 'abandoned' WHERE id = ? AND status = 'active'", (session_id,))
+    conn.execute("DELETE FROM exam_session_answer WHERE session_id = ?", (session_id,))
+
+
+@retry_on_lock
+def save_exam_answer(session_id: int, pos: int, answer_text: str) -> bool:
+    """每次改答案都会调用：一条主键 upsert。卷已经交了（例如到点被后台代交）时不写，返回 False"""
+    with transaction() as conn:
+        return conn.execute("""
+            INSERT INTO exam_session_answer (session_id, pos, answer)
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM exam_session WHERE id = ? AND status = 'active')
+            ON CONFLICT (session_id, pos) DO UPDATE SET answer = excluded.answer
+        """, (session_id, pos, answer_text, session_id)).rowcount > 0
+
+
+@retry_on_lock
+def save_exam_mark(session_id: int, pos: int, marked: bool):
+    with transaction() as conn:
+        conn.execute("""
+            INSERT INTO exam_session_answer (session_id, pos, marked)
+            SELECT ?, ?, ? WHERE EXISTS (SELECT 1 FROM exam_session WHERE id = ? AND status = 'active')
+            ON CONFLICT (session_id, pos) DO UPDATE SET marked = excluded.marked
+        """, (session_id, pos, int(marked), session_id))
+
+
+# ========= 考试截止 =========
+@timed("data")
+@retry_on_lock
+def expire_exam_sessions(session_ids) -> int:
+    """按当前草稿给这些卷判分并交卷，返回实际代交的张数；已交或已作废的卷跳过。
+
+    所有卷的题拼成一个序列，一次 grade_responses 判完，再在一个事务里逐张认领、写入作答。
+    作答时间记为截止时间。
+    """
+    session_ids = list(session_ids)
+    if not session_ids:
+        return 0
+    marks = ",".join("?" * len(session_ids))
+    with get_conn() as conn:
+        sessions = conn.execute(
+            f"SELECT id, user_id, bank_id, question_ids, start_ts FROM exam_session "
+            f"WHERE status = 'active' AND id IN ({marks})",
+            session_ids,
+        ).fetchall()
+        drafts = {}
+        for sid, pos, text in conn.execute(
+                f"SELECT session_id, pos, answer FROM exam_session_answer WHERE session_id IN ({marks}) AND answer <> ''",
+                session_ids):
+            drafts.setdefault(sid, {})[pos] = text
+    if not sessions:
+        return 0
+
+    papers, stale = [], []
+    q_types, keys, raw, scores = [], [], [], []
+    for sid, user_id, bank_id, blob, start_ts in sessions:
+        bank = get_bank(bank_id)
+        ids = _paper_ids(blob)
+        if not all(qid in bank for qid in ids):
+            stale.append(sid)
+            continue
+        papers.append((sid, user_id, ids, start_ts + EXAM_DURATION_SECONDS, len(q_types)))
+        answered = drafts.get(sid, {})
+        types = [bank.type_of(qid) for qid in ids]
+        q_types += types
+        keys += [bank.key_of(qid) for qid in ids]
+        raw += [answered.get(pos) for pos in range(len(ids))]
+        scores.append(exam_score_vector(types, bank.exam_config))
+
+    correct = grade_responses(q_types, keys, raw).tolist()
+    gains = np.where(correct, np.concatenate(scores), 0).tolist() if scores else []
+
+    expired = 0
+    with transaction() as conn:
+        for sid in stale:
+            _abandon_exam_session(conn, sid)
+        for sid, user_id, ids, deadline, start in papers:
+            end = start + len(ids)
+            if not _claim_exam_session(conn, sid, sum(gains[start:end]), deadline):
+                continue
+            answers = [(user_id, qid, ok, text or "", deadline)
+                       for qid, ok, text in zip(ids, correct[start:end], raw[start:end])]
+            write_answers(conn, answers, exam_session_id=sid)
+            expired += 1
+    return expired
+
+
+class ExamSweeper:
+    """后台线程：进行中的卷按截止时间放进小顶堆，线程只睡到堆顶的截止时间，醒来批量代交到期的卷。
+
+    开着几百张卷时，每次醒来也只碰已经到期的那几张，入堆出堆都是 O(log n)。
+    本进程开的卷由 schedule() 直接入堆；别的副本开的卷、重启前留下的卷，
+    靠定期按 id 高水位从库里增量捞出来。多个副本同时代交同一张卷时由 _claim_exam_session 保证只落库一次。
+    """
+
+    def __init__(self):
+        self._heap = []           # (代交时间, 会话 id)
+        self._queued = set()
+        self._seen_id = 0
+        self._stopping = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="exam-sweeper", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def schedule(self, session_id: int, start_ts: float):
+        with self._cond:
+            self._push(session_id, start_ts)
+            self._cond.notify()
+
+    def pending(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+    def close(self, timeout: float = 10.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _push(self, session_id: int, start_ts: float):
+        if session_id not in self._queued:
+            self._queued.add(session_id)
+            heapq.heappush(self._heap, (start_ts + EXAM_DURATION_SECONDS + EXAM_SWEEP_GRACE_SECONDS, session_id))
+
+    def _resync(self):
+        with get_conn() as conn:
+            rows = conn.execute(
+                "SELECT id, start_ts FROM exam_session WHERE id > ? AND status = 'active' ORDER BY id",
+                (self._seen_id,),
+            ).fetchall()
+        with self._cond:
+            for session_id, start_ts in rows:
+                self._push(session_id, start_ts)
+            if rows:
+                self._seen_id = max(self._seen_id, rows[-1][0])
+
+    def _run(self):
+        next_resync = 0.0
+        while True:
+            now = time.time()
+            if now >= next_resync:
+                try:
+                    self._resync()
+                except sqlite3.Error:
+                    logger.exception("读取进行中的考试会话失败")
+                next_resync = now + EXAM_SWEEP_RESYNC_SECONDS
+
+            with self._cond:
+                if self._stopping:
+                    return
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < EXAM_SWEEP_BATCH:
+                    _, session_id = heapq.heappop(self._heap)
+                    self._queued.discard(session_id)
+                    due.append(session_id)
+                if not due:
+                    wake = min(next_resync, self._heap[0][0]) if self._heap else next_resync
+                    self._cond.wait(max(wake - now, 0.0))
+                    continue
+
+            try:
+                n = expire_exam_sessions(due)
+            except sqlite3.Error:
+                logger.exception("代交 %d 张过期试卷失败，稍后重试", len(due))
+                # 按开考时间倒推，让这批卷 WRITE_RETRY_MAX_SECONDS 之后再到期一次
+                retry_start = time.time() + WRITE_RETRY_MAX_SECONDS - EXAM_DURATION_SECONDS - EXAM_SWEEP_GRACE_SECONDS
+                with self._cond:
+                    for session_id in due:
+                        self._push(session_id, retry_start)
+                continue
+            if n:
+                logger.info("已代交 %d 张过期试卷", n)
+
+
+@st.cache_resource(show_spinner=False)
+def get_exam_sweeper(db_path: str) -> ExamSweeper:
+    return ExamSweeper()
 
 
 # ========= SessionState =========
@@ -412,7 +2938,7 @@ def init_session():
     ss = st.session_state
     defaults = {
         "mode": "章节刷题",
-        "q_list": [],
+        "practice": None,
         "q_index": 0,
         "show_answer": False,
         "judge_result": None,
@@ -425,6 +2951,10 @@ def init_session():
         "exam_finished": False,
         "exam_result": None,
         "exam_marked": set(),
+        "exam_session_id": None,
+        "exam_notice": None,
+        "exam_user": None,
+        "bank_id": DEFAULT_BANK_ID,
     }
     for k, v in defaults.items():
         if k not in ss:
@@ -434,9 +2964,24 @@ def init_session():
 # ========= 主界面 =========
 def main():
     st.set_page_config(page_title="川的刷题小玩意儿", page_icon="🧠", layout="wide")
+    metrics = resource(get_metrics)
+    metrics.begin_rerun()
+    # 点按钮后的 st.rerun() 和异常都会从中途跳出，这些最慢的 rerun 也要记上
+    try:
+        is_admin = render_app()
+    finally:
+        rerun = metrics.end_rerun()
+        metrics.maybe_export(METRICS_FILE)
+    if is_admin:
+        render_perf_panel(metrics, rerun)
+
+
+def render_app() -> bool:
+    """整页界面；返回当前用户是否管理员"""
     init_session()
-    init_db()
-    import_csv_if_empty()
+    ensure_db_ready()
+    resource(get_exam_sweeper, str(DB_PATH))  # 进程里第一次 rerun 时启动，接管库里所有进行中的卷
+    resource(get_item_calibrator, str(DB_PATH))
     ss = st.session_state
 
     # 全局样式
@@ -512,40 +3057,52 @@ def main():
         .nav-btn.current { background: #ff5252; }
         .nav-btn.marked { border: 2px solid #ffb74d; }
         .nav-btn.answered { background: #2e7d32; }
+        mark { background: #ffb74d; color: #000; padding: 0 2px; border-radius: 2px; }
         </style>
     """, unsafe_allow_html=True)
 
     st.markdown('<div class="main-title">川的刷题小玩意儿</div>', unsafe_allow_html=True)
-    st.markdown('<div class="sub-title">章节刷题 · 错题重刷 · 随机刷题 · 模拟考核</div>', unsafe_allow_html=True)
+    st.markdown('<div class="sub-title">章节刷题 · 错题重刷 · 到期复习 · 随机刷题 · 模拟考核</div>', unsafe_allow_html=True)
 
     # 侧边栏
     with st.sidebar:
         st.header("基本设置")
         user_id = st.text_input("用户名", value="student01").strip() or "student01"
 
-        mode = st.selectbox("刷题模式", ["章节刷题", "错题重刷", "随机刷题", "模拟考核"],
-                           index=["章节刷题", "错题重刷", "随机刷题", "模拟考核"].index(ss.mode))
+        banks = dict(list_banks())
+        bank_id = DEFAULT_BANK_ID
+        if len(banks) > 1:
+            # 用 key 固定控件身份；按 index 回填的话每次切换题库控件都会换一个，下一次选择会丢
+            bank_id = st.selectbox("题库", list(banks), format_func=banks.get, key="bank_select")
+        if bank_id != ss.bank_id:
+            ss.bank_id = bank_id
+            ss.practice = None  # 练习会话和考卷都跟着题库走
+            ss.q_index = 0
+        ensure_bank_ready(bank_id)
+
+        mode = st.selectbox("刷题模式", PRACTICE_MODES, index=PRACTICE_MODES.index(ss.mode))
         if mode != ss.mode:
             ss.mode = mode
-            ss.q_list = []
+            ss.practice = None
             ss.q_index = 0
             ss.show_answer = False
             ss.judge_result = None
             ss.practice_start_ts = None
 
-        chapters = get_all_chapters()
+        chapters = get_all_chapters(bank_id)
         chapter = "全部"
-        if mode in ["章节刷题", "错题重刷"]:
+        if mode in ["章节刷题", "错题重刷", "到期复习"]:
             chapter = st.selectbox("按章节", ["全部"] + chapters, index=0)
 
         q_type_filter = "全部"
-        if mode in ["章节刷题", "错题重刷", "随机刷题"]:
+        if mode in ["章节刷题", "错题重刷", "到期复习", "随机刷题"]:
             q_type_filter = st.selectbox("题型筛选", ["全部"] + QTYPE_ORDER, index=0)
 
         st.markdown("---")
         st.subheader("统计信息")
-        total_cnt = get_available_count(user_id, mode, chapter, q_type_filter)
-        wrong_cnt = get_wrong_count(user_id)
+        with timed_section("sidebar_stats"):
+            total_cnt = get_available_count(user_id, mode, chapter, q_type_filter, bank_id)
+            wrong_cnt = get_wrong_count(user_id, bank_id)
         st.write(f"当前模式可选题数：**{total_cnt}**")
         st.write(f"当前用户错题数：**{wrong_cnt}**")
 
@@ -560,12 +3117,7 @@ def main():
             col1, col2 = st.columns(2)
             with col1:
                 if st.button("确定清空"):
-                    conn = get_conn()
-                    cur = conn.cursor()
-                    cur.execute("DELETE FROM wrong_log WHERE user_id = ?", (user_id,))
-                    cur.execute("DELETE FROM answer_log WHERE user_id = ?", (user_id,))
-                    conn.commit()
-                    conn.close()
+                    clear_user_history(user_id)
                     ss.confirm_clear = False
                     st.success("已清空")
                     st.rerun()
@@ -574,44 +3126,84 @@ def main():
                     ss.confirm_clear = False
                     st.rerun()
 
-    tab_quiz, tab_wrong, tab_sum = st.tabs(["刷题 / 考核", "错题汇总", "题目汇总"])
+    is_admin = user_id in ADMIN_USERS
+    tabs = st.tabs(["刷题 / 考核", "错题汇总", "题目汇总", "题目搜索"] + (["班级分析"] if is_admin else []))
+    tab_quiz, tab_wrong, tab_sum, tab_search = tabs[:4]
 
     with tab_quiz:
         if mode == "模拟考核":
-            render_exam_tab(user_id)
+            render_exam_tab(user_id, bank_id)
         else:
-            render_practice_tab(user_id, mode, chapter, q_type_filter)
+            render_practice_tab(user_id, mode, chapter, q_type_filter, bank_id)
 
     with tab_wrong:
-        render_wrong_summary(user_id)
+        render_wrong_summary(user_id, bank_id)
 
-    with tab_sum:
-        df = get_chapter_summary(user_id)
+    with tab_sum, timed_section("chapter_summary_tab"):
+        df = get_chapter_summary(user_id, bank_id)
         st.dataframe(df, use_container_width=True)
 
+    with tab_search:
+        render_search_tab(user_id, bank_id)
+
+    if is_admin:
+        with tabs[4]:
+            render_cohort_tab(bank_id)
+    return is_admin
+
+
+def render_perf_panel(metrics: Metrics, rerun: dict):
+    """管理员调试面板：本次 rerun 的明细和进程内滚动分位数"""
+    with st.sidebar.expander("⏱ 性能面板", expanded=False):
+        st.write(f"本次 rerun：**{rerun['total_ms']:.1f} ms**，SQL **{rerun['queries']}** 条")
+        calls = [
+            {"类别": kind, "名称": name, "次数": n, "耗时(ms)": round(ms, 2)}
+            for (kind, name), (n, ms) in sorted(rerun["calls"].items(), key=lambda kv: -kv[1][1])
+        ]
+        st.dataframe(pd.DataFrame(calls), use_container_width=True, hide_index=True)
+        st.caption("进程内最近样本（ms，queries 为条数）")
+        rows = [
+            {"类别": r["kind"], "名称": r["name"], "次数": r["count"],
+             "p50": round(r["p50"], 2), "p95": round(r["p95"], 2), "p99": round(r["p99"], 2)}
+            for r in metrics.snapshot()
+        ]
+        st.dataframe(pd.DataFrame(rows), use_container_width=True, hide_index=True)
+        loaded = resource(get_bank_registry, str(DB_PATH)).loaded()
+        st.caption("已加载题库（估算 MB）：" + "，".join(f"#{bid} {n / 1048576:.1f}" for bid, n in loaded.items()))
+        if WRITE_BEHIND:
+            writer = resource(get_answer_writer, str(DB_PATH))
+            if writer.spilled:
+                st.warning(f"后台写入失败，{writer.spilled} 条作答已存入 {writer.spill_file}，重启后重新提交")
+
 
 # ========= 练习 =========
-def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: str):
+@timed("render")
+def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: str, bank_id: int):
     ss = st.session_state
 
     # 初始化或刷新题目列表
     col_refresh, col_time = st.columns([1, 3])
     with col_refresh:
         if st.button("🔄 刷新题目列表"):
-            ss.q_list = fetch_questions_for_mode(user_id, mode, chapter, q_type_filter)
+            ss.practice = new_practice_session(user_id, mode, chapter, q_type_filter, bank_id)
             ss.q_index = 0
             ss.show_answer = False
             ss.judge_result = None
             ss.practice_start_ts = time.time()
             st.rerun()
 
-    if not ss.q_list:
-        ss.q_list = fetch_questions_for_mode(user_id, mode, chapter, q_type_filter)
+    if ss.practice is None:
+        ss.practice = new_practice_session(user_id, mode, chapter, q_type_filter, bank_id)
         if ss.practice_start_ts is None:
             ss.practice_start_ts = time.time()
 
-    if not ss.q_list:
-        st.info("当前条件下没有可用题目，请调整筛选条件后点击刷新。")
+    total = practice_total(ss.practice)
+    if total == 0:
+        ss.practice = None  # 下次 rerun 重新按当前条件取题（例如刚做错了第一道题）
+        if mode == "到期复习":
+            st.info(f"现在没有到期的复习题。答错的题 {REVIEW_RELEARN_MINUTES} 分钟后会进入复习队列。")
+        else:
+            st.info("当前条件下没有可用题目，请调整筛选条件后点击刷新。")
         return
 
     with col_time:
@@ -620,34 +3212,39 @@ def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: st
             st.markdown(f"**练习用时：{format_hms(elapsed)}**")
 
     # 当前题目
-    if ss.q_index >= len(ss.q_list):
-        ss.q_index = len(ss.q_list) - 1
+    if ss.q_index >= total:
+        ss.q_index = total - 1
     if ss.q_index < 0:
         ss.q_index = 0
 
-    current = ss.q_list[ss.q_index]
+    current = practice_question(ss.practice, ss.q_index)
+    if current is None:
+        # 题库重新导入过，这道题已不存在
+        ss.practice = None
+        st.info("题库已更新，请点击刷新题目列表。")
+        return
     qid = current["id"]
     qtype = current["q_type"]
-    options = (current["options"] or "").split("||") if current["options"] else []
+    view = question_view(current)
+    options = view["options"]
 
     st.markdown("---")
     st.markdown(f'<div class="question-card">', unsafe_allow_html=True)
-    st.markdown(f'<span class="tag">{escape_html(current["chapter"])}</span><span class="tag">{escape_html(qtype)}</span>', unsafe_allow_html=True)
-    st.markdown(f"**第 {ss.q_index + 1} / {len(ss.q_list)} 题：** {escape_html(current['text'])}")
+    st.markdown(view["tags_html"], unsafe_allow_html=True)
+    st.markdown(f"**第 {ss.q_index + 1} / {total} 题：** {view['stem_html']}")
 
     # 根据题型渲染
     user_ans = None
     if qtype == "单选题":
         user_ans = st.radio("请选择一个答案：", options, index=None, key=f"prac_single_{qid}")
         if user_ans:
-            user_ans = user_ans[0] if user_ans and user_ans[0].isalpha() else user_ans
+            user_ans = view["letter_of"][user_ans]
 
     elif qtype == "多选题":
         st.write("请选择一个或多个答案：")
         selected = []
-        for i, opt in enumerate(options):
+        for i, (opt, letter) in enumerate(zip(options, view["letters"])):
             if st.checkbox(opt, key=f"prac_multi_{qid}_{i}"):
-                letter = opt[0] if opt and opt[0].isalpha() else str(i)
                 selected.append(letter)
         user_ans = selected
 
@@ -661,14 +3258,9 @@ def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: st
     col1, col2, col3 = st.columns(3)
     with col1:
         if st.button("提交 / 检查答案"):
-            std = current["answer"]
-            is_correct = check_answer(qtype, user_ans, std)
+            is_correct = answer_matches(qtype, user_ans, current["answer_key"])
             ans_str = "".join(user_ans) if isinstance(user_ans, list) else str(user_ans or "")
-            log_answer(user_id, qid, is_correct, ans_str)
-            if is_correct:
-                remove_from_wrong(user_id, qid)
-            else:
-                record_wrong(user_id, qid)
+            submit_practice_answer(user_id, qid, is_correct, ans_str)
             ss.show_answer = True
             ss.judge_result = is_correct
             st.rerun()
@@ -681,7 +3273,7 @@ def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: st
             st.rerun()
 
     with col3:
-        if st.button("下一题") and ss.q_index < len(ss.q_list) - 1:
+        if st.button("下一题") and ss.q_index < total - 1:
             ss.q_index += 1
             ss.show_answer = False
             ss.judge_result = None
@@ -701,27 +3293,62 @@ def render_practice_tab(user_id: str, mode: str, chapter: str, q_type_filter: st
 
 
 # ========= 模拟考核 =========
-def render_exam_tab(user_id: str):
+def _reset_exam_state():
+    ss = st.session_state
+    ss.exam_questions = []
+    ss.exam_answers = {}
+    ss.exam_index = 0
+    ss.exam_start_ts = None
+    ss.exam_finished = False
+    ss.exam_result = None
+    ss.exam_marked = set()
+    ss.exam_session_id = None
+    ss.exam_notice = None
+
+
+def restore_exam_session(user_id: str, bank_id: int):
+    """刷新页面、断线重连或换了副本后，从库里接着上一张没交的卷"""
+    ss = st.session_state
+    if ss.exam_user != (user_id, bank_id):
+        _reset_exam_state()
+        ss.exam_user = (user_id, bank_id)
+    if ss.exam_questions or ss.exam_finished:
+        return
+    session = load_exam_session(user_id, bank_id)
+    if session is None:
+        return
+    ss.exam_questions = session["questions"]
+    ss.exam_answers = session["answers"]
+    ss.exam_marked = session["marked"]
+    ss.exam_start_ts = session["start_ts"]
+    ss.exam_session_id = session["id"]
+    ss.exam_index = 0
+
+
+@timed("render")
+def render_exam_tab(user_id: str, bank_id: int):
     ss = st.session_state
+    restore_exam_session(user_id, bank_id)
+    if ss.exam_notice:
+        st.warning(ss.exam_notice)
 
     # 未开始
     if not ss.exam_questions and not ss.exam_finished:
         st.subheader("模拟考核说明")
+        exam_config = get_bank(bank_id).exam_config
         for qt in QTYPE_ORDER:
-            cfg = EXAM_CONFIG.get(qt)
+            cfg = exam_config.get(qt)
             if cfg:
                 st.markdown(f"- {qt}：{cfg['count']} 题，每题 {cfg['score']} 分")
-        st.markdown("- 总时长：60 分钟，超时自动交卷")
+        st.markdown(f"- 总时长：{EXAM_DURATION_SECONDS // 60} 分钟，超时自动交卷")
         st.markdown("- 题目按 **单选→多选→判断→填空** 顺序排列")
 
         if st.button("开始模拟考核"):
-            ss.exam_questions = build_exam_paper()
-            ss.exam_answers = {}
-            ss.exam_index = 0
+            _reset_exam_state()
+            ss.exam_questions = build_exam_paper(user_id, bank_id=bank_id)
             ss.exam_start_ts = time.time()
-            ss.exam_finished = False
-            ss.exam_result = None
-            ss.exam_marked = set()
+            ss.exam_session_id = create_exam_session(user_id, ss.exam_questions, ss.exam_start_ts, bank_id)
+            resource(get_exam_sweeper, str(DB_PATH)).schedule(ss.exam_session_id, ss.exam_start_ts)
             st.rerun()
         return
 
@@ -731,13 +3358,7 @@ def render_exam_tab(user_id: str):
         st.success(f"本次模拟考核总分：**{total} 分**")
         st.dataframe(df, use_container_width=True)
         if st.button("重新开始新的模拟考核"):
-            ss.exam_questions = []
-            ss.exam_answers = {}
-            ss.exam_index = 0
-            ss.exam_start_ts = None
-            ss.exam_finished = False
-            ss.exam_result = None
-            ss.exam_marked = set()
+            _reset_exam_state()
             st.rerun()
         return
 
@@ -746,13 +3367,68 @@ def render_exam_tab(user_id: str):
         st.info("暂无试卷")
         return
 
-    # 计时
+    # 各块是独立的 fragment：作答只重跑题目卡片，计时器按自己的节奏刷新，都不会重跑整页
+    render_exam_timer(user_id)
+    st.markdown("---")
+    render_exam_navigator()
+    st.markdown("---")
+    render_exam_question()
+    render_exam_submit_bar(user_id)
+
+
+def _finish_exam(user_id: str):
+    ss = st.session_state
+    total, df = grade_exam(user_id, ss.exam_questions, ss.exam_answers, ss.exam_session_id)
+    ss.exam_finished = True
+    ss.exam_result = (total, df)
+    ss.exam_session_id = None
+
+
+def set_exam_answer(idx: int, value):
+    """记下作答；和上次不同才落库，卡片每次重跑都会调用"""
+    ss = st.session_state
+    if (ss.exam_answers.get(idx) or None) == (value or None):
+        return
+    ss.exam_answers[idx] = value
+    if ss.exam_session_id is None:
+        return
+    if not save_exam_answer(ss.exam_session_id, idx, exam_answer_text(ss.exam_questions[idx]["q_type"], value)):
+        _exam_closed_elsewhere()
+
+
+def _exam_closed_elsewhere():
+    """卷已经在别处交了（到点被后台代交）：改为显示库里记下的成绩，这之后的作答不算"""
+    ss = st.session_state
+    result = load_exam_result(ss.exam_session_id, ss.exam_questions)
+    _reset_exam_state()
+    if result is None:
+        ss.exam_notice = "这张卷已经作废，请重新开始"
+    else:
+        ss.exam_finished = True
+        ss.exam_result = result
+        ss.exam_notice = "考试时间已到，已按截止前保存的作答交卷，之后的修改不计分"
+    st.rerun()
+
+
+def toggle_exam_mark(idx: int):
+    ss = st.session_state
+    if idx in ss.exam_marked:
+        ss.exam_marked.discard(idx)
+    else:
+        ss.exam_marked.add(idx)
+    if ss.exam_session_id is not None:
+        save_exam_mark(ss.exam_session_id, idx, idx in ss.exam_marked)
+
+
+@st.fragment(run_every=EXAM_TIMER_REFRESH_SECONDS)
+def render_exam_timer(user_id: str):
+    ss = st.session_state
+    if ss.exam_finished or not ss.exam_questions:
+        return
     elapsed = int(time.time() - (ss.exam_start_ts or time.time()))
-    remain = 60 * 60 - elapsed
+    remain = EXAM_DURATION_SECONDS - elapsed
     if remain <= 0:
-        total, df = grade_exam(user_id, questions, ss.exam_answers)
-        ss.exam_finished = True
-        ss.exam_result = (total, df)
+        _finish_exam(user_id)
         st.warning("时间到，已自动交卷")
         st.rerun()
         return
@@ -763,67 +3439,88 @@ def render_exam_tab(user_id: str):
     with col_t2:
         st.markdown(f"**剩余时间：{format_hms(remain)}**")
 
-    # 题号导航
-    st.markdown("---")
+
+@st.fragment
+@timed("render")
+def render_exam_navigator():
+    """题号导航、标记和翻页。标记只重跑本块；换题要连同题目卡片一起重画，走整页 rerun"""
+    ss = st.session_state
+    questions = ss.exam_questions
+    idx = ss.exam_index
     st.markdown("**题号导航（点击跳转，黄边=已标记，绿色=已作答）：**")
 
-    nav_html = ""
-    for i, q in enumerate(questions):
-        cls = "nav-btn"
-        if i == ss.exam_index:
-            cls += " current"
-        if i in ss.exam_marked:
-            cls += " marked"
-        if i in ss.exam_answers and ss.exam_answers[i]:
-            cls += " answered"
-        nav_html += f'<span class="{cls}">{i + 1}</span>'
-    st.markdown(nav_html, unsafe_allow_html=True)
+    with timed_section("exam_nav"):
+        nav_html = ""
+        for i, q in enumerate(questions):
+            cls = "nav-btn"
+            if i == idx:
+                cls += " current"
+            if i in ss.exam_marked:
+                cls += " marked"
+            if i in ss.exam_answers and ss.exam_answers[i]:
+                cls += " answered"
+            nav_html += f'<span class="{cls}">{i + 1}</span>'
+        st.markdown(nav_html, unsafe_allow_html=True)
 
     # 跳转输入
     jump_col1, jump_col2 = st.columns([1, 4])
     with jump_col1:
-        jump_to = st.number_input("跳转到第几题", min_value=1, max_value=len(questions), value=ss.exam_index + 1, step=1)
+        jump_to = st.number_input("跳转到第几题", min_value=1, max_value=len(questions), value=idx + 1, step=1)
     with jump_col2:
         if st.button("跳转"):
             ss.exam_index = jump_to - 1
             st.rerun()
 
-    st.markdown("---")
+    col_mark, col_prev, col_next = st.columns(3)
+    with col_mark:
+        # 回调在本块重跑之前执行，导航条直接画出新的标记状态，不用再 rerun
+        label = "取消标记" if idx in ss.exam_marked else "🚩 标记此题"
+        st.button(label, on_click=toggle_exam_mark, args=(idx,))
 
-    # 当前题目
+    with col_prev:
+        if st.button("上一题") and idx > 0:
+            ss.exam_index -= 1
+            st.rerun()
+
+    with col_next:
+        if st.button("下一题") and idx < len(questions) - 1:
+            ss.exam_index += 1
+            st.rerun()
+
+
+@st.fragment
+@timed("render")
+def render_exam_question():
+    """当前题目卡片；改答案只重跑这一块（导航里的「已作答」颜色在下次换题时更新）"""
+    ss = st.session_state
+    questions = ss.exam_questions
     idx = ss.exam_index
     row = questions[idx]
-    qid = row["id"]
     qtype = row["q_type"]
-    options = (row["options"] or "").split("||") if row["options"] else []
+    view = question_view(row)
+    options = view["options"]
 
     st.markdown(f'<div class="question-card">', unsafe_allow_html=True)
-    st.markdown(f'<span class="tag">{escape_html(qtype)}</span>', unsafe_allow_html=True)  # 只显示题型
-    st.markdown(f"**第 {idx + 1} / {len(questions)} 题：** {escape_html(row['text'])}")
+    st.markdown(view["type_tag_html"], unsafe_allow_html=True)  # 只显示题型
+    st.markdown(f"**第 {idx + 1} / {len(questions)} 题：** {view['stem_html']}")
 
     current_ans = ss.exam_answers.get(idx)
 
     if qtype == "单选题":
-        default_idx = None
-        if isinstance(current_ans, str) and current_ans:
-            for i, opt in enumerate(options):
-                if opt.startswith(current_ans):
-                    default_idx = i
-                    break
+        default_idx = view["index_of"].get(current_ans) if isinstance(current_ans, str) else None
         choice = st.radio("请选择：", options, index=default_idx, key=f"exam_single_{idx}")
         if choice:
-            ss.exam_answers[idx] = choice[0] if choice and choice[0].isalpha() else choice
+            set_exam_answer(idx, view["letter_of"][choice])
 
     elif qtype == "多选题":
         st.write("请选择一个或多个答案：")
         selected = current_ans if isinstance(current_ans, list) else []
         new_selected = []
-        for i, opt in enumerate(options):
-            letter = opt[0] if opt and opt[0].isalpha() else str(i)
+        for i, (opt, letter) in enumerate(zip(options, view["letters"])):
             checked = letter in selected
             if st.checkbox(opt, value=checked, key=f"exam_multi_{idx}_{i}"):
                 new_selected.append(letter)
-        ss.exam_answers[idx] = new_selected
+        set_exam_answer(idx, new_selected)
 
     elif qtype == "判断题":
         default_idx = None
@@ -833,74 +3530,731 @@ def render_exam_tab(user_id: str):
             default_idx = 1
         choice = st.radio("请选择：", ["对", "错"], index=default_idx, key=f"exam_judge_{idx}")
         if choice:
-            ss.exam_answers[idx] = choice
+            set_exam_answer(idx, choice)
 
     else:
         text = st.text_area("请填写答案：", value=current_ans or "", key=f"exam_blank_{idx}")
-        ss.exam_answers[idx] = text
+        set_exam_answer(idx, text)
 
     st.markdown("</div>", unsafe_allow_html=True)
 
-    # 标记按钮
-    col_mark, col_prev, col_next, col_submit = st.columns(4)
-    with col_mark:
-        if idx in ss.exam_marked:
-            if st.button("取消标记"):
-                ss.exam_marked.discard(idx)
-                st.rerun()
-        else:
-            if st.button("🚩 标记此题"):
-                ss.exam_marked.add(idx)
-                st.rerun()
-
-    with col_prev:
-        if st.button("上一题") and idx > 0:
-            ss.exam_index -= 1
-            st.rerun()
-
-    with col_next:
-        if st.button("下一题") and idx < len(questions) - 1:
-            ss.exam_index += 1
-            st.rerun()
 
+@st.fragment
+def render_exam_submit_bar(user_id: str):
+    ss = st.session_state
+    answered = sum(1 for a in ss.exam_answers.values() if a)
+    col_info, col_submit = st.columns([3, 1])
+    with col_info:
+        st.caption(f"已作答 {answered} / {len(ss.exam_questions)} 题，已标记 {len(ss.exam_marked)} 题")
     with col_submit:
         if st.button("交卷"):
-            total, df = grade_exam(user_id, questions, ss.exam_answers)
-            ss.exam_finished = True
-            ss.exam_result = (total, df)
+            _finish_exam(user_id)
             st.rerun()
 
 
 # ========= 错题汇总 =========
-def render_wrong_summary(user_id: str):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT q.chapter, q.q_type, q.text, q.answer, w.wrong_count
-        FROM wrong_log w
-        JOIN questions q ON w.question_id = q.id
-        WHERE w.user_id = ?
-        ORDER BY q.q_type, q.chapter, w.last_wrong_ts DESC
-    """, (user_id,))
-    rows = cur.fetchall()
-    conn.close()
-
-    if not rows:
-        st.info("当前用户暂无错题记录。做错的题目会自动添加到这里。")
-        return
+@timed("data")
+def get_wrong_summary(user_id: str, bank_id: int = DEFAULT_BANK_ID):
+    """错题汇总表：题型、章节升序，同章节内最近答错的在前"""
+    bank = get_bank(bank_id)
+
+    def read():
+        with get_conn() as conn:
+            rows = conn.execute("""
+                SELECT question_id, wrong_count, last_wrong_ts FROM wrong_log WHERE user_id = ?
+            """, (user_id,)).fetchall()
+        entries = {r["question_id"]: (r["wrong_count"], r["last_wrong_ts"]) for r in rows}
+        if WRITE_BEHIND:
+            # 叠加还没落库的作答，刚答对的马上移出、刚答错的马上出现
+            for qid, answers in resource(get_answer_writer, str(DB_PATH)).pending_answers(user_id).items():
+                entries[qid] = fold_wrong(entries.get(qid), answers)
+        return entries
+
+    entries = read_with_pending(read)
+    items = [(bank.get(qid), e) for qid, e in entries.items() if e is not None and qid in bank]
+
+    items.sort(key=lambda x: -x[1][1])
+    items.sort(key=lambda x: (x[0]["q_type"], x[0]["chapter"]))
 
     data = []
-    for r in rows:
+    for q, e in items:
         data.append({
-            "章节": r["chapter"],
-            "题型": r["q_type"],
-            "题干": r["text"][:50] + "..." if len(r["text"]) > 50 else r["text"],
-            "标准答案": r["answer"],
-            "错误次数": r["wrong_count"],
+            "章节": q["chapter"],
+            "题型": q["q_type"],
+            "题干": q["text"][:50] + "..." if len(q["text"]) > 50 else q["text"],
+            "标准答案": q["answer"],
+            "错误次数": e[0],
         })
-    df = pd.DataFrame(data)
+    return pd.DataFrame(data)
+
+
+@timed("render")
+def render_wrong_summary(user_id: str, bank_id: int):
+    df = get_wrong_summary(user_id, bank_id)
+    if df.empty:
+        st.info("当前用户暂无错题记录。做错的题目会自动添加到这里。")
+        return
     st.dataframe(df, use_container_width=True)
 
 
+# ========= 题目搜索 =========
+@timed("data")
+def search_questions(query: str, chapter: str = "全部", q_type: str = "全部",
+                     user_id: str = None, only_wrong: bool = False, limit: int = SEARCH_LIMIT,
+                     bank_id: int = DEFAULT_BANK_ID):
+    """在一个题库里按题干和选项搜索，多个词之间是「且」。返回 (题目列表, 搜索词)，有全文索引时按相关度排序。
+
+    不少于 SEARCH_MIN_TERM 个字的词走 FTS5 索引，更短的词（中文两字词很常见）用 instr 逐行过滤。
+    """
+    terms = list(dict.fromkeys(query.split()))
+    if not terms:
+        return [], []
+    join, join_params, where, params = "", [], ["q.bank_id = ?"], [bank_id]
+    if only_wrong:
+        join, join_params = "JOIN wrong_log w ON w.question_id = q.id AND w.user_id = ?", [user_id]
+    if chapter != "全部":
+        where.append("q.chapter = ?")
+        params.append(chapter)
+    if q_type != "全部":
+        where.append("q.q_type = ?")
+        params.append(q_type)
+
+    with get_conn() as conn:
+        fts = _has_fts(conn)
+        long_terms = [t for t in terms if fts and len(t) >= SEARCH_MIN_TERM]
+        for t in terms:
+            if t not in long_terms:
+                where.append("(instr(q.text, ?) > 0 OR instr(COALESCE(q.options, ''), ?) > 0)")
+                params += [t, t]
+        if long_terms:
+            # 每个词作为短语加引号，避免用户输入被当成 FTS5 查询语法
+            match = " ".join('"' + t.replace('"', '""') + '"' for t in long_terms)
+            sql = f"""
+                SELECT q.id FROM questions_fts f
+                JOIN questions q ON q.id = f.rowid {join}
+                WHERE questions_fts MATCH ? {"".join(" AND " + w for w in where)}
+                ORDER BY bm25(questions_fts, 2.0, 1.0)
+                LIMIT ?
+            """
+            params = join_params + [match] + params
+        else:
+            sql = f"""
+                SELECT q.id FROM questions q {join}
+                WHERE {" AND ".join(where)}
+                ORDER BY q.id
+                LIMIT ?
+            """
+            params = join_params + params
+        ids = [r[0] for r in conn.execute(sql, params + [limit])]
+
+    bank = get_bank(bank_id)
+    return [bank.get(qid) for qid in ids if qid in bank], terms
+
+
+def highlight_html(text: str, terms: list) -> str:
+    """转义 HTML 并用 <mark> 标出命中的搜索词"""
+    if not text:
+        return ""
+    pattern = re.compile("|".join(re.escape(t) for t in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    out, pos = [], 0
+    for m in pattern.finditer(text):
+        out.append(escape_html(text[pos:m.start()]))
+        out.append(f"<mark>{escape_html(m.group())}</mark>")
+        pos = m.end()
+    out.append(escape_html(text[pos:]))
+    return "".join(out)
+
+
+@timed("render")
+def render_search_tab(user_id: str, bank_id: int):
+    col1, col2, col3 = st.columns([3, 1, 1])
+    with col1:
+        query = st.text_input("搜索题干或选项", placeholder="多个关键词用空格分隔", key="search_query")
+    with col2:
+        chapter = st.selectbox("章节", ["全部"] + get_all_chapters(bank_id), key="search_chapter")
+    with col3:
+        q_type = st.selectbox("题型", ["全部"] + QTYPE_ORDER, key="search_q_type")
+    only_wrong = st.checkbox("只搜我的错题", key="search_only_wrong")
+
+    if not query.strip():
+        st.info("输入关键词开始搜索。")
+        return
+    start = time.perf_counter()
+    results, terms = search_questions(query, chapter, q_type, user_id, only_wrong, bank_id=bank_id)
+    elapsed = (time.perf_counter() - start) * 1000
+    if not results:
+        st.info("没有找到匹配的题目。")
+        return
+    more = "（只显示前 {} 条）".format(SEARCH_LIMIT) if len(results) >= SEARCH_LIMIT else ""
+    st.caption(f"找到 {len(results)} 道题{more}，用时 {elapsed:.1f} ms")
+
+    for q in results:
+        view = question_view(q)
+        body = "<br>".join([highlight_html(q["text"], terms)] + [highlight_html(o, terms) for o in view["options"]])
+        st.markdown(
+            f'<div class="question-card">{view["tags_html"]}'
+            f'<span class="tag">#{q["id"]}</span><br>{body}'
+            f'<br><span class="tag">答案：{escape_html(q["answer"])}</span></div>',
+            unsafe_allow_html=True,
+        )
+
+
+# ========= 班级分析 =========
+class CohortAnalytics:
+    """全班的题目分析。只保存可以相加的充分统计量，按 answer_log.id 的高水位增量读新作答，分批向量化累加：
+
+    - 每道题：作答数、答对数；考核作答的次数、答对次数，以及答对 / 答错时整卷总分的和、总分的平方和，
+      够算正确率（难度）和点二列相关（区分度）；
+    - 每道题每个错答的次数；
+    - 每个 (学生, 题库, 章节) 的作答数和答对数，用来算全班各章掌握情况。
+
+    第一次统计时把已归档的按天汇总也算进作答数（归档不保留作答内容和考卷，不参与错答和区分度）。
+    题库版本变化（导入、去重合并会改题号）或旧作答被合并成按天汇总后从头重算；清空个人记录不回退已经累加的数。
+    """
+
+    ITEM_COLUMNS = ["n", "c", "en", "ec", "s1", "s0", "s2"]
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.refreshed_ts = 0.0
+        self._reset(None)
+
+    def _reset(self, versions):
+        self.versions = versions   # (各题库版本号, 合并批次数)
+        self.hwm = 0
+        self.rows = 0
+        self.seeded = False  # 按天汇总只在重算后的第一次刷新时并入一次
+        self.items = pd.DataFrame(columns=self.ITEM_COLUMNS, dtype=float)
+        self.wrong = pd.Series(dtype=float)
+        self.students = pd.DataFrame(columns=["n", "c"], dtype=float)
+        self._reports = {}
+
+    def refresh(self, force: bool = False):
+        if not force and time.time() - self.refreshed_ts < COHORT_REFRESH_SECONDS:
+            return
+        with self._lock:
+            if not force and time.time() - self.refreshed_ts < COHORT_REFRESH_SECONDS:
+                return
+            with get_conn() as conn:
+                cur = conn.cursor()
+                cur.row_factory = None  # 大批量读取用元组，省掉 sqlite3.Row
+                versions = (tuple(cur.execute("SELECT id, version FROM banks ORDER BY id").fetchall()),
+                            cur.execute("SELECT value FROM meta WHERE key = 'compactions'").fetchone()[0])
+                if versions != self.versions:
+                    self._reset(versions)
+                latest = cur.execute("SELECT COALESCE(MAX(id), 0) FROM answer_log").fetchone()[0]
+                if self.seeded and latest <= self.hwm:
+                    self.refreshed_ts = time.time()
+                    return
+                q = cur.execute("SELECT id, bank_id, chapter FROM questions").fetchall()
+                chapters = pd.DataFrame(q, columns=["question_id", "bank_id", "chapter"]).set_index("question_id")
+                self._reports = {}
+
+                if not self.seeded:
+                    daily = cur.execute("""
+                        SELECT user_id, question_id, SUM(correct_cnt + wrong_cnt), SUM(correct_cnt)
+                        FROM answer_log_daily GROUP BY user_id, question_id
+                    """).fetchall()
+                    if daily:
+                        self._absorb(pd.DataFrame(daily, columns=["user_id", "question_id", "n", "c"]), chapters)
+                    self.seeded = True
+                while True:
+                    rows = cur.execute("""
+                        SELECT a.id, a.user_id, a.question_id, a.is_correct != 0, a.answer_text, e.total_score
+                        FROM answer_log a LEFT JOIN exam_session e ON e.id = a.exam_session_id
+                        WHERE a.id > ? ORDER BY a.id LIMIT ?
+                    """, (self.hwm, COHORT_CHUNK_ROWS)).fetchall()
+                    if not rows:
+                        break
+                    chunk = pd.DataFrame(rows, columns=["id", "user_id", "question_id", "c", "answer_text", "score"])
+                    chunk["n"] = 1
+                    self._absorb(chunk, chapters)
+                    self.hwm = int(chunk["id"].iat[-1])
+                    self.rows += len(chunk)
+            self.refreshed_ts = time.time()
+
+    def _absorb(self, frame: pd.DataFrame, chapters: pd.DataFrame):
+        """把一批作答（每行可以是已汇总的 n 次作答、其中 c 次答对）累加进统计量"""
+        n = frame["n"].to_numpy(dtype=float)
+        c = frame["c"].to_numpy(dtype=float)
+        score = frame["score"].to_numpy(dtype=float) if "score" in frame else np.full(len(frame), np.nan)
+        exam = ~np.isnan(score)
+        s = np.where(exam, score, 0.0)
+        en = np.where(exam, n, 0.0)
+        ec = np.where(exam, c, 0.0)
+        items = pd.DataFrame({
+            "question_id": frame["question_id"].to_numpy(),
+            "n": n, "c": c, "en": en, "ec": ec,
+            "s1": ec * s, "s0": (en - ec) * s, "s2": en * s * s,
+        }).groupby("question_id").sum()
+        self.items = items if self.items.empty else self.items.add(items, fill_value=0)
+
+        if "answer_text" in frame:
+            wrong = frame.loc[c == 0, ["question_id", "answer_text"]]
+            counts = wrong.groupby(["question_id", "answer_text"]).size().astype(float)
+            self.wrong = counts if self.wrong.empty else self.wrong.add(counts, fill_value=0)
+
+        where = chapters.reindex(frame["question_id"].to_numpy())
+        students = pd.DataFrame({
+            "user_id": frame["user_id"].to_numpy(),
+            "bank_id": where["bank_id"].to_numpy(),
+            "chapter": where["chapter"].to_numpy(),
+            "n": n, "c": c,
+        }).dropna(subset=["chapter"]).groupby(["user_id", "bank_id", "chapter"]).sum()
+        self.students = students if self.students.empty else self.students.add(students, fill_value=0)
+
+    def reports(self, bank: QuestionBank):
+        """(题目分析表, 章节掌握表)；统计量和题库版本都没变时直接返回上次的结果"""
+        cached = self._reports.get(bank.bank_id)
+        if cached is None or cached[0] != bank.version:
+            cached = (bank.version, self.item_report(bank), self.chapter_report(bank))
+            self._reports[bank.bank_id] = cached
+        return cached[1], cached[2]
+
+    def forget(self, bank_id: int):
+        """题库被淘汰出内存时丢掉它的报表缓存，统计量本身保留"""
+        self._reports.pop(bank_id, None)
+
+    def item_report(self, bank: QuestionBank) -> pd.DataFrame:
+        """每道题的难度、区分度和常见错答；没人做过的题不列出"""
+        with self._lock:
+            items = self.items[self.items.index.isin(bank.ids)]
+            wrong = self.wrong[self.wrong.index.get_level_values(0).isin(bank.ids)] if len(self.wrong) else self.wrong
+        if items.empty:
+            return pd.DataFrame()
+
+        en, ec = items["en"], items["ec"]
+        p = ec / en
+        mean = (items["s1"] + items["s0"]) / en
+        sd = np.sqrt((items["s2"] / en - mean ** 2).clip(lower=0))
+        r_pb = (items["s1"] / ec - items["s0"] / (en - ec)) / sd * np.sqrt(p * (1 - p))
+        r_pb = r_pb.where((en >= COHORT_MIN_EXAM_ATTEMPTS) & (sd > 0) & (p > 0) & (p < 1))
+
+        top = ""
+        if len(wrong):
+            # 每题取前几个错答，按名次摊成几列再整列拼接，避免逐题调用 Python 函数
+            top_wrong = wrong.sort_values(ascending=False).groupby(level=0).head(COHORT_TOP_WRONG)
+            qid = top_wrong.index.get_level_values(0)
+            text = pd.Series(top_wrong.index.get_level_values(1), dtype=object).fillna("").replace("", "（空）")
+            labels = pd.DataFrame({
+                "qid": qid,
+                "rank": top_wrong.groupby(level=0).cumcount().to_numpy(),
+                "label": (text + "×" + top_wrong.astype(int).astype(str).to_numpy()).to_numpy(),
+            }).pivot(index="qid", columns="rank", values="label")
+            top = labels[0]
+            for rank in labels.columns[1:]:
+                top = top.str.cat(labels[rank], sep=" / ", na_rep="").str.rstrip(" /")
+
+        qids = items.index.to_numpy()
+        df = pd.DataFrame({
+            "题号": qids,
+            "章节": [bank.chapter_of(q) for q in qids],
+            "题型": [bank.type_of(q) for q in qids],
+            "题干": [bank.get(q)["text"][:40] for q in qids],
+            "作答数": items["n"].astype(int).to_numpy(),
+            "正确率": (items["c"] / items["n"]).round(3).to_numpy(),
+            "考核作答数": en.astype(int).to_numpy(),
+            "区分度": r_pb.round(3).to_numpy(),
+            "常见错答": top.reindex(qids).fillna("").to_numpy() if len(wrong) else "",
+        })
+        return df.sort_values(["正确率", "作答数"], ascending=[True, False], ignore_index=True)
+
+    def chapter_report(self, bank: QuestionBank) -> pd.DataFrame:
+        """全班各章的作答数、正确率和掌握人数"""
+        with self._lock:
+            students = self.students
+        if students.empty or bank.bank_id not in students.index.get_level_values("bank_id"):
+            return pd.DataFrame()
+        per = students.xs(bank.bank_id, level="bank_id")
+        mastered = (per["c"] / per["n"] >= COHORT_MASTERY_ACCURACY) & (per["n"] >= COHORT_MASTERY_MIN_ATTEMPTS)
+        g = per.groupby(level="chapter")
+        df = pd.DataFrame({
+            "学生数": g.size(),
+            "作答数": g["n"].sum().astype(int),
+            "正确率": (g["c"].sum() / g["n"].sum()).round(3),
+            "掌握人数": mastered.groupby(level="chapter").sum().astype(int),
+        })
+        df["掌握率"] = (df["掌握人数"] / df["学生数"]).round(3)
+        df = df.reindex([c for c in bank.chapters if c in df.index])
+        return df.rename_axis("章节").reset_index()
+
+
+@st.cache_resource(show_spinner=False)
+def get_cohort_analytics(db_path: str) -> CohortAnalytics:
+    analytics = CohortAnalytics()
+    get_bank_registry(db_path).on_evict(analytics.forget)
+    return analytics
+
+
+@timed("data")
+def get_cohort_reports(bank_id: int = DEFAULT_BANK_ID, force: bool = False):
+    """(题目分析表, 章节掌握表, 统计器)；距上次刷新不到 COHORT_REFRESH_SECONDS 时直接用缓存"""
+    analytics = resource(get_cohort_analytics, str(DB_PATH))
+    analytics.refresh(force)
+    items, chapters = analytics.reports(get_bank(bank_id))
+    return items, chapters, analytics
+
+
+@timed("render")
+def render_cohort_tab(bank_id: int):
+    force = st.button("立即刷新统计")
+    items, chapters, analytics = get_cohort_reports(bank_id, force)
+    st.caption(f"已统计 {analytics.rows} 条作答（截至作答记录 #{analytics.hwm}），"
+               f"更新于 {time.strftime('%H:%M:%S', time.localtime(analytics.refreshed_ts))}；"
+               f"区分度为该题对错与整卷总分的点二列相关，考核作答少于 {COHORT_MIN_EXAM_ATTEMPTS} 次的题不计算")
+
+    st.subheader("各章掌握情况")
+    if chapters.empty:
+        st.info("这个题库还没有作答记录。")
+        return
+    st.caption(f"掌握：该章正确率 ≥ {COHORT_MASTERY_ACCURACY:.0%} 且作答不少于 {COHORT_MASTERY_MIN_ATTEMPTS} 次")
+    st.dataframe(chapters, use_container_width=True, hide_index=True)
+
+    st.subheader("题目难度与区分度（正确率从低到高）")
+    st.dataframe(items, use_container_width=True, hide_index=True)
+
+
+# ========= 批量判分 =========
+def read_paper_spec(path: Path) -> list:
+    """试卷文件：按题目顺序列出题号，空白或逗号分隔，# 开头的行是注释"""
+    ids = []
+    for line in path.read_text(encoding="utf-8-sig").splitlines():
+        line = line.split("#", 1)[0]
+        ids += [int(tok) for tok in re.split(r"[\s,]+", line) if tok]
+    if not ids:
+        raise ValueError(f"试卷文件里没有题号：{path}")
+    return ids
+
+
+def _init_sheet_worker(db_path: str):
+    """判分工作进程用主进程的库，第一次判分时从库里加载内存题库"""
+    global DB_PATH
+    DB_PATH = Path(db_path)
+
+
+def _grade_sheet_chunk(users: list, sheets: list, question_ids: list, bank_id: int, ts: float = None):
+    """判一组答卷，返回 (答卷数 × 题数 的对错矩阵, 作答行)。
+
+    给了 ts 时顺带按答卷顺序拼好 write_answers 要的作答行，主进程只管写库；不写库时作答行为 None。
+    """
+    correct = grade_answer_sheets(question_ids, sheets, bank_id)
+    if ts is None:
+        return correct, None
+    bank = get_bank(bank_id)
+    q_types = [bank.type_of(qid) for qid in question_ids]
+    n = len(question_ids)
+    rows = [(user_id, qid, c, exam_answer_text(t, a.strip()), ts)
+            for user_id, sheet, ok in zip(users, sheets, correct.tolist())
+            for qid, t, c, a in zip(question_ids, q_types, ok, sheet + [""] * (n - len(sheet)))]
+    return correct, rows
+
+
+def _read_sheet_chunks(path: Path, n_questions: int, report: dict):
+    """逐行读答卷 CSV，按 GRADE_SHEETS_CHUNK 份一组产出 (用户名列表, 作答列表)，不合格的行记进 report"""
+    with open(path, encoding="utf-8-sig", newline="") as f:
+        reader = csv.reader(f)
+        users, sheets = [], []
+        for row in reader:
+            if not row or (reader.line_num == 1 and row[0].strip().lower() in ("user_id", "用户名")):
+                continue
+            user_id = row[0].strip()
+            reason = None
+            if not user_id:
+                reason = "缺少用户名"
+            elif len(row) - 1 > n_questions:
+                reason = f"作答 {len(row) - 1} 列，多于试卷的 {n_questions} 题"
+            if reason:
+                report["rejected_count"] += 1
+                if len(report["rejected"]) < IMPORT_REJECT_SAMPLES:
+                    report["rejected"].append((reader.line_num, reason))
+                continue
+            users.append(user_id)
+            sheets.append(row[1:])   # 后面没填的列算未作答
+            if len(sheets) >= GRADE_SHEETS_CHUNK:
+                yield users, sheets
+                users, sheets = [], []
+        if sheets:
+            yield users, sheets
+
+
+@timed("data")
+def grade_sheet_file(sheets_path: Path, question_ids: list, bank_id: int = DEFAULT_BANK_ID,
+                     workers: int = None, write: bool = True, progress=None) -> dict:
+    """纸质考试批量判分：答卷 CSV 每行为用户名 + 按题目顺序的作答，判分规则和分值同 grade_exam。
+
+    答卷按 GRADE_SHEETS_CHUNK 份一组判分，连同作答行一起在进程池里做；文件小于 GRADE_SHEETS_POOL_MIN_BYTES
+    或 workers=1 时在本进程做。工作进程各自从库里加载一份内存题库，只读不写。
+    主进程按文件顺序收结果，write=True 时每张卷记成一条已交卷的考试会话、作答写进 answer_log / 错题本，
+    攒够 GRADE_SHEETS_WRITE_ROWS 条作答提交一个事务。同一个文件判两次会记两遍。
+
+    写库只有主进程一个写者，速度受 SQLite 单写锁和 answer_log 上的索引限制，工作进程再多也快不过它；
+    分批提交是为了让在线作答能在批与批之间拿到写锁。
+
+    progress(已判份数) 每组回调一次。返回 {"table", "graded", "rejected_count", "rejected"}，
+    table 为每份答卷的得分表，按文件顺序排列。
+    """
+    bank = get_bank(bank_id)
+    missing = [qid for qid in question_ids if qid not in bank]
+    if missing:
+        raise ValueError(f"题号不在该题库里：{', '.join(map(str, missing[:10]))}")
+    q_types = [bank.type_of(qid) for qid in question_ids]
+    scores = exam_score_vector(q_types, bank.exam_config)
+    types = [t for t in QTYPE_ORDER if t in q_types] + sorted(set(q_types) - set(QTYPE_ORDER))
+    type_masks = {t: np.array([qt == t for qt in q_types]) for t in types}
+    blob = array("q", question_ids).tobytes()
+    if sheets_path.stat().st_size < GRADE_SHEETS_POOL_MIN_BYTES:
+        workers = 1
+    workers = workers or os.cpu_count() or 1
+    ts = time.time() if write else None
+
+    report = {"graded": 0, "rejected_count": 0, "rejected": []}
+    columns = {"用户名": [], "得分": [], "答对题数": []}
+    columns.update({f"{t}得分": [] for t in types})
+    pending, pending_rows = [], []
+
+    def collect(users, correct, rows):
+        totals = np.where(correct, scores, 0).sum(axis=1)
+        columns["用户名"] += users
+        columns["得分"] += totals.tolist()
+        columns["答对题数"] += correct.sum(axis=1).tolist()
+        for t, mask in type_masks.items():
+            columns[f"{t}得分"] += np.where(correct[:, mask], scores[mask], 0).sum(axis=1).tolist()
+        report["graded"] += len(users)
+        if write:
+            pending.extend(zip(users, totals.tolist()))
+            pending_rows.extend(rows)
+            if len(pending_rows) >= GRADE_SHEETS_WRITE_ROWS:
+                _write_graded_sheets(pending, pending_rows, len(question_ids), blob, bank_id, ts)
+                pending.clear()
+                pending_rows.clear()
+        if progress:
+            progress(report["graded"])
+
+    chunks = _read_sheet_chunks(sheets_path, len(question_ids), report)
+    if workers == 1:
+        for users, sheets in chunks:
+            collect(users, *_grade_sheet_chunk(users, sheets, question_ids, bank_id, ts))
+    else:
+        # spawn：工作进程重新导入本模块，不继承主进程里的连接和后台线程
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_sheet_worker, initargs=(str(DB_PATH),)) as pool:
+            window = deque()   # 最多同时挂 2 × workers 组，读文件、判分、写库一起往前走
+            for users, sheets in chunks:
+                window.append((users, pool.submit(_grade_sheet_chunk, users, sheets, question_ids, bank_id, ts)))
+                if len(window) >= 2 * workers:
+                    users, fut = window.popleft()
+                    collect(users, *fut.result())
+            while window:
+                users, fut = window.popleft()
+                collect(users, *fut.result())
+    if pending:
+        _write_graded_sheets(pending, pending_rows, len(question_ids), blob, bank_id, ts)
+
+    report["table"] = pd.DataFrame(columns)
+    return report
+
+
+@retry_on_lock
+def _write_graded_sheets(graded: list, answers: list, n_questions: int, question_ids_blob: bytes,
+                         bank_id: int, ts: float):
+    """graded: [(用户名, 总分), ...]，answers 为这些卷按顺序排好的作答行，每卷 n_questions 条；
+    每张卷记成一条已交卷的考试会话（班级分析据此算区分度），作答整批交给 write_answers"""
+    with transaction() as conn:
+        session_ids = [
+            conn.execute("""
+                INSERT INTO exam_session (user_id, bank_id, question_ids, start_ts, status, finished_ts, total_score)
+                VALUES (?, ?, ?, ?, 'finished', ?, ?)
+            """, (user_id, bank_id, question_ids_blob, ts, ts, total)).lastrowid
+            for user_id, total in graded
+        ]
+        write_answers(conn, answers,
+                      exam_session_id=[sid for sid in session_ids for _ in range(n_questions)])
+
+
+# ========= 命令行 =========
+def cli(argv=None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python app.py",
+        description="刷题小玩意儿的维护命令（界面请用 streamlit run app.py 启动）",
+    )
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_import = sub.add_parser("import", help="流式导入题库 CSV")
+    p_import.add_argument("csv", type=Path, help="题库文件，列为 " + ",".join(IMPORT_COLUMNS))
+    p_import.add_argument("--replace", action="store_true", help="导入前清空现有题库（已有作答记录将对不上题号）")
+    p_import.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    p_import.add_argument("--dedup", action="store_true", help="导入后查找并合并重复题")
+    p_import.add_argument("--bank", help="导入到这个题库，不存在时新建；默认导入默认题库")
+    p_import.add_argument("--exam-config", type=Path, help="该题库的组卷配置 JSON，格式同 EXAM_CONFIG")
+
+    p_dedup = sub.add_parser("dedup", help="查找近似重复的题目（默认只报告）")
+    p_dedup.add_argument("--merge", action="store_true", help="把答案一致的重复题合并到题号最小的那道")
+    p_dedup.add_argument("--threshold", type=float, default=DEDUP_THRESHOLD, help="MinHash 相似度阈值")
+    p_dedup.add_argument("--show", type=int, default=20, help="最多列出多少组")
+    p_dedup.add_argument("--bank", help="在这个题库里查找，默认为默认题库")
+
+    sub.add_parser("banks", help="列出所有题库")
+
+    sub.add_parser("rebuild-stats", help="从作答记录重算按用户物化的统计表")
+
+    sub.add_parser("calibrate", help="立即重算题目难度标定（界面进程也会定期在后台重算）")
+
+    p_paper = sub.add_parser("make-paper", help="按组卷配置组一张卷，把题号写进试卷文件（纸质考试用）")
+    p_paper.add_argument("output", type=Path, help="试卷文件，每行一个题号")
+    p_paper.add_argument("--bank", help="从这个题库组卷，默认为默认题库")
+    p_paper.add_argument("--seed", type=int, help="随机种子，给了就能重现同一张卷")
+
+    p_grade = sub.add_parser("grade-sheets", help="纸质考试批量判分，作答写入记录并输出得分表")
+    p_grade.add_argument("paper", type=Path, help="试卷文件，按题目顺序列出题号（可由 make-paper 生成）")
+    p_grade.add_argument("sheets", type=Path, help="答卷 CSV，每行为用户名 + 按题目顺序的作答，多选题写成 ABD")
+    p_grade.add_argument("--bank", help="试卷所在题库，默认为默认题库")
+    p_grade.add_argument("--workers", type=int, help="判分进程数，默认为 CPU 核数；小文件总在本进程判")
+    p_grade.add_argument("--output", type=Path, help="得分表 CSV 写到文件，默认打印到标准输出")
+    p_grade.add_argument("--dry-run", action="store_true", help="只判分出表，不写作答记录")
+
+    p_maint = sub.add_parser("maintain", help="把旧作答记录合并成按天汇总（可选归档），并回收空闲页")
+    p_maint.add_argument("--days", type=float, default=ARCHIVE_AFTER_DAYS, help="合并多少天以前的作答")
+    p_maint.add_argument("--archive-dir", type=Path, help="原始作答先追加到该目录下的 gzip CSV")
+    p_maint.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    p_maint.add_argument("--no-vacuum", action="store_true", help="只合并，不回收空闲页")
+
+    args = parser.parse_args(argv)
+    init_db()
+    register_bank_files()
+
+    if args.command == "import":
+        start = time.time()
+        try:
+            bank_id = DEFAULT_BANK_ID
+            if args.bank or args.exam_config:
+                exam_config = None
+                if args.exam_config:
+                    cfg = check_exam_config(json.loads(args.exam_config.read_text(encoding="utf-8")))
+                    exam_config = json.dumps(cfg, ensure_ascii=False, sort_keys=True)
+                bank_id = upsert_bank(args.bank or DEFAULT_BANK_NAME, args.csv.resolve(), exam_config)
+            report = import_questions(
+                args.csv, replace=args.replace, batch_size=args.batch_size,
+                progress=lambda n: print(f"\r已处理 {n} 行", end="", file=sys.stderr), bank_id=bank_id,
+            )
+        except (OSError, ValueError) as e:
+            print(f"导入失败：{e}", file=sys.stderr)
+            return 1
+        print(file=sys.stderr)
+        for line_no, reason in report["rejected"]:
+            print(f"第 {line_no} 行被拒绝：{reason}", file=sys.stderr)
+        if report["rejected_count"] > len(report["rejected"]):
+            print(f"……其余 {report['rejected_count'] - len(report['rejected'])} 行省略", file=sys.stderr)
+        print(f"导入 {report['inserted']} 题，拒绝 {report['rejected_count']} 行，用时 {time.time() - start:.2f}s")
+        if args.dedup:
+            _print_dedup_report(dedup_questions(merge=True, bank_id=bank_id), show=0)
+
+    elif args.command == "dedup":
+        start = time.time()
+        bank_id = DEFAULT_BANK_ID
+        if args.bank:
+            bank_id = dict((name, bid) for bid, name in list_banks()).get(args.bank)
+            if bank_id is None:
+                print(f"题库不存在：{args.bank}", file=sys.stderr)
+                return 1
+        report = dedup_questions(merge=args.merge, threshold=args.threshold, bank_id=bank_id)
+        _print_dedup_report(report, show=args.show)
+        print(f"用时 {time.time() - start:.2f}s")
+
+    elif args.command == "banks":
+        with get_conn() as conn:
+            rows = conn.execute("""
+                SELECT b.id, b.name, COUNT(q.id), b.exam_config IS NOT NULL, b.source
+                FROM banks b LEFT JOIN questions q ON q.bank_id = b.id
+                GROUP BY b.id ORDER BY b.id
+            """).fetchall()
+        for bid, name, n, custom, source in rows:
+            print(f"#{bid} {name}：{n} 题" + ("，自定义组卷" if custom else "") + (f"，来源 {source}" if source else ""))
+
+    elif args.command == "rebuild-stats":
+        start = time.time()
+        with transaction() as conn:
+            rebuild_user_stats(conn)
+        print(f"统计表已重建，用时 {time.time() - start:.2f}s")
+
+    elif args.command in ("make-paper", "grade-sheets"):
+        bank_id = DEFAULT_BANK_ID
+        if args.bank:
+            bank_id = dict((name, bid) for bid, name in list_banks()).get(args.bank)
+            if bank_id is None:
+                print(f"题库不存在：{args.bank}", file=sys.stderr)
+                return 1
+        ensure_bank_ready(bank_id)  # 题库文件登记了但还没人打开过时先导入
+
+        if args.command == "make-paper":
+            paper = build_exam_paper(rng=random.Random(args.seed), bank_id=bank_id)
+            args.output.write_text("".join(f"{row['id']}  # {row['q_type']}\n" for row in paper), encoding="utf-8")
+            print(f"已组卷 {len(paper)} 题，写入 {args.output}")
+            return 0
+
+        start = time.time()
+        try:
+            report = grade_sheet_file(
+                args.sheets, read_paper_spec(args.paper), bank_id=bank_id, workers=args.workers,
+                write=not args.dry_run, progress=lambda n: print(f"\r已判 {n} 份", end="", file=sys.stderr),
+            )
+        except (OSError, ValueError) as e:
+            print(f"判分失败：{e}", file=sys.stderr)
+            return 1
+        print(file=sys.stderr)
+        for line_no, reason in report["rejected"]:
+            print(f"第 {line_no} 行被拒绝：{reason}", file=sys.stderr)
+        if report["rejected_count"] > len(report["rejected"]):
+            print(f"……其余 {report['rejected_count'] - len(report['rejected'])} 行省略", file=sys.stderr)
+        table = report["table"]
+        if args.output:
+            table.to_csv(args.output, index=False, encoding="utf-8-sig")
+        else:
+            table.to_csv(sys.stdout, index=False)
+        summary = f"判分 {report['graded']} 份，拒绝 {report['rejected_count']} 行"
+        if len(table):
+            summary += f"；平均分 {table['得分'].mean():.1f}，中位数 {table['得分'].median():g}，" \
+                       f"最高 {table['得分'].max()}，最低 {table['得分'].min()}"
+        print(summary + ("（未写入作答记录）" if args.dry_run else "") + f"，用时 {time.time() - start:.2f}s",
+              file=sys.stderr)
+
+    elif args.command == "calibrate":
+        start = time.time()
+        n = calibrate_items()
+        print(f"已标定 {n} 道题的难度，用时 {time.time() - start:.2f}s")
+
+    elif args.command == "maintain":
+        start = time.time()
+        report = compact_answer_log(
+            args.days, archive_dir=args.archive_dir, batch_size=args.batch_size,
+            progress=lambda n: print(f"\r已合并 {n} 条", end="", file=sys.stderr),
+        )
+        print(file=sys.stderr)
+        print(f"合并 {report['rows']} 条 {time.strftime('%Y-%m-%d', time.localtime(report['cutoff']))} 以前的作答"
+              + (f"，原始记录归档到 {report['archive']}" if report["archive"] else ""))
+        if not args.no_vacuum:
+            v = vacuum_free_pages()
+            print(("已切换为增量回收并做了一次全量 VACUUM" if v["full"] else "增量回收完成")
+                  + f"，释放 {v['freed_bytes'] / 1048576:.1f} MB")
+        print(f"用时 {time.time() - start:.2f}s")
+    return 0
+
+
+def _print_dedup_report(report: dict, show: int):
+    for g in report["groups"][:show]:
+        line = f"保留 #{g['keep']}"
+        if g["merge"]:
+            line += " ← " + " ".join(f"#{i}" for i in g["merge"])
+        if g["conflict"]:
+            line += "；答案不同未合并：" + " ".join(f"#{i}" for i in g["conflict"])
+        print(f"{line}（相似度 ≥ {g['similarity']:.2f}）")
+    if len(report["groups"]) > show > 0:
+        print(f"……其余 {len(report['groups']) - show} 组省略")
+    print(f"{report['questions']} 题中有 {len(report['groups'])} 组重复：可合并 {report['duplicates']} 题，"
+          f"答案不同 {report['conflicts']} 题，已合并 {report['merged']} 题")
+
+
 if __name__ == "__main__":
+    # streamlit run app.py 时没有额外参数，走界面；python app.py <命令> 走命令行
+    if len(sys.argv) > 1:
+        sys.exit(cli(sys.argv[1:]))
     main()
\ No newline at end of file
@@ -0,0 +1,223 @@
+"""数据层基准测试：用合成题库和合成作答历史给 app.py 的数据函数计时。
+
+    python bench.py                              # 默认规模跑一遍，结果打印到标准输出
+    python bench.py --questions 100000 --users 5000 --answers 20000000 --output bench.json
+    python bench.py --baseline bench_baseline.json   # 和基线对比，有退化时退出码为 1
+    python bench.py --save-baseline bench_baseline.json
+
+合成数据写在临时目录里，不会碰到当前目录下的 quiz.db。
+"""
+import os
+import csv
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import statistics
+from pathlib import Path
+
+import app
+
+TYPE_MIX = {"单选题": 0.4, "多选题": 0.25, "判断题": 0.2, "填空题": 0.15}
+
+
+# ========= 合成数据 =========
+def write_bank_csv(path: Path, n_questions: int, n_chapters: int, type_mix: dict, rng: random.Random):
+    types = list(type_mix)
+    weights = [type_mix[t] for t in types]
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        w = csv.writer(f)
+        w.writerow(app.IMPORT_COLUMNS)
+        for i in range(n_questions):
+            q_type = rng.choices(types, weights)[0]
+            chapter = f"第{i % n_chapters + 1}章 合成章节"
+            text = f"{i + 1} 合成题干{rng.getrandbits(48):x}，请选择或填写（ ）。"
+            if q_type in ("单选题", "多选题"):
+                options = "||".join(f"{c}、 选项{c}{i}" for c in "ABCD")
+                answer = rng.choice("ABCD") if q_type == "单选题" else "".join(sorted(rng.sample("ABCD", rng.randint(2, 4))))
+            elif q_type == "判断题":
+                options, answer = "", rng.choice(["对", "错"])
+            else:
+                options, answer = "", f"答案{i}"
+            w.writerow([chapter, q_type, text, options, answer])
+
+
+def generate_history(n_users: int, n_answers: int, wrong_ratio: float, span_days: float):
+    """在库里直接生成作答历史：answer_log 用递归 CTE 批量插入，错题本按比例抽样"""
+    with app.get_conn() as conn:
+        lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM questions").fetchone()
+    now = time.time()
+    batch = 500_000
+    done = 0
+    while done < n_answers:
+        n = min(batch, n_answers - done)
+        with app.transaction() as conn:
+            conn.execute("""
+                WITH RECURSIVE seq(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM seq WHERE x < ?)
+                INSERT INTO answer_log (user_id, question_id, is_correct, answer_text, ts)
+                SELECT 'user' || (abs(random()) % ?),
+                       ? + abs(random()) % ?,
+                       abs(random()) % 100 >= 35,
+                       'A',
+                       ? - (abs(random()) % ?) / 1000.0
+                FROM seq
+            """, (n, n_users, lo, hi - lo + 1, now, int(span_days * 86400 * 1000)))
+        done += n
+        print(f"\r生成作答记录 {done}/{n_answers}", end="", file=sys.stderr)
+    print(file=sys.stderr)
+
+    with app.transaction() as conn:
+        conn.execute("""
+            INSERT INTO wrong_log (user_id, question_id, wrong_count, last_wrong_ts)
+            SELECT user_id, question_id, COUNT(*), MAX(ts) FROM answer_log
+            WHERE is_correct = 0 AND abs(random()) % 1000 < ?
+            GROUP BY user_id, question_id
+        """, (int(wrong_ratio * 1000),))
+
+
+# ========= 计时 =========
+def timeit(fn, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        "runs": repeat,
+        "median_ms": round(statistics.median(samples), 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 4),
+        "max_ms": round(samples[-1], 4),
+    }
+
+
+def run(args) -> dict:
+    workdir = Path(tempfile.mkdtemp(prefix="quiz-bench-"))
+    app.DB_PATH = workdir / "quiz.db"
+    app.CSV_PATH = workdir / "questions.csv"
+    try:
+        return _run(args)
+    finally:
+        app.get_pool(str(app.DB_PATH)).close_all()
+        if not args.keep_db:
+            shutil.rmtree(workdir, ignore_errors=True)
+        else:
+            print(f"合成数据库保留在 {app.DB_PATH}", file=sys.stderr)
+
+
+def _run(args) -> dict:
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+
+    type_mix = json.loads(args.type_mix) if args.type_mix else TYPE_MIX
+    write_bank_csv(app.CSV_PATH, args.questions, args.chapters, type_mix, rng)
+    app.init_db()
+
+    results = {}
+    start = time.perf_counter()
+    app.import_csv_if_empty()
+    results["import_csv_if_empty"] = {"runs": 1, "median_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+    generate_history(args.users, args.answers, args.wrong_ratio, args.span_days)
+    with app.transaction() as conn:
+        app.rebuild_user_stats(conn)
+    start = time.perf_counter()
+    app.calibrate_items()  # 让 build_exam_paper 走按难度换题的路径
+    results["calibrate_items"] = {"runs": 1, "median_ms": round((time.perf_counter() - start) * 1000, 2)}
+
+    bank = app.get_bank()
+    users = [f"user{i}" for i in range(args.users)]
+    chapters = bank.chapters
+    ids = bank.ids
+
+    def pick_user():
+        return rng.choice(users)
+
+    cases = {
+        "fetch_questions_for_mode[章节刷题]": lambda: app.fetch_questions_for_mode(pick_user(), "章节刷题", rng.choice(chapters)),
+        "fetch_questions_for_mode[随机刷题]": lambda: app.fetch_questions_for_mode(pick_user(), "随机刷题"),
+        "fetch_questions_for_mode[错题重刷]": lambda: app.fetch_questions_for_mode(pick_user(), "错题重刷"),
+        "get_chapter_summary": lambda: app.get_chapter_summary(pick_user()),
+        "get_question_stats": lambda: app.get_question_stats(pick_user(), rng.choice(ids)),
+        "build_exam_paper": lambda: app.build_exam_paper(pick_user()),
+        "get_wrong_summary": lambda: app.get_wrong_summary(pick_user()),
+    }
+    for name, fn in cases.items():
+        repeat = args.repeat if "随机刷题" not in name else max(3, args.repeat // 10)
+        results[name] = timeit(fn, repeat)
+        print(f"{name}: {results[name]['median_ms']} ms", file=sys.stderr)
+
+    paper = app.build_exam_paper()
+    answers = {i: rng.choice(["A", "B", "对"]) for i in range(len(paper))}
+    results["grade_exam"] = timeit(lambda: app.grade_exam(pick_user(), paper, answers), args.repeat)
+    print(f"grade_exam: {results['grade_exam']['median_ms']} ms", file=sys.stderr)
+
+    return {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "sqlite": app.sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "config": {k: v for k, v in vars(args).items()
+                       if k not in ("baseline", "save_baseline", "output", "keep_db")},
+            "db_bytes": os.path.getsize(app.DB_PATH),
+        },
+        "results": results,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """返回退化项：中位数比基线慢超过 tolerance（比例）的函数"""
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        cur = report["results"].get(name)
+        if not cur:
+            continue
+        ratio = cur["median_ms"] / base["median_ms"] if base["median_ms"] else 1.0
+        if ratio > 1 + tolerance:
+            regressions.append({"name": name, "baseline_ms": base["median_ms"], "current_ms": cur["median_ms"],
+                                "ratio": round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="app.py 数据层基准测试")
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--chapters", type=int, default=30)
+    parser.add_argument("--type-mix", help='题型比例 JSON，例如 {"单选题": 0.5, "判断题": 0.5}')
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--answers", type=int, default=500_000)
+    parser.add_argument("--wrong-ratio", type=float, default=0.3, help="答错过的 (用户, 题) 里留在错题本的比例")
+    parser.add_argument("--span-days", type=float, default=120)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=20240901)
+    parser.add_argument("--output", type=Path, help="结果 JSON 写到文件，默认打印")
+    parser.add_argument("--baseline", type=Path, help="与这个基线文件对比")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="允许比基线慢的比例")
+    parser.add_argument("--save-baseline", type=Path, help="把本次结果存为基线")
+    parser.add_argument("--keep-db", action="store_true", help="跑完保留合成数据库，便于排查")
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    if args.baseline:
+        report["regressions"] = compare(report, json.loads(args.baseline.read_text(encoding="utf-8")), args.tolerance)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        args.output.write_text(text, encoding="utf-8")
+    else:
+        print(text)
+    if args.save_baseline:
+        args.save_baseline.write_text(text, encoding="utf-8")
+
+    for r in report.get("regressions", []):
+        print(f"退化：{r['name']} {r['baseline_ms']} ms -> {r['current_ms']} ms (x{r['ratio']})", file=sys.stderr)
+    return 1 if report.get("regressions") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""并发压力测试：多个进程 × 多个线程对同一个数据库跑练习和模拟考核，检查有没有锁错误和丢失的写入。
+
+    python stress.py                                  # 默认 4 进程 × 8 线程
+    python stress.py --processes 8 --threads 16 --ops 200
+    python stress.py --write-behind                   # 练习作答走后台写队列
+
+每个线程用自己的用户名刷练习（错题本可以按作答顺序逐条核对），模拟考核的交卷则都记在同一个
+共享用户下，制造同一行上的写冲突。合成数据写在临时目录里，不会碰到当前目录下的 quiz.db。
+有任何一项检查不通过时退出码为 1。
+"""
+import sys
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import tempfile
+import threading
+import multiprocessing
+from pathlib import Path
+
+import app
+import bench
+
+SHARED_USER = "shared"
+
+
+# ========= 工作进程 =========
+def _practice(user_id: str, bank, rng: random.Random):
+    qid = rng.choice(bank.ids)
+    row = bank.get(qid)
+    is_correct = rng.random() < 0.6
+    answer = row["answer"] if is_correct else "错误答案"
+    app.submit_practice_answer(user_id, qid, is_correct, answer)
+
+
+def _exam(rng: random.Random):
+    paper = app.build_exam_paper(SHARED_USER, rng=rng)
+    answers = {i: rng.choice(["A", "B", "对"]) for i in range(len(paper))}
+    app.grade_exam(SHARED_USER, paper, answers)
+    return len(paper)
+
+
+def worker(db_path: str, proc_no: int, n_threads: int, n_ops: int, exam_ratio: float,
+           write_behind: bool, seed: int, results):
+    app.DB_PATH = Path(db_path)
+    app.WRITE_BEHIND = write_behind
+    bank = app.get_bank()
+    counts = {"practice": 0, "exam_answers": 0, "errors": []}
+    lock = threading.Lock()
+
+    def run_thread(thread_no: int):
+        rng = random.Random(seed * 1000003 + proc_no * 1009 + thread_no)
+        user_id = f"p{proc_no}t{thread_no}"
+        practice = exam_answers = 0
+        for _ in range(n_ops):
+            try:
+                if rng.random() < exam_ratio:
+                    exam_answers += _exam(rng)
+                else:
+                    _practice(user_id, bank, rng)
+                    practice += 1
+            except sqlite3.Error as exc:
+                with lock:
+                    counts["errors"].append(f"{user_id}: {exc!r}")
+        with lock:
+            counts["practice"] += practice
+            counts["exam_answers"] += exam_answers
+
+    threads = [threading.Thread(target=run_thread, args=(i,)) for i in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if write_behind:
+        app.get_answer_writer(str(app.DB_PATH)).flush()
+    app.get_pool(str(app.DB_PATH)).close_all()
+    results.put(counts)
+
+
+# ========= 检查 =========
+def check(db_path: Path, expected_practice: int, expected_exam_answers: int) -> list:
+    """返回不一致项；空列表表示全部通过"""
+    failures = []
+    conn = sqlite3.connect(db_path)
+    try:
+        practice = conn.execute("SELECT COUNT(*) FROM answer_log WHERE user_id <> ?", (SHARED_USER,)).fetchone()[0]
+        exam = conn.execute("SELECT COUNT(*) FROM answer_log WHERE user_id = ?", (SHARED_USER,)).fetchone()[0]
+        if practice != expected_practice:
+            failures.append(f"练习作答记录 {practice} 条，应为 {expected_practice} 条")
+        if exam != expected_exam_answers:
+            failures.append(f"考核作答记录 {exam} 条，应为 {expected_exam_answers} 条")
+
+        # 练习用户：按作答顺序重放，答错 +1、答对清零，结果应与错题本一致
+        replay = {}
+        for user_id, qid, ok in conn.execute(
+                "SELECT user_id, question_id, is_correct FROM answer_log WHERE user_id <> ? ORDER BY id",
+                (SHARED_USER,)):
+            replay[(user_id, qid)] = 0 if ok else replay.get((user_id, qid), 0) + 1
+        wrong_log = {(u, q): n for u, q, n in conn.execute(
+            "SELECT user_id, question_id, wrong_count FROM wrong_log WHERE user_id <> ?", (SHARED_USER,))}
+        expected_wrong = {k: n for k, n in replay.items() if n}
+        if wrong_log != expected_wrong:
+            diff = set(wrong_log.items()) ^ set(expected_wrong.items())
+            failures.append(f"练习错题本与作答记录不一致，{len(diff)} 处，例如 {sorted(diff)[:3]}")
+
+        # 共享用户：考核只累加不清除，错题次数之和应等于答错次数
+        shared_wrong = conn.execute(
+            "SELECT COALESCE(SUM(wrong_count), 0) FROM wrong_log WHERE user_id = ?", (SHARED_USER,)).fetchone()[0]
+        shared_expected = conn.execute(
+            "SELECT COUNT(*) FROM answer_log WHERE user_id = ? AND is_correct = 0", (SHARED_USER,)).fetchone()[0]
+        if shared_wrong != shared_expected:
+            failures.append(f"共享用户错题次数 {shared_wrong}，作答记录里答错 {shared_expected} 次")
+
+        # write_answers 维护的统计表应与作答记录逐行一致
+        mismatched = conn.execute("""
+            SELECT COUNT(*) FROM (
+                SELECT user_id, question_id, SUM(is_correct) AS c, SUM(1 - is_correct) AS w
+                FROM answer_log GROUP BY user_id, question_id
+            ) a
+            LEFT JOIN user_question_stats s USING (user_id, question_id)
+            WHERE s.correct_cnt IS NOT a.c OR s.wrong_cnt IS NOT a.w
+        """).fetchone()[0]
+        if mismatched:
+            failures.append(f"user_question_stats 有 {mismatched} 行与作答记录不一致")
+    finally:
+        conn.close()
+    return failures
+
+
+# ========= 入口 =========
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="app.py 并发写入压力测试")
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8, help="每个进程的线程数")
+    parser.add_argument("--ops", type=int, default=100, help="每个线程的操作次数")
+    parser.add_argument("--exam-ratio", type=float, default=0.05, help="操作中交卷所占比例，其余为练习作答")
+    parser.add_argument("--questions", type=int, default=2000)
+    parser.add_argument("--write-behind", action="store_true", help="练习作答走后台写队列")
+    parser.add_argument("--seed", type=int, default=20240901)
+    parser.add_argument("--keep-db", action="store_true", help="跑完保留数据库，便于排查")
+    args = parser.parse_args(argv)
+
+    workdir = Path(tempfile.mkdtemp(prefix="quiz-stress-"))
+    app.DB_PATH = workdir / "quiz.db"
+    app.CSV_PATH = workdir / "questions.csv"
+    try:
+        bench.write_bank_csv(app.CSV_PATH, args.questions, 20, bench.TYPE_MIX, random.Random(args.seed))
+        app.init_db()
+        app.import_csv_if_empty()
+        app.get_pool(str(app.DB_PATH)).close_all()
+
+        ctx = multiprocessing.get_context("spawn")
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(target=worker, args=(str(app.DB_PATH), i, args.threads, args.ops, args.exam_ratio,
+                                             args.write_behind, args.seed, results))
+            for i in range(args.processes)
+        ]
+        start = time.perf_counter()
+        for p in procs:
+            p.start()
+        counts = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        elapsed = time.perf_counter() - start
+
+        errors = [e for c in counts for e in c["errors"]]
+        practice = sum(c["practice"] for c in counts)
+        exam_answers = sum(c["exam_answers"] for c in counts)
+        print(f"{args.processes} 进程 × {args.threads} 线程，用时 {elapsed:.1f} s："
+              f"练习作答 {practice} 次，考核作答 {exam_answers} 题，"
+              f"{(practice + exam_answers) / elapsed:.0f} 条/秒", file=sys.stderr)
+
+        failures = [f"写入报错 {len(errors)} 次，例如 {errors[:3]}"] if errors else []
+        failures += check(app.DB_PATH, practice, exam_answers)
+        for f in failures:
+            print(f"失败：{f}", file=sys.stderr)
+        if not failures:
+            print("通过：没有锁错误，没有丢失的写入", file=sys.stderr)
+        return 1 if failures else 0
+    finally:
+        if args.keep_db:
+            print(f"数据库保留在 {app.DB_PATH}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    sys.exit(main())